@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains a library of anchors: past FINESSE runs with their
+EstimationCase. The estimate of EstimationCase gets worse the further the
+input moves away from the run it was made from, so the library estimates
+with the anchor nearest to the input, or with a distance-weighted blend of
+the nearest anchors. The EstimationCase of every anchor is precomputed
+when it is added, so switching anchors costs nothing.
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import collections
+import copy
+
+import numpy as np
+
+import pf2q.fit as fit
+import pf2q.store as store
+
+
+class Anchor():
+    """ A FINESSE run and everything needed to estimate with it
+    Attributes:
+    finesse_input -- the FinesseInput of the run
+    finesse_data -- the FinesseDataSet of the run
+    estimation_case -- the precomputed EstimationCase of the run
+    parameters -- dict with the input parameters, see store.input_parameters
+    rho -- rho by flux-surface
+    psi -- normalized poloidal flux by flux-surface
+    q_est -- the estimated q of the input of the run
+    q_ratio -- q of FINESSE divided by the estimated q of the input of the
+               run, the error of the estimate on the anchor itself
+    """
+
+    def __init__(self, finesse_input, finesse_data):
+        self.finesse_input = copy.deepcopy(finesse_input)
+        self.finesse_data = finesse_data
+        self.estimation_case = finesse_data.assume_dp_dF_correct()
+        self.estimation_case.precompute(finesse_input.a_0 /
+                                        finesse_input.epsilon)
+        self.parameters = store.input_parameters(finesse_input)
+        self.rho = finesse_data.calculate_rho()
+        psi = finesse_data.psi_finesse[0, :]
+        self.psi = (psi - psi[0]) / (psi[-1] - psi[0])
+        self.q_est, __, __, __ = self.estimation_case.estimate_profiles(
+            finesse_input)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.q_ratio = np.abs(finesse_data.q_finesse[0, :] / self.q_est)
+        # The estimate is not defined on the magnetic axis
+        self.q_ratio[0] = self.q_ratio[1]
+
+
+class AnchorLibrary():
+    """ Past FINESSE runs to estimate from
+    The distance between two inputs is the Euclidean distance between their
+    parameters, each divided by its scale. By default these are the
+    parameters fit.fit varies: the coefficients of F2_tilde_poly and
+    P_tilde_poly except the constant ones, and alpha.
+    """
+
+    def __init__(self, parameters=None, scales=None, max_anchors=None):
+        """
+        Keyword arguments:
+        parameters -- names of the parameters used in the distance, like
+                      "F2_tilde_poly[2]" or "alpha". Defaults to
+                      fit.default_parameters of every anchor
+        scales -- dict with per parameter name the change that counts as
+                  distance 1. Defaults to the absolute value of the
+                  parameter of the first anchor, or 1 if that is smaller
+        max_anchors -- maximum number of anchors. When full, the oldest
+                       anchor is removed. None for no limit
+        """
+        self.parameters = None if parameters is None else list(parameters)
+        self.scales = dict(scales or {})
+        self.anchors = collections.deque(maxlen=max_anchors)
+
+    def add(self, finesse_input, finesse_data):
+        """ Add a FINESSE run as anchor
+
+        Arguments:
+        finesse_input -- the FinesseInput of the run
+        finesse_data -- the FinesseDataSet of the run
+
+        Returns:
+        anchor -- the new Anchor
+        """
+        anchor = Anchor(finesse_input, finesse_data)
+        for name, value in anchor.parameters.items():
+            self.scales.setdefault(name, max(abs(value), 1.))
+        self.anchors.append(anchor)
+        return anchor
+
+    def __len__(self):
+        return len(self.anchors)
+
+    def _names(self, finesse_input):
+        if self.parameters is not None:
+            return self.parameters
+        names = set(fit.default_parameters(finesse_input))
+        for anchor in self.anchors:
+            names.update(fit.default_parameters(anchor.finesse_input))
+        return sorted(names)
+
+    def distances(self, finesse_input):
+        """ Distance of finesse_input to every anchor, oldest anchor first """
+        names = self._names(finesse_input)
+        parameters = store.input_parameters(finesse_input)
+        scales = np.array([self.scales.get(name, 1.) for name in names])
+        vector = np.array([parameters.get(name, 0.) for name in names])
+        anchors = np.array([[anchor.parameters.get(name, 0.)
+                             for name in names] for anchor in self.anchors])
+        return np.sqrt(np.sum(((anchors - vector) / scales) ** 2, axis=1))
+
+    def nearest(self, finesse_input, k=1):
+        """ The k anchors nearest to finesse_input
+
+        Returns:
+        [(distance, anchor), ...] -- nearest first
+        """
+        if len(self.anchors) == 0:
+            raise AnchorError("The library has no anchors")
+        distances = self.distances(finesse_input)
+        order = np.argsort(distances, kind='stable')[:k]
+        return [(distances[i], self.anchors[i]) for i in order]
+
+    def estimate_q(self, finesse_input, k=1, power=2, correct_bias=False):
+        """ Estimate the q-profile with the nearest anchors
+        With k = 1 this is the estimate of the EstimationCase of the nearest
+        anchor. Otherwise the profiles of the k nearest anchors are blended
+        with weights 1/distance^power, on the flux-surfaces of the nearest
+        anchor, matched by normalized poloidal flux.
+
+        Arguments:
+        finesse_input -- a FinesseInput instance
+
+        Keyword arguments:
+        k -- the number of anchors to blend
+        power -- power of the inverse distance in the weights
+        correct_bias -- if true, the estimate of each anchor is multiplied
+                        by its q_ratio, so it is exact for the input of the
+                        anchor
+
+        Returns:
+        q_est, I_encl, (B_p_est, B_phi_est), anchor
+        q_est, I_encl -- see EstimationCase.estimate_q
+        (B_p_est, B_phi_est) -- the estimated fields of the nearest anchor
+        anchor -- the nearest Anchor, with the rho of the profiles
+        """
+        nearest = self.nearest(finesse_input, k=k)
+        __, anchor = nearest[0]
+        q_est, I_encl, fields = anchor.estimation_case.estimate_q(
+            finesse_input)
+        if correct_bias:
+            q_est = q_est * anchor.q_ratio
+        if len(nearest) == 1 or nearest[0][0] == 0:
+            return q_est, I_encl, fields, anchor
+
+        distances = np.array([distance for distance, __ in nearest])
+        weights = 1 / distances ** power
+        weights /= np.sum(weights)
+        q_blend = weights[0] * q_est
+        I_blend = weights[0] * I_encl
+        for weight, (__, other) in zip(weights[1:], nearest[1:]):
+            q_other, I_other, __, __ = \
+                other.estimation_case.estimate_profiles(finesse_input)
+            if correct_bias:
+                q_other = q_other * other.q_ratio
+            q_other[0] = q_other[1]
+            q_blend += weight * np.interp(anchor.psi, other.psi, q_other)
+            I_blend += weight * np.interp(anchor.psi, other.psi, I_other)
+        # The estimate is not defined on the magnetic axis
+        q_blend[0] = q_est[0]
+        return q_blend, I_blend, fields, anchor
+
+
+class AnchorError(Exception):
+    def __init__(self, message):
+        super(AnchorError, self).__init__(message)
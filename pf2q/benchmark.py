@@ -0,0 +1,458 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains benchmarks for the performance critical parts of PF2q.
+None of them need FINESSE, all data is generated on the fly. Run all
+benchmarks with python -m pf2q.benchmark
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+from __future__ import print_function
+
+import copy
+import os
+import re
+import shutil
+import tempfile
+import timeit
+
+import numpy as np
+
+import pf2q.cache as cache
+import pf2q.finesse as finesse
+import pf2q.synthetic as synthetic
+import pf2q.tools as tools
+
+# Grid sizes used in final_report/report_scripts
+npoints = [17, 33, 65, 129, 257]
+
+
+def _read_output_data_reference(file_path):
+    """ Line by line parser, as PF2q used to parse FINESSE output files
+    Only used as reference for benchmark_read_output_data.
+    """
+    with open(file_path, 'r') as f:
+        line = f.readline()
+        words = re.split(r'\s{1,}', line)
+        values = [float(word)for word in words[1:-1]]
+        finesse_data = dict(zip(finesse.FinesseDataSet.constants, values))
+
+        line = f.readline()
+        words = re.split(r'\s{1,}', line)
+        finesse_data["NR_INVERSE"] = int(words[1])
+        finesse_data["NP_INVERSE"] = int(words[2])
+        matrix = np.empty([finesse_data["NR_INVERSE"] *
+                           finesse_data["NP_INVERSE"], 40], dtype=float)
+        for i, line in enumerate(f):
+            words = re.split(r'\s{1,}', line)
+            values = [float(word)for word in words[1:-1]]
+            matrix[i] = values
+        d3_matrix = np.reshape(matrix, [finesse_data["NR_INVERSE"],
+                                        finesse_data["NP_INVERSE"], 40])
+        for column_name, column_number in finesse.FinesseDataSet.data.items():
+            finesse_data[column_name] = d3_matrix[:, :, column_number]
+    return finesse_data
+
+
+def _ring_integral_reference(triangular_map, value):
+    """ TriangularMap.ring_integral as PF2q used to calculate it, summing
+    all inner rings again for every ring
+    Only used as reference for benchmark_ring_integral.
+    """
+    (__, __), ((dvalue_1, dsurface_1),
+               (dvalue_2, dsurface_2)) = triangular_map.surface_integral(value)
+    dvalue_encl_ring = np.sum(dvalue_1 * dsurface_1 +
+                              dvalue_2 * dsurface_2, axis=0)
+    value_encl = np.empty_like(dvalue_encl_ring)
+    for i in range(1, len(dvalue_encl_ring) + 1):
+        value_encl[i - 1] = sum(dvalue_encl_ring[0:i])
+    return value_encl
+
+
+def _estimate_q_reference(estimation_case, finesse_input):
+    """ EstimationCase.estimate_q as PF2q used to calculate it, with the full
+    ring and contour integral on every call
+    Only used as reference for benchmark_estimate_q.
+    """
+    finesse_output = estimation_case.finesse_output
+    psi = finesse_output.psi_finesse[0, :]
+    F2_tilde = np.polyval(finesse_input.F2_tilde_poly, psi)
+    F2, (c_F, _) = tools.rescale(F2_tilde, estimation_case.F_0 ** 2,
+                                 estimation_case.F_1 ** 2)
+    P = np.polyval(finesse_input.P_tilde_poly, psi)
+    _, (c_p, _) = tools.rescale(P, estimation_case.P_0, estimation_case.P_1)
+    F2_poly = finesse_input.F2_tilde_poly.deriv() * c_F/estimation_case.Psi_1
+    F2_prime = np.polyval(F2_poly, psi)
+    p_poly = finesse_input.P_tilde_poly.deriv() * c_p/estimation_case.Psi_1
+    p_prime = np.polyval(p_poly, psi)
+
+    R0 = finesse_input.a_0 / finesse_input.epsilon
+    R = R0 + finesse_output.x_map.points_x[:, :, 0]
+    j_phi = -0.5 * F2_prime / (finesse.mu0 * R) - p_prime * R
+
+    I_encl = _ring_integral_reference(finesse_output.triangular_map, j_phi)
+    I_encl = np.insert(I_encl, 0, 0)
+    dl = finesse_output.triangular_map.calculate_dl()
+    L = np.sum(dl, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        B_p_est_const = finesse.mu0 * I_encl / L
+        B_p_est_const[0] = 0
+        B_p_est = estimation_case.B_p_scaling * \
+            np.tile(B_p_est_const, (len(B_p_est_const), 1))
+        B_phi_est = finesse_input.SIGN_I * np.tile(np.sqrt(F2),
+                                                   (len(F2), 1)) / R
+        q_est, _ = finesse_output.x_map.contour_integral(
+            (B_phi_est / (R * B_p_est))[0:-1, :])
+    q_est /= 2 * np.pi
+    q_est *= finesse_input.alpha / finesse_output.ALPHA
+    return q_est, I_encl, (B_p_est, B_phi_est)
+
+
+def synthetic_estimation_case(npoint):
+    """ EstimationCase of a synthetic FINESSE run of example_input
+
+    Returns:
+    (estimation_case, finesse_input) -- the EstimationCase and the
+                                        FinesseInput it was made from
+    """
+    finesse_input = synthetic.example_input(npoint)
+    finesse_data = finesse.FinesseDataSet(
+        synthetic.synthetic_output(finesse_input), finesse_input.a_0,
+        finesse_input.B_phi0)
+    return finesse_data.assume_dp_dF_correct(), finesse_input
+
+
+def random_output_data(npoint, seed=0):
+    """ Generate a dict with random FINESSE output on an npoint x npoint grid
+
+    Arguments:
+    npoint -- NR_INVERSE and NP_INVERSE of the generated data
+
+    Keyword Arguments:
+    seed -- seed of the random generator
+
+    Returns:
+    finesse_data -- dict with all constants and 2d data sets
+    """
+    random = np.random.RandomState(seed)
+    finesse_data = {}
+    for name in finesse.FinesseDataSet.constants:
+        finesse_data[name] = random.uniform(0.1, 1)
+    finesse_data["NR_INVERSE"] = finesse_data["NP_INVERSE"] = npoint
+    for name in finesse.FinesseDataSet.data:
+        finesse_data[name] = random.uniform(-1, 1, (npoint, npoint))
+    return finesse_data
+
+
+def benchmark_read_output_data(npoints=npoints, repeat=3):
+    """ Compare the line by line parser with FinesseSession.read_output_data
+    Also times reading the binary sidecar written by read_output_data.
+
+    Keyword Arguments:
+    npoints -- list of grid sizes to benchmark
+    repeat -- number of times each parser is timed, the best time is used
+
+    Returns:
+    results -- dict with per npoint the best time in seconds of the
+               'reference' and 'vectorized' parser and of a 'sidecar' read
+    """
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for npoint in npoints:
+            file_path = os.path.join(tmp_dir, "finesse.dat")
+            finesse.FinesseSession.write_output_data(
+                file_path, random_output_data(npoint))
+
+            reference = _read_output_data_reference(file_path)
+            vectorized = finesse.FinesseSession.read_output_data(file_path)
+            for name in finesse.FinesseDataSet.data:
+                if not np.allclose(reference[name], vectorized[name]):
+                    raise Exception("Parsers disagree on " + name)
+
+            results[npoint] = {
+                "reference": min(timeit.repeat(
+                    lambda: _read_output_data_reference(file_path),
+                    number=1, repeat=repeat)),
+                "vectorized": min(timeit.repeat(
+                    lambda: finesse.FinesseSession.read_output_data(file_path),
+                    number=1, repeat=repeat))}
+
+            # The first read writes the sidecar, the next ones map it
+            finesse.FinesseSession.read_output_data(file_path, sidecar=True)
+            results[npoint]["sidecar"] = min(timeit.repeat(
+                lambda: finesse.FinesseSession.read_output_data(file_path,
+                                                                sidecar=True),
+                number=1, repeat=repeat))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def benchmark_memory_usage(npoints=npoints):
+    """ Compare the memory kept alive per FinesseDataSet
+    The reference keeps views into the full 40-column matrix, the compact
+    data sets own one C-contiguous array per field.
+
+    Keyword Arguments:
+    npoints -- list of grid sizes to benchmark
+
+    Returns:
+    results -- dict with per npoint the size in bytes of the 'reference',
+               'float64' and 'float32' data sets
+    """
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for npoint in npoints:
+            file_path = os.path.join(tmp_dir, "finesse.dat")
+            finesse.FinesseSession.write_output_data(
+                file_path, random_output_data(npoint))
+
+            reference = _read_output_data_reference(file_path)
+            results[npoint] = {"reference": tools.memory_usage(
+                [reference[name] for name in finesse.FinesseDataSet.data])}
+            for dtype in [np.float64, np.float32]:
+                finesse_data = finesse.FinesseSession.read_output_data(
+                                                        file_path, dtype=dtype)
+                data_set = finesse.FinesseDataSet(finesse_data, 1, 1)
+                results[npoint][np.dtype(dtype).name] = \
+                    data_set.memory_usage()
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def benchmark_session(npoints=npoints, repeat=3):
+    """ Time FinesseSession.run_finesse with the synthetic FINESSE backend
+    This measures the overhead of PF2q itself: generating and writing the
+    output, the run directory and parsing. A run served from a ResultCache
+    is timed too.
+
+    Keyword Arguments:
+    npoints -- list of grid sizes to benchmark
+    repeat -- number of times each run is timed, the best time is used
+
+    Returns:
+    results -- dict with per npoint the best time in seconds of a 'run' and
+               a 'cached' run
+    """
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        result_cache = cache.ResultCache(os.path.join(tmp_dir, "cache"))
+        run_finesse = synthetic.make_run_finesse_synthetic()
+        session = finesse.FinesseSession(None, run_finesse,
+                                         os.path.join(tmp_dir, "runs"))
+        cached_session = finesse.FinesseSession(None, run_finesse,
+                                                os.path.join(tmp_dir, "runs"),
+                                                result_cache=result_cache)
+        for npoint in npoints:
+            input_data = synthetic.example_input(npoint)
+            cached_session.run_finesse(input_data)
+            results[npoint] = {
+                "run": min(timeit.repeat(
+                    lambda: session.run_finesse(input_data),
+                    number=1, repeat=repeat)),
+                "cached": min(timeit.repeat(
+                    lambda: cached_session.run_finesse(input_data),
+                    number=1, repeat=repeat))}
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def _slider_update_reference(estimation_case, finesse_input, p):
+    """ A slider update of the GUI as PF2q used to calculate it: the
+    reference estimate of q and the full volume integrals for beta
+    """
+    q_est, I_encl, (B_p_est, B_phi_est) = \
+        _estimate_q_reference(estimation_case, finesse_input)
+    triangular_map = estimation_case.finesse_output.triangular_map
+    R0 = finesse_input.a_0 / finesse_input.epsilon
+    beta = finesse.calculate_beta(triangular_map, p, B_phi_est, R0)
+    betap = finesse.calculate_betap(triangular_map, p, B_p_est, R0)
+    return q_est, I_encl, (beta, betap)
+
+
+def _slider_update(estimation_case, finesse_input, p):
+    """ A slider update of the GUI, see FpTool._estimate_q """
+    q_est, I_encl, F2, B_p_est_const = \
+        estimation_case.estimate_profiles(finesse_input)
+    return q_est, I_encl, estimation_case.estimate_beta(p, F2, B_p_est_const)
+
+
+def benchmark_estimate_q(npoints=npoints, repeat=20):
+    """ Time one slider update of the GUI: EstimationCase.estimate_q for a
+    FinesseInput with changed coefficients
+    The 'reference' recalculates the geometry and the full ring and contour
+    integral every call, 'precomputed' reuses what EstimationCase.precompute
+    calculated once per FINESSE run and 'profiles' skips the 2d fields too.
+    'slider_reference' and 'slider' time the whole slider update, with beta
+    and beta poloidal, as it used to be and as FpTool does it now.
+
+    Keyword Arguments:
+    npoints -- list of grid sizes to benchmark
+    repeat -- number of times each estimate is timed, the best time is used
+
+    Returns:
+    results -- dict with per npoint the best time in seconds of the
+               'reference', 'precomputed', 'profiles', 'slider_reference'
+               and 'slider' estimate
+    """
+    results = {}
+    for npoint in npoints:
+        estimation_case, finesse_input = synthetic_estimation_case(npoint)
+        finesse_input.P_tilde_poly[1] += 0.1
+        reference = _estimate_q_reference(estimation_case, finesse_input)
+        precomputed = estimation_case.estimate_q(finesse_input)
+        p, __ = tools.rescale(
+            np.polyval(finesse_input.P_tilde_poly, estimation_case.psi),
+            estimation_case.P_0, estimation_case.P_1)
+        slider_reference = _slider_update_reference(estimation_case,
+                                                    finesse_input, p)
+        slider = _slider_update(estimation_case, finesse_input, p)
+        for name, values in [("q_est", (reference[0], precomputed[0])),
+                             ("I_encl", (reference[1], precomputed[1])),
+                             ("beta", (slider_reference[2], slider[2]))]:
+            if not np.allclose(*values, equal_nan=True):
+                raise Exception("Estimates disagree on " + name)
+
+        results[npoint] = {
+            "reference": min(timeit.repeat(
+                lambda: _estimate_q_reference(estimation_case,
+                                              finesse_input),
+                number=1, repeat=repeat)),
+            "precomputed": min(timeit.repeat(
+                lambda: estimation_case.estimate_q(finesse_input),
+                number=1, repeat=repeat)),
+            "profiles": min(timeit.repeat(
+                lambda: estimation_case.estimate_profiles(finesse_input),
+                number=1, repeat=repeat)),
+            "slider_reference": min(timeit.repeat(
+                lambda: _slider_update_reference(estimation_case,
+                                                 finesse_input, p),
+                number=1, repeat=repeat)),
+            "slider": min(timeit.repeat(
+                lambda: _slider_update(estimation_case, finesse_input, p),
+                number=1, repeat=repeat))}
+    return results
+
+
+def benchmark_estimate_q_batch(npoints=npoints, n_candidates=200, repeat=3):
+    """ Compare estimating q for many candidate inputs one by one with
+    EstimationCase.estimate_q_batch
+
+    Keyword Arguments:
+    npoints -- list of grid sizes to benchmark
+    n_candidates -- number of candidates with random coefficients
+    repeat -- number of times each estimate is timed, the best time is used
+
+    Returns:
+    results -- dict with per npoint the best time in seconds per candidate
+               of the 'sequential' and the 'batch' estimate
+    """
+    results = {}
+    random = np.random.RandomState(0)
+    for npoint in npoints:
+        estimation_case, finesse_input = synthetic_estimation_case(npoint)
+        F2_coefficients = np.asarray(finesse_input.F2_tilde_poly)[::-1] * \
+            random.uniform(0.9, 1.1, (n_candidates,
+                                      finesse_input.F2_tilde_poly.order + 1))
+        P_coefficients = np.asarray(finesse_input.P_tilde_poly)[::-1] * \
+            random.uniform(0.9, 1.1, (n_candidates,
+                                      finesse_input.P_tilde_poly.order + 1))
+        alphas = random.uniform(2, 4, n_candidates)
+        inputs = []
+        for F2_row, P_row, alpha in zip(F2_coefficients, P_coefficients,
+                                        alphas):
+            candidate = copy.deepcopy(finesse_input)
+            candidate.F2_tilde_poly = np.poly1d(F2_row[::-1])
+            candidate.P_tilde_poly = np.poly1d(P_row[::-1])
+            candidate.alpha = alpha
+            inputs.append(candidate)
+
+        q_est, __, __ = estimation_case.estimate_q_batch(
+            finesse_input, F2_coefficients, P_coefficients, alphas)
+        if not np.allclose(q_est[-1], estimation_case.estimate_q(
+                inputs[-1])[0], equal_nan=True):
+            raise Exception("Batch and sequential estimate disagree")
+
+        results[npoint] = {
+            "sequential": min(timeit.repeat(
+                lambda: [estimation_case.estimate_q(candidate)
+                         for candidate in inputs],
+                number=1, repeat=repeat)) / n_candidates,
+            "batch": min(timeit.repeat(
+                lambda: estimation_case.estimate_q_batch(
+                    finesse_input, F2_coefficients, P_coefficients, alphas),
+                number=1, repeat=repeat)) / n_candidates}
+    return results
+
+
+def benchmark_ring_integral(npoints=npoints + [513], n_fields=16,
+                            repeat=3):
+    """ Compare the old ring integral with TriangularMap.ring_integral
+    'single' integrates one grid per call, 'stacked' n_fields grids in one
+    call.
+
+    Keyword Arguments:
+    npoints -- list of grid sizes to benchmark
+    n_fields -- number of stacked grids
+    repeat -- number of times each integral is timed, the best time is used
+
+    Returns:
+    results -- dict with per npoint the best time in seconds per grid of the
+               'reference', 'single' and 'stacked' integral
+    """
+    results = {}
+    random = np.random.RandomState(0)
+    for npoint in npoints:
+        estimation_case, __ = synthetic_estimation_case(npoint)
+        triangular_map = estimation_case.finesse_output.triangular_map
+        values = random.uniform(-1, 1, (n_fields, npoint, npoint))
+        reference = _ring_integral_reference(triangular_map, values[0])
+        if not np.allclose(reference, triangular_map.ring_integral(values)[0]):
+            raise Exception("Ring integrals disagree")
+
+        results[npoint] = {
+            "reference": min(timeit.repeat(
+                lambda: _ring_integral_reference(triangular_map, values[0]),
+                number=1, repeat=repeat)),
+            "single": min(timeit.repeat(
+                lambda: triangular_map.ring_integral(values[0]),
+                number=1, repeat=repeat)),
+            "stacked": min(timeit.repeat(
+                lambda: triangular_map.ring_integral(values),
+                number=1, repeat=repeat)) / n_fields}
+    return results
+
+
+def print_results(title, results, unit="ms", scale=1e3):
+    """ Print a benchmark result dict as a table
+    Each key of results is a row, each key of the inner dict a column.
+    """
+    columns = list(next(iter(results.values())).keys())
+    print(title)
+    print("%8s" % "" + "".join("%14s" % column for column in columns))
+    for row, values in sorted(results.items()):
+        print("%8s" % row +
+              "".join("%11.3f " % (scale * values[column]) + unit
+                      for column in columns))
+    print("")
+
+
+if __name__ == '__main__':
+    print_results("FinesseSession.read_output_data [NR_INVERSE]",
+                  benchmark_read_output_data())
+    print_results("FinesseDataSet.memory_usage [NR_INVERSE]",
+                  benchmark_memory_usage(), unit="kB", scale=1e-3)
+    print_results("FinesseSession.run_finesse, synthetic FINESSE "
+                  "[NR_INVERSE]", benchmark_session())
+    print_results("EstimationCase.estimate_q, one slider update "
+                  "[NR_INVERSE]", benchmark_estimate_q())
+    print_results("EstimationCase.estimate_q_batch, per candidate "
+                  "[NR_INVERSE]", benchmark_estimate_q_batch(), unit="us",
+                  scale=1e6)
+    print_results("TriangularMap.ring_integral, per grid [NR_INVERSE]",
+                  benchmark_ring_integral())
@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains an on-disk cache of parsed FINESSE output, so identical
+FINESSE runs only have to be done once.
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+class ResultCache():
+    """ On-disk cache of parsed FINESSE output
+    Every entry is keyed by FinesseInput.input_hash() and consists of an .npy
+    file with the stacked 2d data sets and a .json file with the constants.
+    When the cache grows larger than max_size, the least recently used
+    entries are removed. The mtime of the .json file is used as time of last
+    use.
+    """
+
+    def __init__(self, cache_path, max_size=2 ** 30):
+        """
+        Arguments:
+        cache_path -- directory to store the cache in. Created if needed
+
+        Keyword arguments:
+        max_size -- maximum size of the cache in bytes
+        """
+        self.cache_path = cache_path
+        self.max_size = max_size
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_path, key)
+        return base + ".npy", base + ".json"
+
+    def __contains__(self, key):
+        return os.path.isfile(self._paths(key)[1])
+
+    def get(self, key, dtype=float):
+        """ Get the parsed FINESSE output stored under key
+
+        Arguments:
+        key -- the key of the entry, usually FinesseInput.input_hash()
+
+        Keyword arguments:
+        dtype -- dtype of the returned 2d data sets. These are memory-mapped
+                 if they are stored in this dtype
+
+        Returns:
+        finesse_data -- dict with the constants and the 2d data sets, or None
+                        if key is not in the cache
+        """
+        npy_path, json_path = self._paths(key)
+        try:
+            with open(json_path, 'r') as f:
+                header = json.load(f)
+            matrix = np.load(npy_path, mmap_mode='r')
+            # Mark as most recently used
+            os.utime(json_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        finesse_data = dict(header["constants"])
+        for i, name in enumerate(header["columns"]):
+            finesse_data[name] = np.asarray(matrix[i], dtype=dtype)
+        return finesse_data
+
+    def put(self, key, finesse_data, columns):
+        """ Store parsed FINESSE output under key and evict old entries
+
+        Arguments:
+        key -- the key of the entry, usually FinesseInput.input_hash()
+        finesse_data -- dict with the constants and 2d data sets
+        columns -- names of the 2d data sets in finesse_data, the rest of
+                   finesse_data is stored as constants
+        """
+        column_names = list(columns)
+        npy_path, json_path = self._paths(key)
+        with open(npy_path + ".tmp", 'wb') as f:
+            np.save(f, np.stack([finesse_data[name] for name in column_names]))
+        os.replace(npy_path + ".tmp", npy_path)
+
+        header = {"columns": column_names,
+                  "constants": dict((name, value.item()
+                                     if hasattr(value, "item") else value)
+                                    for name, value in finesse_data.items()
+                                    if name not in column_names)}
+        with open(json_path + ".tmp", 'w') as f:
+            json.dump(header, f)
+        os.replace(json_path + ".tmp", json_path)
+        self.evict()
+
+    def size(self):
+        """ Total size of the cache in bytes """
+        return sum(size for __, size, __ in self._entries())
+
+    def _entries(self):
+        """ List (key, size, last_used) of all entries in the cache """
+        entries = []
+        for file in os.listdir(self.cache_path):
+            if not file.endswith(".json"):
+                continue
+            key = file[:-len(".json")]
+            npy_path, json_path = self._paths(key)
+            try:
+                size = os.path.getsize(npy_path) + os.path.getsize(json_path)
+                last_used = os.path.getmtime(json_path)
+            except OSError:
+                continue
+            entries.append((key, size, last_used))
+        return entries
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits max_size
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        for key, entry_size, __ in entries:
+            if size <= self.max_size:
+                break
+            for path in self._paths(key)[::-1]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            size -= entry_size
+
+    def clear(self):
+        """ Remove all entries from the cache """
+        for key, __, __ in self._entries():
+            for path in self._paths(key)[::-1]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
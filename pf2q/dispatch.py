@@ -0,0 +1,365 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains a dispatcher that runs FINESSE jobs on several hosts.
+Every host has one or more slots, each with its own run_finesse_function,
+for example made with the unix_functions factories for a different server
+or FINESSE case. Jobs wait in one queue and are only handed to a host when
+a slot is free, and only to the host that is expected to finish them
+first, based on the jobs running on each host and the observed run time
+per grid size. So a slow host does not take jobs a fast host would finish
+sooner. A job that fails because of the
+host is retried on another host, and the host is avoided for a while.
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import collections
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, wait
+
+try:
+    # for Python2
+    import Queue as queue
+except ImportError:
+    # for Python3
+    import queue
+
+import pf2q.finesse as finesse
+import pf2q.pool as pool
+import pf2q.unix_functions as unix_functions
+
+
+# Exceptions of the connection to a host, see is_host_error
+host_errors = (finesse.FinesseTransportError, EnvironmentError, EOFError,
+               subprocess.CalledProcessError)
+
+
+def is_host_error(error):
+    """ Decide if a failed job should be retried on another host
+    Errors of the connection to the host, like a failed ssh or copy or a
+    lost worker, are blamed on the host. Any other error, like a
+    FinesseOutputError of a FINESSE run that diverged or did not converge,
+    fails on every host, so it is not retried.
+    """
+    return isinstance(error, host_errors)
+
+
+class Host():
+    """ An execution target of the Dispatcher
+    The number of slots is the maximum number of jobs that run on the host
+    at once. Every slot has its own run_finesse_function, as two FINESSE
+    runs can not share a FINESSE case.
+    """
+
+    def __init__(self, name, run_finesse_functions, finesse_paths=None):
+        """
+        Arguments:
+        name -- unique name of the host, also used as directory name
+        run_finesse_functions -- list of run_finesse_functions, one per slot
+
+        Keyword arguments:
+        finesse_paths -- list of FinessePaths, one per slot, passed to the
+                         FinesseSession of each slot
+        """
+        self.name = name
+        self.run_finesse_functions = list(run_finesse_functions)
+        if finesse_paths is None:
+            finesse_paths = [None] * len(self.run_finesse_functions)
+        self.finesse_paths = list(finesse_paths)
+        self.jobs = queue.Queue()
+        # Jobs handed to this host and not finished yet
+        self.outstanding = 0
+        self.n_done = 0
+        self.n_failed = 0
+        # Time until which the host is avoided after a failure
+        self.down_until = 0
+        # Observed run time in seconds per NR_INVERSE
+        self.run_times = {}
+
+    @classmethod
+    def local(cls, name, finesse_case_path, n_slots=1, scratch_path=None,
+              make_run_finesse=unix_functions.make_run_finesse_local):
+        """ Make a host that runs FINESSE locally in scratch directories
+        Every slot gets its own clone of the FINESSE case, see
+        pool.clone_case. Handy to test the dispatcher without servers.
+
+        Arguments:
+        name -- unique name of the host
+        finesse_case_path -- path of the (local) FINESSE case to clone
+
+        Keyword arguments:
+        n_slots -- number of jobs that run at once
+        scratch_path -- directory the clones are made in, for example a
+                        different one per host. Defaults to a new temporary
+                        directory
+        make_run_finesse -- function that makes a run_finesse_function for
+                            the FinessePaths of a clone
+        """
+        if scratch_path is None:
+            scratch_path = tempfile.mkdtemp(prefix="pf2q_" + name)
+        finesse_paths = [pool.clone_case(finesse_case_path,
+                                         os.path.join(scratch_path,
+                                                      "case" + str(i)))
+                         for i in range(n_slots)]
+        return cls(name, [make_run_finesse(paths) for paths in finesse_paths],
+                   finesse_paths=finesse_paths)
+
+    @property
+    def n_slots(self):
+        return len(self.run_finesse_functions)
+
+    def expected_run_time(self, npoint):
+        """ Expected run time of a job with NR_INVERSE npoint
+        Uses the run time observed for npoint, otherwise the run time of the
+        nearest observed grid size scaled with the number of grid points.
+        None if nothing was observed yet.
+        """
+        if npoint in self.run_times:
+            return self.run_times[npoint]
+        if len(self.run_times) == 0:
+            return None
+        nearest = min(self.run_times, key=lambda size: abs(size - npoint))
+        return self.run_times[nearest] * (float(npoint) / nearest) ** 2
+
+    def record_run_time(self, npoint, run_time, weight=0.3):
+        """ Update the exponential moving average of the run time """
+        if npoint in self.run_times:
+            run_time = (1 - weight) * self.run_times[npoint] + \
+                weight * run_time
+        self.run_times[npoint] = run_time
+
+
+class _Job():
+    def __init__(self, input_data, backup_result):
+        self.input_data = input_data
+        self.backup_result = backup_result
+        self.future = Future()
+        self.tried = []
+        self.error = None
+
+
+class Dispatcher():
+    """ Runs FINESSE jobs on several hosts
+    Every slot of every host is served by its own thread with its own
+    FinesseSession. The result of each host is stored in its own directory
+    in result_path.
+    """
+
+    def __init__(self, hosts, result_path, retry=is_host_error,
+                 max_tries=None, cooldown=60, **session_kwargs):
+        """
+        Arguments:
+        hosts -- list of Host instances
+        result_path -- path where the run directories are made
+
+        Keyword arguments:
+        retry -- function that gets the exception of a failed job and
+                 returns True if the job should be tried on another host
+        max_tries -- maximum number of hosts a job is tried on. Defaults to
+                     the number of hosts
+        cooldown -- seconds a host is avoided after it failed a job, unless
+                    all other hosts were tried or are avoided too
+        session_kwargs -- passed on to FinesseSession, e.g. dtype
+        """
+        self.hosts = list(hosts)
+        self.retry = retry
+        self.max_tries = len(self.hosts) if max_tries is None else max_tries
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+        self.futures = set()
+        self.threads = []
+        for host in self.hosts:
+            host_path = os.path.join(result_path, host.name)
+            for run_finesse_function, finesse_paths in zip(
+                    host.run_finesse_functions, host.finesse_paths):
+                session = finesse.FinesseSession(finesse_paths,
+                                                 run_finesse_function,
+                                                 host_path, **session_kwargs)
+                thread = threading.Thread(target=self._serve,
+                                          args=(host, session))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _expected_finish(self, host, npoint):
+        run_time = host.expected_run_time(npoint)
+        if run_time is None:
+            # Unknown hosts get the run time of the others, so they are used
+            known = [other.expected_run_time(npoint) for other in self.hosts]
+            known = [run_time for run_time in known if run_time is not None]
+            run_time = sum(known) / len(known) if known else 1.
+        waves = host.outstanding // host.n_slots + 1
+        return waves * run_time
+
+    def _candidates(self, job):
+        """ Hosts job may still be run on, or [] if it should fail """
+        hosts = [host for host in self.hosts if host not in job.tried]
+        if len(job.tried) >= self.max_tries:
+            return []
+        now = time.time()
+        up = [host for host in hosts if host.down_until <= now]
+        return up if len(up) > 0 else hosts
+
+    def _dispatch(self):
+        """ Hand pending jobs to free slots
+        A job is handed to the host expected to finish it first, if that
+        host has a free slot. Otherwise it waits for the next call, which
+        is done every time a job is submitted or finished.
+
+        Jobs that can not be run on any host anymore fail with the error of
+        their last try.
+        """
+        failed = []
+        with self.lock:
+            waiting = collections.deque()
+            while len(self.pending) > 0:
+                if all(host.outstanding >= host.n_slots
+                       for host in self.hosts):
+                    break
+                job = self.pending.popleft()
+                hosts = self._candidates(job)
+                if len(hosts) == 0:
+                    failed.append(job)
+                    continue
+                npoint = job.input_data.NR_INVERSE
+                host = min(hosts, key=lambda host:
+                           self._expected_finish(host, npoint))
+                if host.outstanding >= host.n_slots:
+                    waiting.append(job)
+                    continue
+                host.outstanding += 1
+                job.tried.append(host)
+                host.jobs.put(job)
+            waiting.extend(self.pending)
+            self.pending = waiting
+        for job in failed:
+            error = job.error
+            if error is None:
+                error = DispatchError("No host left to run the job on")
+            if not job.future.done():
+                job.future.set_exception(error)
+
+    def _serve(self, host, session):
+        while True:
+            job = host.jobs.get()
+            if job is None:
+                break
+            if job.future.running() or \
+                    job.future.set_running_or_notify_cancel():
+                self._run(host, session, job)
+            else:
+                # Cancelled before it started
+                with self.lock:
+                    host.outstanding -= 1
+            self._dispatch()
+
+    def _run(self, host, session, job):
+        start = time.time()
+        job.future.timing["started"] = start
+        try:
+            result = session.run_finesse(job.input_data,
+                                         backup_result=job.backup_result)
+        except Exception as error:
+            job.future.timing["finished"] = time.time()
+            retry = self.retry(error)
+            with self.lock:
+                host.outstanding -= 1
+                host.n_failed += 1
+                if retry:
+                    host.down_until = time.time() + self.cooldown
+                    job.error = error
+                    self.pending.appendleft(job)
+            if not retry:
+                job.future.set_exception(error)
+        else:
+            job.future.timing["finished"] = time.time()
+            with self.lock:
+                host.outstanding -= 1
+                host.n_done += 1
+                host.record_run_time(job.input_data.NR_INVERSE,
+                                     job.future.timing["finished"] - start)
+            job.future.set_result(result)
+
+    def submit(self, input_data, backup_result=False):
+        """ Submit a FINESSE job
+
+        Arguments:
+        input_data -- an instance of FinesseInput. It should not be changed
+                      until the job is done
+
+        Keyword arguments:
+        backup_result -- If true, keep the run directory of the job
+
+        Returns:
+        future -- concurrent.futures.Future of the FinesseDataSet. The host
+                  that ran the job is the last one in future.hosts. The
+                  times the job was submitted, and its last try started and
+                  finished, are in the dict future.timing
+        """
+        job = _Job(input_data, backup_result)
+        job.future.hosts = job.tried
+        job.future.timing = {"submitted": time.time()}
+        with self.lock:
+            self.futures.add(job.future)
+            self.pending.append(job)
+        job.future.add_done_callback(self._forget)
+        self._dispatch()
+        return job.future
+
+    def _forget(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def map(self, inputs):
+        """ Run FINESSE for all inputs
+
+        Arguments:
+        inputs -- iterable of FinesseInput instances
+
+        Returns:
+        results -- iterator over the FinesseDataSets, in the order of inputs.
+                   A failed job raises its exception when reached
+        """
+        futures = [self.submit(input_data) for input_data in inputs]
+        return (future.result() for future in futures)
+
+    def stats(self):
+        """ Per host name a dict with the number of 'outstanding', 'done'
+        and 'failed' jobs, the observed 'run_times' per grid size and if the
+        host is avoided because it failed ('down')
+        """
+        with self.lock:
+            return dict((host.name, {"outstanding": host.outstanding,
+                                     "done": host.n_done,
+                                     "failed": host.n_failed,
+                                     "run_times": dict(host.run_times),
+                                     "down": host.down_until > time.time()})
+                        for host in self.hosts)
+
+    def close(self):
+        """ Wait for all jobs and stop the threads """
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+        for host in self.hosts:
+            for __ in range(host.n_slots):
+                host.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DispatchError(Exception):
+    def __init__(self, message):
+        super(DispatchError, self).__init__(message)
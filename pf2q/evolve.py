@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains a population-based optimizer of the FINESSE input
+that scores every candidate with a real FINESSE run, for when the estimate
+is not accurate enough to fit on. It is differential evolution: every
+generation each member of the population gets a trial input, mixed from
+the other members, and the trial replaces the member if FINESSE scores it
+better. All trials of a generation are run in parallel. Runs that fail, for
+example with a FinesseOutputError, get a penalty score. Before a trial is
+run, it is estimated with the anchor nearest to it, see anchors.py, and
+trials that are estimated much worse than the member they compete with are
+dropped without a run.
+
+The state is saved to a checkpoint directory after every generation, so an
+optimization that is killed can be resumed with Evolution(checkpoint_path).
+The random numbers of a generation only depend on the seed and the
+generation, so a resumed generation runs the same trials.
+
+Checkpoint directory layout:
+    spec.json -- the parameters, the settings, the seed and the target
+    base_input.pkl -- the pickled base FinesseInput
+    state.json -- the generation, the population, the scores and the
+                  history
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import json
+import os
+import pickle
+import shutil
+import time
+from concurrent.futures import as_completed
+
+import numpy as np
+
+import pf2q.anchors as anchors
+import pf2q.sweep as sweep
+import pf2q.tools as tools
+
+
+class BadnessObjective():
+    """ The default objective: the mean absolute value of the total badness
+    and the badness at rho = .08, q = 1, q = 1.1 and the one-but-last point,
+    see tools.badness
+    """
+
+    def __init__(self, rho_target, q_target):
+        self.rho_target = np.asarray(rho_target)
+        self.q_target = np.abs(q_target)
+
+    def __call__(self, rho, q):
+        """
+        Arguments:
+        rho -- rho by flux-surface
+        q -- the absolute value of q by flux-surface
+
+        Returns:
+        value -- the score, lower is better
+        """
+        total, points = tools.badness(self.rho_target, self.q_target, rho, q)
+        return float(np.mean(np.abs([total] +
+                                    [badness for __, badness in points[:-1]])))
+
+
+def _reflect(population, low, high):
+    """ Mirror values outside [low, high] back into it """
+    population = np.where(population < low, 2 * low - population,
+                          population)
+    population = np.where(population > high, 2 * high - population,
+                          population)
+    return np.clip(population, low, high)
+
+
+class Evolution():
+    """ Differential evolution checkpointed in a directory, see the module
+    documentation
+    Create a new optimization with Evolution.create and open an existing
+    one, for example after a crash, with Evolution(checkpoint_path).
+    """
+
+    def __init__(self, checkpoint_path):
+        """
+        Arguments:
+        checkpoint_path -- the checkpoint directory made by Evolution.create
+        """
+        self.checkpoint_path = checkpoint_path
+        with open(os.path.join(checkpoint_path, "spec.json"), 'r') as f:
+            self.spec = json.load(f)
+        with open(os.path.join(checkpoint_path, "base_input.pkl"), 'rb') as f:
+            self.base_input = pickle.load(f)
+        with open(os.path.join(checkpoint_path, "state.json"), 'r') as f:
+            self.state = json.load(f)
+        self.parameters = [sweep.Parameter(**parameter)
+                           for parameter in self.spec["parameters"]]
+        self.names = [parameter.name for parameter in self.parameters]
+        self.low = np.array([parameter.low for parameter in self.parameters])
+        self.high = np.array([parameter.high
+                              for parameter in self.parameters])
+
+    @classmethod
+    def create(cls, checkpoint_path, base_input, parameters, rho_target=None,
+               q_target=None, population_size=None, mutation=0.7,
+               crossover=0.9, seed=0, penalty=1e10):
+        """ Write a new checkpoint directory
+
+        Arguments:
+        checkpoint_path -- the checkpoint directory, should not exist yet
+        base_input -- the FinesseInput the parameters are varied of
+        parameters -- list of sweep.Parameter instances with low and high
+
+        Keyword arguments:
+        rho_target, q_target -- the target of the default objective, see
+                                BadnessObjective
+        population_size -- number of members, defaults to 5 per parameter
+                           and at least 4
+        mutation -- the differential weight, the step along the difference
+                    of two members
+        crossover -- the probability that a parameter of the trial comes
+                     from the mixed input instead of the member
+        seed -- seed of the random generator
+        penalty -- the score of runs that fail
+
+        Returns:
+        evolution -- Evolution instance of the new checkpoint directory
+        """
+        for parameter in parameters:
+            if parameter.low is None or parameter.high is None:
+                raise EvolutionError("Give low and high of " +
+                                     parameter.name)
+        if population_size is None:
+            population_size = max(4, 5 * len(parameters))
+        if population_size < 4:
+            raise EvolutionError("The population needs at least 4 members")
+        # Check the parameters before anything is written
+        sweep.apply_point(base_input, dict(
+            (parameter.name, parameter.low) for parameter in parameters))
+
+        # Write to a temporary directory first, so a crash halfway does not
+        # leave a half written checkpoint behind
+        tmp_path = checkpoint_path.rstrip(os.sep) + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        with open(os.path.join(tmp_path, "base_input.pkl"), 'wb') as f:
+            pickle.dump(base_input, f)
+        sweep.write_json(os.path.join(tmp_path, "spec.json"), {
+            "parameters": [parameter.to_dict() for parameter in parameters],
+            "population_size": population_size, "mutation": mutation,
+            "crossover": crossover, "seed": seed, "penalty": penalty,
+            "rho_target": None if rho_target is None else
+            np.asarray(rho_target, dtype=float).tolist(),
+            "q_target": None if q_target is None else
+            np.asarray(q_target, dtype=float).tolist()})
+        sweep.write_json(os.path.join(tmp_path, "state.json"), {
+            "generation": 0, "population": None, "scores": None,
+            "history": []})
+        os.rename(tmp_path, checkpoint_path)
+        return cls(checkpoint_path)
+
+    def input(self, values):
+        """ The FinesseInput of a member with values of the parameters """
+        return sweep.apply_point(self.base_input,
+                                 dict(zip(self.names, values)))
+
+    def best(self):
+        """ The best member so far
+
+        Returns:
+        point, score
+        point -- dict with the value of every parameter
+        score -- the score of the member
+        """
+        if self.state["population"] is None:
+            raise EvolutionError("No generation has been run yet")
+        index = int(np.argmin(self.state["scores"]))
+        return (dict(zip(self.names, self.state["population"][index])),
+                self.state["scores"][index])
+
+    def trials(self, generation=None):
+        """ The trial values of every member in generation, rand/1/bin
+        Each trial mixes three other members a + mutation * (b - c), and
+        takes each parameter from the mix with probability crossover, and
+        at least one.
+        """
+        if generation is None:
+            generation = self.state["generation"]
+        population = np.array(self.state["population"])
+        n, dimension = population.shape
+        random = np.random.RandomState([self.spec["seed"], generation])
+        trials = population.copy()
+        for i in range(n):
+            others = random.choice([j for j in range(n) if j != i], 3,
+                                   replace=False)
+            a, b, c = population[others]
+            mix = a + self.spec["mutation"] * (b - c)
+            take = random.uniform(size=dimension) < self.spec["crossover"]
+            take[random.randint(dimension)] = True
+            trials[i, take] = mix[take]
+        return _reflect(trials, self.low, self.high)
+
+    def _save(self):
+        sweep.write_json(os.path.join(self.checkpoint_path, "state.json"),
+                         self.state)
+
+    def run(self, runner, n_generations, objective=None, screen=2.,
+            store=None, max_anchors=50, callback=None):
+        """ Run generations until n_generations are done
+        Generation 0 is the initial population, a Latin hypercube of the
+        parameters. Can be called again after an interruption, the
+        generation that was interrupted is run again.
+
+        Arguments:
+        runner -- anything with a submit(finesse_input) method that returns
+                  a concurrent.futures.Future of the FinesseDataSet, like a
+                  pool.FinessePool, a dispatch.Dispatcher or a
+                  FinesseSession
+        n_generations -- the total number of generations, including the
+                         ones already done
+
+        Keyword arguments:
+        objective -- function objective(rho, q) that scores a q-profile,
+                     lower is better. Defaults to the BadnessObjective of
+                     the target given to create
+        screen -- a trial is not run if its estimated score is more than
+                  screen times the score of the member it competes with,
+                  or if its estimate is not finite. None to run all trials.
+                  The estimate uses the runs of this call only, so nothing
+                  is screened in the first generation after a resume
+        store -- a store.ResultsStore every run is added to, tagged with
+                 the name of the checkpoint directory
+        max_anchors -- the number of runs kept to estimate with
+        callback -- function called as callback(record) after every
+                    generation, with record the dict added to the history
+
+        Returns:
+        finesse_input, score -- the input and score of the best member
+        """
+        if objective is None:
+            if self.spec["q_target"] is None:
+                raise EvolutionError("Give an objective or a target")
+            objective = BadnessObjective(self.spec["rho_target"],
+                                         self.spec["q_target"])
+        penalty = self.spec["penalty"]
+        library = anchors.AnchorLibrary(
+            parameters=self.names,
+            scales=dict(zip(self.names, self.high - self.low)),
+            max_anchors=max_anchors)
+        tag = os.path.basename(os.path.abspath(self.checkpoint_path))
+
+        while self.state["generation"] < n_generations:
+            generation = self.state["generation"]
+            if self.state["population"] is None:
+                points = sweep.sample(self.parameters, sampling="lhs",
+                                      n_samples=self.spec["population_size"],
+                                      seed=self.spec["seed"])
+                candidates = np.array([[point[name] for name in self.names]
+                                       for point in points])
+                parent_scores = np.full(len(candidates), np.inf)
+            else:
+                candidates = self.trials()
+                parent_scores = np.array(self.state["scores"])
+            inputs = [self.input(values) for values in candidates]
+
+            scores = np.full(len(candidates), np.inf)
+            run = np.ones(len(candidates), dtype=bool)
+            if screen is not None and len(library) > 0:
+                for i, finesse_input in enumerate(inputs):
+                    q_est, __, __, anchor = library.estimate_q(
+                        finesse_input, correct_bias=True)
+                    q_est = np.abs(q_est)
+                    # The estimate is not defined on the magnetic axis
+                    q_est[0] = q_est[1]
+                    run[i] = np.all(np.isfinite(q_est)) and \
+                        objective(anchor.rho, q_est) <= \
+                        screen * parent_scores[i]
+
+            futures = {}
+            for i in np.flatnonzero(run):
+                submitted = time.time()
+                futures[runner.submit(inputs[i])] = (i, submitted)
+            n_failed = 0
+            for future in as_completed(futures):
+                i, submitted = futures[future]
+                __, run_time = sweep.run_times(future, submitted)
+                error = None
+                try:
+                    finesse_data = future.result()
+                except Exception as exception:
+                    finesse_data = None
+                    error = exception
+                    scores[i] = penalty
+                    n_failed += 1
+                else:
+                    score = objective(finesse_data.calculate_rho(),
+                                      np.abs(finesse_data.q_finesse[0, :]))
+                    scores[i] = score if np.isfinite(score) else penalty
+                    library.add(inputs[i], finesse_data)
+                if store is not None:
+                    store.add(inputs[i], finesse_data=finesse_data,
+                              run_time=run_time, error=error, tag=tag)
+
+            # A trial replaces its member if it is better
+            better = scores < parent_scores
+            if self.state["population"] is None:
+                population = candidates
+            else:
+                population = np.array(self.state["population"])
+                population[better] = candidates[better]
+            population_scores = np.where(better, scores, parent_scores)
+            record = {"generation": generation,
+                      "n_runs": int(np.sum(run)),
+                      "n_screened": int(np.sum(~run)),
+                      "n_failed": n_failed,
+                      "n_improved": int(np.sum(better)),
+                      "best": float(np.min(population_scores)),
+                      "median": float(np.median(population_scores))}
+            self.state["population"] = population.tolist()
+            self.state["scores"] = population_scores.tolist()
+            self.state["history"].append(record)
+            self.state["generation"] = generation + 1
+            self._save()
+            if callback is not None:
+                callback(record)
+
+        point, score = self.best()
+        return sweep.apply_point(self.base_input, point), score
+
+
+class EvolutionError(Exception):
+    def __init__(self, message):
+        super(EvolutionError, self).__init__(message)
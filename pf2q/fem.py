@@ -130,6 +130,8 @@ class TriangularMap(QuadrilateralMap):
         self.RH = None
         self.SABD = None
         self.SBCD = None
+        self.W_inner = None
+        self.W_outer = None
 
     def volume_integral(self, value, R0):
         """
@@ -148,25 +150,80 @@ class TriangularMap(QuadrilateralMap):
 
         return (result, volume), ((dvalue_1, dvolume_1), (dvalue_2, dvolume_2))
 
+    def volume_weights(self, R0):
+        """
+        Calculates the weights of the grid points in volume_integral, so
+        iiint(value * dV) = sum(weights * value) for every value grid
+
+        Arguments:
+        R0 -- major radius
+
+        Returns:
+        weights -- the weights, with the shape of the grid
+        """
+        self.calculate_centroid()
+        self.calculate_surfaces()
+        dvolume_1 = self.SABD * 2 * np.pi * (R0 + self.G[:, :, 0]) / 3
+        dvolume_2 = self.SBCD * 2 * np.pi * (R0 + self.H[:, :, 0]) / 3
+        weights = np.zeros(self.points_x.shape[:2])
+        # Triangle ABD
+        weights[:-1, :-1] += dvolume_1
+        weights[1:, :-1] += dvolume_1
+        weights[:-1, 1:] += dvolume_1
+        # Triangle BCD
+        weights[1:, :-1] += dvolume_2
+        weights[1:, 1:] += dvolume_2
+        weights[:-1, 1:] += dvolume_2
+        return weights
+
     def ring_integral(self, value):
         """
         Calculates the surface integral of an infinitesimal ring
         iint_0^x(value * dA)
+        The integral over every ring uses the weights of ring_weights, so the
+        enclosed integral is a cumulative sum over the rings. Several value
+        grids can be integrated at once by stacking them along a first axis.
 
         Arguments:
-        value -- the value being integrated
+        value -- the value being integrated, a grid or a stack of K grids
 
         Returns:
-        value_encl -- the result of iint_0^x(value * dA) where x is the index
+        value_encl -- the result of iint_0^x(value * dA) where x is the index,
+                      or a (K, x) array for a stack of grids
         """
-        (__, __), ((dvalue_1, dsurface_1),
-                   (dvalue_2, dsurface_2)) = self.surface_integral(value)
-        dvalue_encl_ring = np.sum(dvalue_1 * dsurface_1 +
-                                  dvalue_2 * dsurface_2, axis=0)
-        value_encl = np.empty_like(dvalue_encl_ring)
-        for i in range(1, len(dvalue_encl_ring) + 1):
-            value_encl[i - 1] = sum(dvalue_encl_ring[0:i])
-        return value_encl
+        W_inner, W_outer = self.ring_weights()
+        value = np.asarray(value)
+        dvalue_encl_ring = (np.einsum('...ik,ik->...k', value[..., :-1],
+                                      W_inner) +
+                            np.einsum('...ik,ik->...k', value[..., 1:],
+                                      W_outer))
+        return np.cumsum(dvalue_encl_ring, axis=-1)
+
+    def ring_weights(self):
+        """ Calculate the weights of the grid points in ring_integral
+        The integral over ring k, between radial index k and k + 1, is linear
+        in the value on the grid points:
+        sum(W_inner[:, k] * value[:, k] + W_outer[:, k] * value[:, k + 1])
+        The weights only depend on the map, so they are calculated once.
+
+        Returns:
+        (W_inner, W_outer) -- the weights, with one radial point less than
+                              the grid
+        """
+        if self.W_inner is None or self.W_outer is None:
+            self.calculate_surfaces()
+            shape = (self.SABD.shape[0] + 1, self.SABD.shape[1])
+            # Triangle ABD has A and B on the inner and D on the outer
+            # surface, triangle BCD has B on the inner and C and D on the
+            # outer surface. A, B, C and D are (i, k), (i + 1, k),
+            # (i + 1, k + 1) and (i, k + 1)
+            self.W_inner = np.zeros(shape)
+            self.W_inner[:-1] += self.SABD / 3
+            self.W_inner[1:] += (self.SABD + self.SBCD) / 3
+            self.W_outer = np.zeros(shape)
+            self.W_outer[:-1] += (self.SABD + self.SBCD) / 3
+            self.W_outer[1:] += self.SBCD / 3
+        return self.W_inner, self.W_outer
 
     def surface_integral(self, value):
         """ Calculate the surface intergral on a triangular map
@@ -199,6 +256,14 @@ class TriangularMap(QuadrilateralMap):
             self.G = (self.A + self.B + self.D)/3
             self.H = (self.C + self.B + self.D)/3
 
+    def calculate_surfaces(self):
+        """
+        Calculate the surface of triangle ABD and triangle BCD
+        """
+        if self.SABD is None or self.SBCD is None:
+            self.SABD = surfaceTriangle(self.A, self.B, self.D)
+            self.SBCD = surfaceTriangle(self.B, self.C, self.D)
+
     def centroid_interpolation(self, value_grid):
         Av, Bv, Cv, Dv = self.abcdize(np.tile(np.atleast_3d(value_grid),
                                               (1, 1, 2)))
@@ -207,9 +272,7 @@ class TriangularMap(QuadrilateralMap):
             # centroid of triangle_2
             self.calculate_centroid()
 
-        if self.SABD is None or self.SBCD is None:
-            self.SABD = surfaceTriangle(self.A, self.B, self.D)
-            self.SBCD = surfaceTriangle(self.B, self.C, self.D)
+        self.calculate_surfaces()
 
         # The value at G and H is also just the geometric average
         value_triangle_1 = (Dv[:, :, 0] + Bv[:, :, 0] + Av[:, :, 0])/3
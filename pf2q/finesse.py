@@ -7,12 +7,22 @@ as well as functions to estimate q-profiles.
 @licence: GPLv3
 """
 
+import asyncio
 import collections
-import re
+import copy
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import signal
 import subprocess
 import posixpath
-from itertools import chain
+import tarfile
+import threading
+import time
+import types
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 try:
     # for Python2
     import Tkinter as tk   ## notice capitalized T in Tkinter
@@ -27,6 +37,7 @@ import numpy as np
 
 import pf2q.tools as tools
 import pf2q.fem as fem
+import pf2q.runs as runs
 
 
 
@@ -34,6 +45,9 @@ np.seterr(all="ignore")
 
 mu0 = 4 * np.pi * 10 ** -7
 
+# Number of columns in a FINESSE .dat file, see /main/misc/mfinesse2file.f90
+N_OUTPUT_COLUMNS = 40
+
 
 def calculate_beta(triangular_map, p, B_phi, R0):
     """ Calculate beta using FEM triangles
@@ -126,21 +140,33 @@ class FinesseDataSet():
             "q_finesse": 39}
     data = collections.OrderedDict(sorted(data.items(),
                                            key=lambda t: t[1]))
-    def __init__(self, dict, a_0, B_phi0):
+    def __init__(self, dict, a_0, B_phi0, dtype=None):
         """
         Initialize with a dict containing the constants and 2d data sets. Also
-        supply the tokamak constants a == a_0 and B_phi0.
+        supply the tokamak constants a == a_0 and B_phi0. The 2d data sets
+        are stored as C-contiguous arrays, copying them if needed, so a data
+        set never keeps a larger parsed buffer alive.
 
         Arguments:
         dict -- dictionairy containing all constants and 2d data sets.
         a_0 -- the a_0 tokomak constant
         B_phi0 -- the B_phi0 tokomak constant
+
+        Keyword arguments:
+        dtype -- dtype to store the 2d data sets in, for example np.float32
+                 to halve the memory usage. Defaults to the supplied dtype
         """
-        for name in chain(self.constants.keys(), self.data.keys()):
+        for name in self.constants.keys():
             try:
                 setattr(self, name, dict[name])
             except KeyError:
                 raise self.FinesseInputError("Please supply " + name)
+        for name in self.data.keys():
+            try:
+                setattr(self, name, np.ascontiguousarray(dict[name],
+                                                         dtype=dtype))
+            except KeyError:
+                raise self.FinesseInputError("Please supply " + name)
         self.a_0 = a_0
         self.B_phi0 = B_phi0
         # Save some common geometric variables.
@@ -155,6 +181,14 @@ class FinesseDataSet():
         self.p = None
         self.rho = None
 
+    def memory_usage(self):
+        """ Bytes of memory kept alive by the 2d data sets
+
+        Returns:
+        nbytes -- size of all buffers owned by the 2d data sets in bytes
+        """
+        return tools.memory_usage([getattr(self, name) for name in self.data])
+
     def __str__(self):
         output_str = ""
         for constant in self.constants:
@@ -358,7 +392,7 @@ def make_run_finesse_remote(send_input_boundary, run_finesse,
             send_input_boundary(input_data)
         except subprocess.CalledProcessError:
             error_msg = "Could not copy local to remote"
-            FinesseSession.FinesseOutputError(error_msg)
+            raise FinesseTransportError(error_msg)
         try:
             run_finesse()
         except subprocess.CalledProcessError:
@@ -373,23 +407,78 @@ def make_run_finesse_remote(send_input_boundary, run_finesse,
             remove_remote()
         except subprocess.CalledProcessError:
             error_msg = "Could not remove remote data, log or input"
-            raise FinesseSession.FinesseOutputError(error_msg)
+            raise FinesseTransportError(error_msg)
     return run_finesse_remote
 
 
+def _run_in_process_group(run_finesse_function, input_data, result_path,
+                          sender):
+    """ Run run_finesse_function in a new process group
+    Used by FinesseSession to be able to kill a run and everything it
+    started. The result or exception is sent back over sender.
+    """
+    os.setsid()
+
+    def terminate(signum, frame):
+        # Lets run functions clean up processes in other process groups
+        raise SystemExit(1)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        sender.send(("ok", run_finesse_function(input_data, result_path)))
+    except Exception as error:
+        try:
+            sender.send(("error", error))
+        except Exception:
+            sender.send(("error",
+                         FinesseSession.FinesseOutputError(str(error))))
+
+
+def _kill_process_group(process, timeout=5):
+    """ Kill the process group led by process, see _run_in_process_group """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        process.terminate()
+    process.join(timeout)
+    if process.is_alive():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            process.terminate()
+        process.join()
+
+
+def _run_timed(timing, function, *args, **kwargs):
+    """ Call function and note in the dict timing when it started and
+    finished. Runners put timing on the future of a job as future.timing,
+    so the time waited in the queue can be told apart from the run time.
+    """
+    timing["started"] = time.time()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        timing["finished"] = time.time()
+
+
 class FinesseSession():
     """ Specifies the FINESSE case
     This class defines all the paths needed to run FINESSE and contains
     functions to run FINESSE and import its output.
     """
 
-    def __init__(self, finesse_paths, run_finesse_function, result_path):
+    def __init__(self, finesse_paths, run_finesse_function, result_path,
+                 dtype=float, sidecar=False, result_cache=None,
+                 max_backup_size=None, max_backup_age=None):
         """
         The FINESSE session needs a function that specifies how FINESSE
         should be run. This function should do at least the following things
         on the machine that runs FINESSE: save the finesse.inp in INPUT_path,
         save boundary.dat in DATA_path, run FINESSE, and copy the resulting
-        .dat file to the result_path on the machine running PF2q.
+        .dat file to the path it is given on the machine running PF2q. Every
+        run is given its own fresh directory in result_path, see
+        runs.RunStore.
+        Alternatively, the function can return the parsed output as a dict
+        like read_output_data does, then nothing is read from result_path.
         Optionally the generated .log file can be deleted too. You can use
         any of the supplied example functions in the unix/windows_function
         modules class or create your own. You can also use the
@@ -398,99 +487,498 @@ class FinesseSession():
         Arguments:
         finesse_case_path -- the path of the FINESSE case for this session
         run_finesse_function -- function used to run FINESSE
-        result_path -- path where the result of run_finesse_function is stored
+        result_path -- path where the run directories of
+                       run_finesse_function are made
+
+        Keyword arguments:
+        dtype -- dtype the 2d data sets of the output are stored in. Use
+                 np.float32 to halve the memory used by each FinesseDataSet
+        sidecar -- if true, write a binary sidecar next to backed up results,
+                   see read_output_data
+        result_cache -- a cache.ResultCache instance. If given, run_finesse
+                        returns the cached output of identical inputs
+                        instead of running FINESSE. Hits and misses are
+                        counted in cache_hits and cache_misses
+        max_backup_size -- maximum total size in bytes of the backed up runs,
+                           the oldest are removed first. None for no limit
+        max_backup_age -- maximum age in seconds of backed up runs and of
+                          runs left behind by crashes. None for no limit
         """
         self.finesse_paths = finesse_paths
         self.run_finesse_function = run_finesse_function
         self.result_path = result_path
+        self.run_store = runs.RunStore(result_path, max_size=max_backup_size,
+                                       max_age=max_backup_age)
+        self.last_run_id = None
+        self.dtype = dtype
+        self.sidecar = sidecar
+        self.result_cache = result_cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Submitted runs, see submit
+        self._executor = None
+        self._cancel_events = {}
+        self._lock = threading.Lock()
+
+    def submit(self, input_data, backup_result=False, replace=False):
+        """ Run FINESSE in the background
+        Runs are done one at a time, in order of submission. The input is
+        copied, so input_data can be changed right after submitting.
+
+        Arguments:
+        input_data -- an instance of FinesseInput, specifies the input file
+
+        Keyword Arguments:
+        backup_result -- If true, backs up the result, otherwise deletes it
+        replace -- If true, cancel all earlier submitted runs first
+
+        Returns:
+        future -- concurrent.futures.Future of the FinesseDataSet. Use cancel
+                  to cancel it, also when it is already running. The times
+                  the job was submitted, started and finished are in the
+                  dict future.timing
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            if replace:
+                for future in list(self._cancel_events):
+                    self.cancel(future)
+            cancel_event = threading.Event()
+            timing = {"submitted": time.time()}
+            future = self._executor.submit(_run_timed, timing,
+                                           self.run_finesse,
+                                           copy.deepcopy(input_data),
+                                           backup_result=backup_result,
+                                           cancel_event=cancel_event)
+            future.timing = timing
+            self._cancel_events[future] = cancel_event
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future):
+        with self._lock:
+            self._cancel_events.pop(future, None)
+
+    def cancel(self, future):
+        """ Cancel a run returned by submit
+        A waiting run is simply not started. A running run has its process
+        group killed, or the cancel method of a stateful runner called, and
+        its run directory and the output it wrote to the local OUTPUT path
+        removed; its future then raises CancelledError.
+
+        Arguments:
+        future -- a future returned by submit
+
+        Returns:
+        cancelled -- False if the run was already done
+        """
+        if future.cancel():
+            return True
+        cancel_event = self._cancel_events.get(future)
+        if cancel_event is None or future.done():
+            return False
+        cancel_event.set()
+        return True
+
+    def submit_async(self, input_data, backup_result=False, replace=False):
+        """ Run FINESSE in the background and return an asyncio future
+        Same as submit, but the result can be awaited in the running
+        asyncio event loop. Cancelling the asyncio future cancels the run.
+
+        Returns:
+        future -- asyncio.Future of the FinesseDataSet
+        """
+        future = self.submit(input_data, backup_result=backup_result,
+                             replace=replace)
+        async_future = asyncio.wrap_future(future)
+
+        def cancel_run(async_future):
+            if async_future.cancelled():
+                self.cancel(future)
+        async_future.add_done_callback(cancel_run)
+        return async_future
+
+    def _call_run_finesse_function(self, input_data, run_path, cancel_event):
+        """ Call run_finesse_function so it can be cancelled
+        A plain function, like the ones the make_* helpers of
+        unix_functions return, is run in a forked process with its own
+        process group, which is killed if cancel_event is set. A bound
+        method or other callable object keeps state between runs, so it is
+        called in this process; if its object has a cancel method, that is
+        called when cancel_event is set. Without fork (Windows), or without
+        cancel_event, the function is simply called.
+        """
+        if cancel_event is None:
+            return self.run_finesse_function(input_data, run_path)
+        if not isinstance(self.run_finesse_function, types.FunctionType):
+            return self._call_stateful(input_data, run_path, cancel_event)
+        if not hasattr(os, "fork"):
+            return self.run_finesse_function(input_data, run_path)
+
+        output_files = self._output_files()
+        context = multiprocessing.get_context("fork")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_run_in_process_group,
+                                  args=(self.run_finesse_function,
+                                        input_data, run_path, sender))
+        process.start()
+        sender.close()
+        try:
+            while not receiver.poll(0.05):
+                if cancel_event.is_set():
+                    _kill_process_group(process)
+                    self._remove_output(output_files)
+                    raise CancelledError()
+                if not process.is_alive() and not receiver.poll():
+                    error_msg = "The process running FINESSE died"
+                    raise FinesseSession.FinesseOutputError(error_msg)
+            status, result = receiver.recv()
+        finally:
+            receiver.close()
+            process.join()
+        if status == "error":
+            raise result
+        return result
+
+    def _call_stateful(self, input_data, run_path, cancel_event):
+        """ Call a stateful run_finesse_function, see
+        _call_run_finesse_function
+        Runners without a cancel method run to the end, and their result is
+        thrown away.
+        """
+        owner = getattr(self.run_finesse_function, "__self__",
+                        self.run_finesse_function)
+        cancel = getattr(owner, "cancel", None)
+        finished = threading.Event()
+
+        def watch():
+            while not finished.wait(0.05):
+                if cancel_event.is_set():
+                    if cancel is not None:
+                        cancel()
+                    return
+        watcher = threading.Thread(target=watch)
+        watcher.daemon = True
+        watcher.start()
+        try:
+            result = self.run_finesse_function(input_data, run_path)
+        except Exception:
+            if cancel_event.is_set():
+                raise CancelledError()
+            raise
+        finally:
+            finished.set()
+            watcher.join()
+        if cancel_event.is_set():
+            raise CancelledError()
+        return result
+
+    def _output_files(self):
+        """ Modification time of the FINESSE output in the local OUTPUT
+        path, by file name
+        """
+        path = getattr(self.finesse_paths, "OUTPUT_path", None)
+        if path is None or not os.path.isdir(path):
+            return {}
+        return dict((file, os.path.getmtime(os.path.join(path, file)))
+                    for file in os.listdir(path)
+                    if file.startswith("finesse") and
+                    (file.endswith(".dat") or file.endswith(".log")))
+
+    def _remove_output(self, output_files):
+        """ Remove local FINESSE output of a cancelled run
+        Only the files that are new or changed since output_files, see
+        _output_files, are removed; output of other runs is left alone. The
+        run directory itself is removed by run_finesse.
+        """
+        for file, mtime in self._output_files().items():
+            if output_files.get(file) != mtime:
+                try:
+                    os.remove(os.path.join(self.finesse_paths.OUTPUT_path,
+                                           file))
+                except OSError:
+                    pass
 
-    def run_finesse(self, input_data, backup_result=False):
+    def run_finesse(self, input_data, backup_result=False, cancel_event=None):
         """ Run finesse locally or remotely
-        This function saves the ouput to the result_path and either deletes it
-        or optionally renames it with .backup at the end.
+        Every run writes its output to its own new directory in result_path.
+        This directory is either deleted afterwards or kept as a finished run
+        in run_store, under the run id stored in last_run_id.
 
         Arguments:
         input_data -- an instance of FinesseInput, specifies the input file
 
         Keyword Arguments:
         backup_result -- If true, backs up the result, otherwise deletes it
+        cancel_event -- a threading.Event. If given, FINESSE is run in its
+                        own process group, which is killed when the event is
+                        set. Used by submit
         Returns:
         finesse_data -- instance of FinesseDataSet read from FINESSE output
         """
-        # Be sure that there are no old .dat files in result_path
-        #try:
-        for file in os.listdir(self.result_path):
-            abs_path = os.path.join(self.result_path, file)
-            if file.startswith("finesse"):
-                if file.endswith(".dat") or file.endswith(".dat.lnk"):
-                    error_msg = "Old .dat file found. Please clear result_path"
+        if self.result_cache is not None:
+            input_hash = input_data.input_hash()
+            finesse_data = self.result_cache.get(input_hash, dtype=self.dtype)
+            if finesse_data is not None:
+                self.cache_hits += 1
+                return FinesseDataSet(finesse_data, input_data.a_0,
+                                      input_data.B_phi0, dtype=self.dtype)
+            self.cache_misses += 1
+
+        run_id, run_path = self.run_store.create()
+        finished = False
+        try:
+            finesse_data = self._call_run_finesse_function(input_data,
+                                                           run_path,
+                                                           cancel_event)
+
+            # Read the output data, unless the run function parsed it
+            output_file = None
+            if finesse_data is None:
+                for file in sorted(os.listdir(run_path)):
+                    if file.startswith("finesse") and (
+                            file.endswith(".dat") or file.endswith(".dat.lnk")):
+                        output_file = file
+                        break
+                if output_file is None:
+                    error_msg = ("Could not find output file. "
+                                 "Did FINESSE converge?")
                     raise FinesseSession.FinesseOutputError(error_msg)
-        #except FinesseSession.FinesseOutputError:
-        #    finesse_data = None
-        #    print(error_msg)
-        #else:
-        self.run_finesse_function(input_data, self.result_path)
-
-        # Read and save the output data
-        worked = False
-        for file in os.listdir(self.result_path):
-           abs_path = os.path.join(self.result_path, file)
-           if file.startswith("finesse"):
-               if file.endswith(".dat") or file.endswith(".dat.lnk"):
-                   finesse_data = FinesseSession.read_output_data(abs_path)
-                   worked = True
-               if backup_result:
-                   os.rename(abs_path, abs_path + ".backup")
-               else:
-                   os.remove(abs_path)
-
-        if not worked:
-           error_msg = "Could not find output file. Did FINESSE converge?"
-           raise FinesseSession.FinesseOutputError(error_msg)
-
+                finesse_data = FinesseSession.read_output_data(
+                        os.path.join(run_path, output_file), dtype=self.dtype,
+                        sidecar=self.sidecar and backup_result)
+
+            if backup_result:
+                metadata = {"output_file": output_file,
+                            "input_hash": input_data.input_hash()}
+                self.run_store.finish(run_id, run_path, metadata)
+                self.last_run_id = run_id
+                finished = True
+        finally:
+            if not finished:
+                self.run_store.discard(run_path)
+
+        if self.result_cache is not None:
+            self.result_cache.put(input_hash, finesse_data,
+                                  FinesseDataSet.data.keys())
         finesse_data = FinesseDataSet(finesse_data, input_data.a_0,
-                                     input_data.B_phi0)
+                                     input_data.B_phi0, dtype=self.dtype)
         return finesse_data
 
     @classmethod
-    def read_output_data(self, file_path):
+    def read_output_data(self, file_path, columns=None, dtype=float,
+                         sidecar=False):
         """ Read the Finesse file and parse data
+        The two header lines are parsed by hand, the 40-column matrix is
+        parsed in one pass by NumPy. Only the requested columns are converted
+        to floats and each is stored in its own C-contiguous array.
+
+        If sidecar is true, the parsed data is saved in a binary sidecar,
+        see write_sidecar. Next reads of the same file memory-map the
+        sidecar instead of parsing the text again.
+
         Arguments:
         file_path -- path of FINESSE output file (ending in .dat or .dat.lnk)
 
+        Keyword Arguments:
+        columns -- dict-like mapping column names to column numbers. Defaults
+                   to FinesseDataSet.data, the columns FinesseDataSet needs
+        dtype -- dtype of the returned 2d data sets
+        sidecar -- if true, read from and write to a binary sidecar
+
         Returns:
-        finesse_data -- instance of FinesseDataSet read from FINESSE output
+        finesse_data -- dict with the constants and the requested 2d data sets
         """
+        if columns is None:
+            columns = FinesseDataSet.data
+        column_names = list(columns.keys())
+
+        if sidecar:
+            finesse_data = self.read_sidecar(file_path, columns=columns,
+                                             dtype=dtype)
+            if finesse_data is not None:
+                return finesse_data
 
         with open(file_path, 'r') as f:
-            line = f.readline()
-            words = re.split(r'\s{1,}', line)
-            values = [float(word)for word in words[1:-1]]
+            words = f.readline().split()
+            values = [float(word) for word in words]
             finesse_data = dict(zip(FinesseDataSet.constants, values))
 
-            line = f.readline()
-            words = re.split(r'\s{1,}', line)
-            finesse_data["NR_INVERSE"] = int(words[1])
-            finesse_data["NP_INVERSE"] = int(words[2])
-            matrix = np.empty([finesse_data["NR_INVERSE"] *
-                               finesse_data["NP_INVERSE"], 40], dtype=float)
-            for i, line in enumerate(f):
-                words = re.split(r'\s{1,}', line)
-                values = [float(word)for word in words[1:-1]]
-                matrix[i] = values
-            d3_matrix = np.reshape(matrix, [finesse_data["NR_INVERSE"],
-                                            finesse_data["NP_INVERSE"], 40])
-            for column_name, column_number in FinesseDataSet.data.items():
-                finesse_data[column_name] = d3_matrix[:, :, column_number]
+            words = f.readline().split()
+            NR_INVERSE = finesse_data["NR_INVERSE"] = int(words[0])
+            NP_INVERSE = finesse_data["NP_INVERSE"] = int(words[1])
+            try:
+                matrix = np.loadtxt(f, ndmin=2,
+                                    usecols=[columns[name]
+                                             for name in column_names])
+            except ValueError as error:
+                error_msg = "Could not parse " + file_path + ": " + str(error)
+                raise FinesseSession.FinesseOutputError(error_msg)
+
+        if matrix.shape[0] != NR_INVERSE * NP_INVERSE:
+            error_msg = ("Expected " + str(NR_INVERSE * NP_INVERSE) +
+                         " rows in " + file_path + ", found " +
+                         str(matrix.shape[0]))
+            raise FinesseSession.FinesseOutputError(error_msg)
 
+        for i, column_name in enumerate(column_names):
+            finesse_data[column_name] = np.ascontiguousarray(
+                        np.reshape(matrix[:, i], [NR_INVERSE, NP_INVERSE]),
+                        dtype=dtype)
+
+        if sidecar:
+            self.write_sidecar(file_path, finesse_data, columns=columns)
         return finesse_data
 
+    @staticmethod
+    def sidecar_paths(file_path):
+        """ Paths of the binary sidecar of a FINESSE output file
+        Sidecars live in the hidden directory .sidecar next to the output
+        file. They consist of an .npy file with the 2d data sets stacked
+        and a .json file with the constants and the key of the output file.
+
+        Arguments:
+        file_path -- path of FINESSE output file
+
+        Returns:
+        (npy_path, json_path) -- paths of the two sidecar files
+        """
+        dirname, basename = os.path.split(os.path.abspath(file_path))
+        sidecar_base = os.path.join(dirname, ".sidecar", basename)
+        return sidecar_base + ".npy", sidecar_base + ".json"
+
+    @classmethod
+    def write_sidecar(self, file_path, finesse_data, columns=None):
+        """ Write the binary sidecar of a FINESSE output file
+        The sidecar is keyed by the size, mtime and SHA-1 hash of the output
+        file. The .json file is written last, so a half written sidecar is
+        never read.
+
+        Arguments:
+        file_path -- path of FINESSE output file the data was read from
+        finesse_data -- dict with the constants and 2d data sets
+
+        Keyword Arguments:
+        columns -- dict-like with the names of the 2d data sets to save.
+                   Defaults to FinesseDataSet.data
+        """
+        if columns is None:
+            columns = FinesseDataSet.data
+        column_names = list(columns.keys())
+        npy_path, json_path = self.sidecar_paths(file_path)
+        if not os.path.isdir(os.path.dirname(npy_path)):
+            os.makedirs(os.path.dirname(npy_path))
+
+        with open(npy_path + ".tmp", 'wb') as f:
+            np.save(f, np.stack([finesse_data[name] for name in column_names]))
+        os.replace(npy_path + ".tmp", npy_path)
+
+        stat = os.stat(file_path)
+        header = {"size": stat.st_size,
+                  "mtime": stat.st_mtime,
+                  "hash": tools.file_hash(file_path),
+                  "columns": column_names,
+                  "constants": dict((name, finesse_data[name].item()
+                                     if hasattr(finesse_data[name], "item")
+                                     else finesse_data[name])
+                                    for name in FinesseDataSet.constants
+                                    if name in finesse_data)}
+        with open(json_path + ".tmp", 'w') as f:
+            json.dump(header, f)
+        os.replace(json_path + ".tmp", json_path)
+
+    @classmethod
+    def read_sidecar(self, file_path, columns=None, dtype=float):
+        """ Read the binary sidecar of a FINESSE output file
+        The sidecar is used if the size of the output file matches and
+        either its mtime or its content hash matches. The 2d data sets
+        are memory-mapped if they are stored in the requested dtype.
+
+        Arguments:
+        file_path -- path of FINESSE output file
+
+        Keyword Arguments:
+        columns -- dict-like with the names of the 2d data sets to read.
+                   Defaults to FinesseDataSet.data
+        dtype -- dtype of the returned 2d data sets
+
+        Returns:
+        finesse_data -- dict with the constants and the requested 2d data
+                        sets, or None if there is no valid sidecar
+        """
+        if columns is None:
+            columns = FinesseDataSet.data
+        npy_path, json_path = self.sidecar_paths(file_path)
+        try:
+            with open(json_path, 'r') as f:
+                header = json.load(f)
+            stat = os.stat(file_path)
+        except (IOError, OSError, ValueError):
+            return None
+        if not all(name in header["columns"] for name in columns):
+            return None
+        if stat.st_size != header["size"]:
+            return None
+        if stat.st_mtime != header["mtime"]:
+            # The file might have been copied or touched, check the content
+            if tools.file_hash(file_path) != header["hash"]:
+                return None
+            header["mtime"] = stat.st_mtime
+            with open(json_path + ".tmp", 'w') as f:
+                json.dump(header, f)
+            os.replace(json_path + ".tmp", json_path)
+
+        try:
+            matrix = np.load(npy_path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        finesse_data = dict(header["constants"])
+        for name in columns:
+            finesse_data[name] = np.asarray(
+                                    matrix[header["columns"].index(name)],
+                                    dtype=dtype)
+        return finesse_data
+
+    @classmethod
+    def write_output_data(self, file_path, finesse_data):
+        """ Write a FINESSE output file
+        Inverse of read_output_data. Columns that are not in finesse_data are
+        filled with zeros. Mainly useful to generate files for benchmarks.
+
+        Arguments:
+        file_path -- path of the FINESSE output file to write
+        finesse_data -- dict with all constants and (part of) the 2d data sets
+        """
+        NR_INVERSE = int(finesse_data["NR_INVERSE"])
+        NP_INVERSE = int(finesse_data["NP_INVERSE"])
+        matrix = np.zeros([NR_INVERSE * NP_INVERSE, N_OUTPUT_COLUMNS])
+        for column_name, column_number in FinesseDataSet.data.items():
+            if column_name in finesse_data:
+                matrix[:, column_number] = np.ravel(finesse_data[column_name])
+
+        constants = [name for name in FinesseDataSet.constants
+                     if name not in ["NR_INVERSE", "NP_INVERSE"]]
+        with open(file_path, 'w') as f:
+            f.write(" " + " ".join("%.8E" % finesse_data[name]
+                                   for name in constants) + "\n")
+            f.write(" " + str(NR_INVERSE) + " " + str(NP_INVERSE) + "\n")
+            np.savetxt(f, matrix, fmt=" %.8E", delimiter="")
+
     @staticmethod
     class FinesseOutputError(Exception):
         def __init__(self, message):
             super(FinesseSession.FinesseOutputError, self).__init__(message)
 
 
+class FinesseTransportError(FinesseSession.FinesseOutputError):
+    """ A FinesseOutputError caused by the connection to the machine that
+    runs FINESSE, like a lost ssh connection or worker, not by FINESSE
+    itself. The same run can succeed on another machine.
+    """
+
+
 class FinesseInput:
     """ Specifies the FINESSE input.
     It contains the following elements:
@@ -580,111 +1068,124 @@ class FinesseInput:
         Arguments:
         save_name -- path and name to save the resulting FINESSE input file
         """
+        # Text mode, so the file gets the newlines of the platform
         with open(save_name, 'w') as output:
-            output.write(" &FINESSE_GLOBAL_PARAMETERS\n")
-            output.write("    FINESSE_INPUT_FILE_VERSION = \"1.1\"\n")
-            output.write("    ANNOTATION                 = \"ITER static\"\n")
-            output.write(" /\n")
-            output.write(" &FINESSE_IO_PARAMETERS\n")
-            output.write("    FAST_DB_FILENAME = \"X.fbdb\"\n")
-            output.write("    SLOW_DB_FILENAME = \"X.sbdb\"\n")
-            output.write("    DATA_FILE        = .TRUE.\n")
-            output.write("    DX_FILE          = .FALSE.\n")
-            output.write("    HAGIS_FILE       = .FALSE.\n")
-            output.write("    PHOENIX_FILE     = .FALSE.\n")
-            output.write("    POSTSCRIPT_FILE  = .FALSE.\n")
-            output.write("    VAC_FILE         = .FALSE.\n")
-            output.write("    VTK_FILE         = .FALSE.\n")
-            output.write(" /\n")
-            output.write(" &FINESSE_MODE_PARAMETERS\n")
-            output.write("    MODE                      = \"static\"\n")
-            output.write("    APPLICATION               = \"tokamak\"\n")
-            output.write("    BERNOULLI_SOLUTION_METHOD = \"root-finding\"\n")
-            output.write(" /\n")
-            output.write(" &FINESSE_PHYSICS_PARAMETERS\n")
-            output.write("    GAMMA = " + str(self.gamma) + "\n")
-            output.write(" /\n")
-            output.write(" &FINESSE_PROFILE_PARAMETERS\n")
-
-            output.write("    C = " + str(self.F2_tilde_poly[0]))
-            for i in range(1, 10):
-                try:
-                    output.write(", " + str(self.F2_tilde_poly[i]))
-                except IndexError:
-                    output.write(", 0.0")
-            output.write("\n")
-            output.write("        " + str(self.P_tilde_poly[0]))
-            for i in range(1, 10):
-                try:
-                    output.write(", " + str(self.P_tilde_poly[i]))
-                except IndexError:
-                    output.write(", 0.0")
-            output.write("\n")
-            output.write("        1.0, -0.7, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0\n")
-            output.write("        0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0\n")
-            output.write("        0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0\n")
-            output.write("        0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0\n")
-            output.write("    A_N = " + str(self.A_N[0]))
-            for i in range(1, 6):
-                try:
-                    output.write(", " + str(self.A_N[i]))
-                except IndexError:
-                    output.write(", 0.0")
-            output.write("\n")
-            output.write("    SIGN_CHI_PRIME = +1.\n")
-            output.write("    SIGN_OMEGA     = +1.\n")
-            if self.SIGN_I == 1:
-                output.write("    SIGN_I         = +1.\n")
-            elif self.SIGN_I == -1:
-                output.write("    SIGN_I         = -1.\n")
-            else:
-                self.FinesseInputError(" SIGN_I can only be -1 or +1, not" +
-                                       self.SIGN_I)
-            output.write(" /\n")
-            output.write(" &FINESSE_FLUX_PARAMETERS\n")
-            output.write("    ALPHA               = " + str(self.alpha) + "\n")
-            output.write("    AVERAGE_FLUXPROFILE = \"none\"\n")
-            output.write("    FLUXFUNCTION        = \"temperature\"\n")
-            output.write("    FLUXPROFILES        = \"primitive\"\n")
-            output.write(" /2.2\n")
-            output.write(" &FINESSE_DELTA_PARAMETERS\n")
-            output.write("    DELTAPROFILES      = \"polynomial\",\"polynomial\",\"polynomial\",\"polynomial\",\"polynomial\",\"polynomial\"\n")
-            output.write("     INTERPOLATION_TYPE = \"cubic\"\n")
-            output.write(" /\n")
-            output.write(" &FINESSE_GEOMETRY_PARAMETERS\n")
-            output.write("    EPSILON            = " + str(self.epsilon) + "\n")
-            output.write("    TOP_DOWN_SYMMETRIC = .FALSE.\n")
-            output.write("    RZ_NORMALIZATION   = \"tokamak\"\n")
-            output.write(" /\n")
-            output.write(" &FINESSE_SHAPE_PARAMETERS\n")
-            output.write("    CS_SHAPE = \"data\"\n")
-            output.write("    NM       = 64\n")
-            output.write("    ELLIPS   = 1.7\n")
-            output.write("    TRIANG   = 0.4\n")
-            output.write("    QUADRA   = 0.0\n")
-            output.write(" /\n")
-            output.write(" &FINESSE_BC_PARAMETERS\n")
-            output.write("    BC_TYPE = \"none\",\"essential\",\"periodic\",\"periodic\"\n")
-            output.write(" /\n")
-            output.write(" &FINESSE_GRID_PARAMETERS\n")
-            output.write("     NR                 =  " + str(self.NR) + "\n")
-            output.write("     NP                 =  " + str(self.NP) + "\n")
-            output.write("    INVERSECOORDINATES = .TRUE.\n")
-            output.write("    STRAIGHTFIELDLINES = .TRUE.\n")
-            output.write("     NR_INVERSE         =  " + str(self.NR_INVERSE) + "\n")
-            output.write("    NP_INVERSE         =  " + str(self.NP_INVERSE) + "\n")
-            output.write("    GRID_TYPE          = \"linear\",\"linear\"\n")
-            output.write(" /\n")
-            output.write(" &FINESSE_FLOW_DOMAIN_PARAMETERS\n")
-            output.write("    FLOW_DOMAIN = \"sub-slow\"\n")
-            output.write(" /\n")
-            output.write(" &FINESSE_DEBUG_PARAMETERS\n")
-            output.write("    DEBUG_MROOT               = .FALSE.\n")
-            output.write("    DEBUG_MDOMAIN             = .FALSE.\n")
-            output.write("    DEBUG_MUPDATEM2           = .FALSE.\n")
-            output.write("    DEBUG_MINVERSECOORDINATES = .FALSE.\n")
-            output.write("    DEBUG_MSTRAIGHTFIELDLINES = .FALSE.\n")
-            output.write(" /\n")
+            output.write(self.render_input().decode("ascii"))
+
+    def render_input(self):
+        """ Render the FinesseInput instance to a FINESSE input file
+        Structure derived from the FINESSE input file. The file is rendered
+        in memory, so it can be written or sent to FINESSE in one go.
+
+        Returns:
+        input_file -- the content of the FINESSE input file as bytes
+        """
+        lines = []
+        lines.append(" &FINESSE_GLOBAL_PARAMETERS\n")
+        lines.append("    FINESSE_INPUT_FILE_VERSION = \"1.1\"\n")
+        lines.append("    ANNOTATION                 = \"ITER static\"\n")
+        lines.append(" /\n")
+        lines.append(" &FINESSE_IO_PARAMETERS\n")
+        lines.append("    FAST_DB_FILENAME = \"X.fbdb\"\n")
+        lines.append("    SLOW_DB_FILENAME = \"X.sbdb\"\n")
+        lines.append("    DATA_FILE        = .TRUE.\n")
+        lines.append("    DX_FILE          = .FALSE.\n")
+        lines.append("    HAGIS_FILE       = .FALSE.\n")
+        lines.append("    PHOENIX_FILE     = .FALSE.\n")
+        lines.append("    POSTSCRIPT_FILE  = .FALSE.\n")
+        lines.append("    VAC_FILE         = .FALSE.\n")
+        lines.append("    VTK_FILE         = .FALSE.\n")
+        lines.append(" /\n")
+        lines.append(" &FINESSE_MODE_PARAMETERS\n")
+        lines.append("    MODE                      = \"static\"\n")
+        lines.append("    APPLICATION               = \"tokamak\"\n")
+        lines.append("    BERNOULLI_SOLUTION_METHOD = \"root-finding\"\n")
+        lines.append(" /\n")
+        lines.append(" &FINESSE_PHYSICS_PARAMETERS\n")
+        lines.append("    GAMMA = " + str(self.gamma) + "\n")
+        lines.append(" /\n")
+        lines.append(" &FINESSE_PROFILE_PARAMETERS\n")
+
+        lines.append("    C = " + str(self.F2_tilde_poly[0]))
+        for i in range(1, 10):
+            try:
+                lines.append(", " + str(self.F2_tilde_poly[i]))
+            except IndexError:
+                lines.append(", 0.0")
+        lines.append("\n")
+        lines.append("        " + str(self.P_tilde_poly[0]))
+        for i in range(1, 10):
+            try:
+                lines.append(", " + str(self.P_tilde_poly[i]))
+            except IndexError:
+                lines.append(", 0.0")
+        lines.append("\n")
+        lines.append("        1.0, -0.7, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0\n")
+        lines.append("        0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0\n")
+        lines.append("        0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0\n")
+        lines.append("        0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0\n")
+        lines.append("    A_N = " + str(self.A_N[0]))
+        for i in range(1, 6):
+            try:
+                lines.append(", " + str(self.A_N[i]))
+            except IndexError:
+                lines.append(", 0.0")
+        lines.append("\n")
+        lines.append("    SIGN_CHI_PRIME = +1.\n")
+        lines.append("    SIGN_OMEGA     = +1.\n")
+        if self.SIGN_I == 1:
+            lines.append("    SIGN_I         = +1.\n")
+        elif self.SIGN_I == -1:
+            lines.append("    SIGN_I         = -1.\n")
+        else:
+            raise self.FinesseInputError("SIGN_I can only be -1 or +1, not " +
+                                         str(self.SIGN_I))
+        lines.append(" /\n")
+        lines.append(" &FINESSE_FLUX_PARAMETERS\n")
+        lines.append("    ALPHA               = " + str(self.alpha) + "\n")
+        lines.append("    AVERAGE_FLUXPROFILE = \"none\"\n")
+        lines.append("    FLUXFUNCTION        = \"temperature\"\n")
+        lines.append("    FLUXPROFILES        = \"primitive\"\n")
+        lines.append(" /2.2\n")
+        lines.append(" &FINESSE_DELTA_PARAMETERS\n")
+        lines.append("    DELTAPROFILES      = \"polynomial\",\"polynomial\",\"polynomial\",\"polynomial\",\"polynomial\",\"polynomial\"\n")
+        lines.append("     INTERPOLATION_TYPE = \"cubic\"\n")
+        lines.append(" /\n")
+        lines.append(" &FINESSE_GEOMETRY_PARAMETERS\n")
+        lines.append("    EPSILON            = " + str(self.epsilon) + "\n")
+        lines.append("    TOP_DOWN_SYMMETRIC = .FALSE.\n")
+        lines.append("    RZ_NORMALIZATION   = \"tokamak\"\n")
+        lines.append(" /\n")
+        lines.append(" &FINESSE_SHAPE_PARAMETERS\n")
+        lines.append("    CS_SHAPE = \"data\"\n")
+        lines.append("    NM       = 64\n")
+        lines.append("    ELLIPS   = 1.7\n")
+        lines.append("    TRIANG   = 0.4\n")
+        lines.append("    QUADRA   = 0.0\n")
+        lines.append(" /\n")
+        lines.append(" &FINESSE_BC_PARAMETERS\n")
+        lines.append("    BC_TYPE = \"none\",\"essential\",\"periodic\",\"periodic\"\n")
+        lines.append(" /\n")
+        lines.append(" &FINESSE_GRID_PARAMETERS\n")
+        lines.append("     NR                 =  " + str(self.NR) + "\n")
+        lines.append("     NP                 =  " + str(self.NP) + "\n")
+        lines.append("    INVERSECOORDINATES = .TRUE.\n")
+        lines.append("    STRAIGHTFIELDLINES = .TRUE.\n")
+        lines.append("     NR_INVERSE         =  " + str(self.NR_INVERSE) + "\n")
+        lines.append("    NP_INVERSE         =  " + str(self.NP_INVERSE) + "\n")
+        lines.append("    GRID_TYPE          = \"linear\",\"linear\"\n")
+        lines.append(" /\n")
+        lines.append(" &FINESSE_FLOW_DOMAIN_PARAMETERS\n")
+        lines.append("    FLOW_DOMAIN = \"sub-slow\"\n")
+        lines.append(" /\n")
+        lines.append(" &FINESSE_DEBUG_PARAMETERS\n")
+        lines.append("    DEBUG_MROOT               = .FALSE.\n")
+        lines.append("    DEBUG_MDOMAIN             = .FALSE.\n")
+        lines.append("    DEBUG_MUPDATEM2           = .FALSE.\n")
+        lines.append("    DEBUG_MINVERSECOORDINATES = .FALSE.\n")
+        lines.append("    DEBUG_MSTRAIGHTFIELDLINES = .FALSE.\n")
+        lines.append(" /\n")
+        return "".join(lines).encode("ascii")
 
     def boundary_to_file(self, absolute_path):
         """ Save the FinesseInput boundary to a boundary file
@@ -694,26 +1195,94 @@ class FinesseInput:
         """
         # Save the boundary file
         with open(absolute_path, 'w') as output:
-            output.write(str(self.boundary.shape[0]) + "\n")
-            for row in self.boundary:
-                output.write(str(row[0]) + " " + str(row[1]) + "\n")
+            output.write(self.render_boundary().decode("ascii"))
+
+    def render_boundary(self):
+        """ Render the FinesseInput boundary to a boundary file
+
+        Returns:
+        boundary_file -- the content of the boundary file as bytes
+        """
+        lines = [str(self.boundary.shape[0]) + "\n"]
+        lines.extend([str(x) + " " + str(y) + "\n"
+                      for x, y in np.asarray(self.boundary).tolist()])
+        return "".join(lines).encode("ascii")
+
+    def render_tar(self, finesse_paths):
+        """ Render the input and boundary file to one tar archive
+        The archive contains INPUT/finesse.inp and DATA/boundary.dat relative
+        to the FINESSE case path, so it can be unpacked in one go with
+        tar -xf - -C finesse_case_path, for example on a remote server.
+
+        Arguments:
+        finesse_paths -- FinessePaths instance of the FINESSE case
+
+        Returns:
+        tar_file -- the tar archive as bytes
+        """
+        path_module = finesse_paths.path_module
+        files = [(path_module.join(finesse_paths.INPUT_path, "finesse.inp"),
+                  self.render_input()),
+                 (path_module.join(finesse_paths.DATA_path, "boundary.dat"),
+                  self.render_boundary())]
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for path, content in files:
+                info = tarfile.TarInfo(path_module.relpath(
+                                       path, finesse_paths.finesse_case_path))
+                info.size = len(content)
+                info.mtime = time.time()
+                tar.addfile(info, io.BytesIO(content))
+        return archive.getvalue()
+
+    def input_hash(self):
+        """ Hash of the input and boundary file as sent to FINESSE
+        Two FinesseInput instances with the same hash give the same FINESSE
+        output. The hash is the SHA-1 hex digest of the rendered files, so
+        it only changes if something FINESSE sees changes.
+
+        Returns:
+        input_hash -- SHA-1 hex digest of the input and boundary file
+        """
+        return hashlib.sha1(self.render_input() + b"\0" +
+                            self.render_boundary()).hexdigest()
 
     @classmethod
-    def read_boundary_file(self, absolute_path):
+    def read_boundary_file(self, absolute_path, cache=None):
         """ Read a boundary file to a boundary for the FinesseInput
+        The first line of the file contains the number of points, the
+        points themselves are parsed in one go and checked against it.
 
         Arguments:
         absolute_path -- path and name to load the resulting boundary file from
+
+        Keyword arguments:
+        cache -- a dict to keep parsed boundaries in. If the file was read
+                 before with the same cache and did not change since, the
+                 parsed boundary is copied from the cache instead
+
+        Returns:
+        boundary -- the boundary as (n_points, 2) array
         """
-        boundary = np.empty([0, 2])
+        if cache is not None:
+            stat = os.stat(absolute_path)
+            key = (os.path.abspath(absolute_path), stat.st_size,
+                   stat.st_mtime)
+            if key in cache:
+                return cache[key].copy()
+
         with open(absolute_path, 'r') as input:
-            for i, line in enumerate(input):
-                if i > 0:
-                    line = line.replace(",", " ")
-                    words = line.split()
-                    boundary = np.vstack((boundary,
-                                          [float(words[0]),
-                                           float(words[1])]))
+            n_points = int(input.readline().replace(",", " ").split()[0])
+            boundary = np.loadtxt(io.StringIO(input.read().replace(",", " ")),
+                                  ndmin=2)
+        if boundary.shape != (n_points, 2):
+            raise self.FinesseInputError("Expected " + str(n_points) +
+                                         " boundary points with 2 values in " +
+                                         absolute_path + ", found " +
+                                         str(boundary.shape))
+
+        if cache is not None:
+            cache[key] = boundary.copy()
         return boundary
 
     def save_input_dialog(self, initialdir=None):
@@ -739,6 +1308,18 @@ class FinesseInput:
             super(FinesseInput.FinesseInputError, self).__init__(message)
 
 
+def _powers(psi, n):
+    """ The powers psi^0 .. psi^(n - 1) and their derivatives to psi
+
+    Returns:
+    (powers, derivatives) -- arrays with in row m psi^m and m psi^(m - 1)
+    """
+    powers = psi ** np.arange(n)[:, np.newaxis]
+    derivatives = np.zeros_like(powers)
+    derivatives[1:] = np.arange(1, n)[:, np.newaxis] * powers[:-1]
+    return powers, derivatives
+
+
 class EstimationCase():
     """ Specifies an estimation case
     This is a convinience class that links together a FINESSE output file
@@ -771,63 +1352,300 @@ class EstimationCase():
         self.F_1 = F_1
         self.Psi_1 = ((self.finesse_output.a_0 ** 2 * self.finesse_output.B_phi0) /
                       (self.finesse_output.BMAoverB0 * self.finesse_output.ALPHA))
+        # Static per FINESSE run and R0, see precompute
+        self.R0 = None
+        self.psi = None
+        self.R = None
+        self.L = None
+        self.ring_weights = None
+        self.q_weights = None
+        self.beta_weights = None
+
+    def precompute(self, R0):
+        """ Calculate everything of estimate_q that does not depend on the
+        profiles
+        The geometry of the FINESSE run fixes the linear operators from
+        j_phi to I_encl and from B_phi/(R B_p) to q. As j_phi is
+        -0.5 F2'/(mu0 R) - p' R with F2' and p' constant on a flux surface,
+        the ring integral of j_phi reduces to four weights per ring: the
+        integrals of 1/R and R over the inner and outer surface of the ring.
+        In the same way the contour integral for q reduces to one weight per
+        flux surface. Only recalculated if R0 changes.
 
-    def estimate_q(self, finesse_input):
-        """ Estimate q-profile from FINESSE input file
+        Arguments:
+        R0 -- major radius in meter
+        """
+        if self.R0 == R0:
+            return
+        finesse_output = self.finesse_output
+        self.psi = finesse_output.psi_finesse[0, :]
+        self.R = R0 + finesse_output.x_map.points_x[:, :, 0]
+
+        W_inner, W_outer = finesse_output.triangular_map.ring_weights()
+        R_inner = self.R[:, :-1]
+        R_outer = self.R[:, 1:]
+        self.ring_weights = (np.sum(W_inner / R_inner, axis=0),
+                             np.sum(W_outer / R_outer, axis=0),
+                             np.sum(W_inner * R_inner, axis=0),
+                             np.sum(W_outer * R_outer, axis=0))
+
+        # B_phi/(R B_p) = SIGN_I sqrt(F2) L / (R^2 B_p_scaling mu0 I_encl)
+        dl = finesse_output.triangular_map.calculate_dl()
+        L = np.sum(dl, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            contour = np.sum(dl / (self.R[:-1, :] ** 2 *
+                                   self.B_p_scaling[:-1, :]), axis=0)
+        self.L = L
+        self.q_weights = (L * contour /
+                          (mu0 * 2 * np.pi * finesse_output.ALPHA))
+
+        # The volume integrals of p, B_phi^2 and B_p^2 in calculate_beta and
+        # calculate_betap, per unit of p, F2 and B_p_est_const^2
+        V = finesse_output.triangular_map.volume_weights(R0)
+        self.beta_weights = (np.sum(V, axis=0),
+                             np.sum(V / self.R ** 2, axis=0),
+                             np.sum(V * self.B_p_scaling ** 2, axis=0))
+        self.R0 = R0
+
+    def enclosed_current(self, F2_prime, p_prime):
+        """ Calculate the current enclosed by each flux surface
+        Integrates j_phi = -0.5 F2'/(mu0 R) - p' R with the ring weights of
+        precompute, which should be called first.
 
         Arguments:
-        finesse_input -- a FIN         = B_p_scalingESSE input file (or more precicely a
-                         FinesseInput instance)
+        F2_prime -- dF2/dPsi by flux-surface
+        p_prime -- dp/dPsi by flux-surface
+        Both can also be stacks of profiles, with the flux-surfaces along
+        the last axis.
 
         Returns:
-        abs(q_est), I_encl, (B_p_est, B_phi_est)
+        I_encl -- enclosed current in Ampere, the shape of F2_prime
+        """
+        inner_R_inv, outer_R_inv, inner_R, outer_R = self.ring_weights
+        F2_prime = -0.5 * np.asarray(F2_prime) / mu0
+        p_prime = np.asarray(p_prime)
+        I_ring = (F2_prime[..., :-1] * inner_R_inv +
+                  F2_prime[..., 1:] * outer_R_inv -
+                  p_prime[..., :-1] * inner_R - p_prime[..., 1:] * outer_R)
+        I_encl = np.zeros(F2_prime.shape)
+        np.cumsum(I_ring, axis=-1, out=I_encl[..., 1:])
+        return I_encl
+
+    def estimate_profiles(self, finesse_input):
+        """ Estimate the q-profile and its ingredients on the flux surfaces
+        Only uses vector operations on the flux surfaces, see precompute.
+
+        Arguments:
+        finesse_input -- a FinesseInput instance
+
+        Returns:
+        q_est, I_encl, F2, B_p_est_const
         q_est -- estimated q-profile
         I_encl -- enclosed current in Ampere by flux-surface
-        (B_p_est, B_phi_est) -- estimated magnetic fields
+        F2 -- physical F^2 by flux-surface
+        B_p_est_const -- B_p by flux-surface, assuming it is constant on it
         """
+        self.precompute(finesse_input.a_0 / finesse_input.epsilon)
+        psi = self.psi
 
-        # This is just to prevent typing self. everywhere
-        (finesse_output, B_p_scaling), P_0, P_1, F_0, F_1 = \
-           (self.finesse_output, self.B_p_scaling), \
-            self.P_0, self.P_1, self.F_0, self.F_1
-
-        F2_tilde = np.polyval(finesse_input.F2_tilde_poly,
-                              finesse_output.psi_finesse[0, :])
-        F2, (c_F, _) = tools.rescale(F2_tilde, F_0 ** 2, F_1 ** 2)
+        F2_tilde = np.polyval(finesse_input.F2_tilde_poly, psi)
+        F2, (c_F, _) = tools.rescale(F2_tilde, self.F_0 ** 2, self.F_1 ** 2)
 
-        P = np.polyval(finesse_input.P_tilde_poly,
-                       finesse_output.psi_finesse[0, :])
-        _, (c_p, _) = tools.rescale(P, P_0, P_1)
+        P = np.polyval(finesse_input.P_tilde_poly, psi)
+        _, (c_p, _) = tools.rescale(P, self.P_0, self.P_1)
 
         # Use dx/dPsi = dx/dx_finesse * dx_finesse/dpsi * dpsi/dPsi
         # with dx/dx_finesse = c_x and dpsi/dPsi = 1/Psi_1
-        F2_poly = finesse_input.F2_tilde_poly.deriv() * c_F/self.Psi_1
-        F2_prime = np.polyval(F2_poly, finesse_output.psi_finesse[0, :])
-        p_poly = finesse_input.P_tilde_poly.deriv() * c_p/self.Psi_1
-        p_prime = np.polyval(p_poly, finesse_output.psi_finesse[0, :])
+        F2_prime = np.polyval(np.polyder(finesse_input.F2_tilde_poly),
+                              psi) * (c_F/self.Psi_1)
+        p_prime = np.polyval(np.polyder(finesse_input.P_tilde_poly),
+                             psi) * (c_p/self.Psi_1)
 
-        R0 = finesse_input.a_0 / finesse_input.epsilon
-        R = R0 + finesse_output.x_map.points_x[:, :, 0]
+        I_encl = self.enclosed_current(F2_prime, p_prime)
 
-        j_phi = -0.5 * F2_prime / (mu0 * R) - p_prime * R
-
-        I_encl = finesse_output.triangular_map.ring_integral(j_phi)
-        I_encl = np.insert(I_encl, 0, 0)
-        dl = finesse_output.triangular_map.calculate_dl()
-        L = np.sum(dl, axis=0)
-        B_p_est_const = mu0 * I_encl / L
+        with np.errstate(divide='ignore', invalid='ignore'):
+            B_p_est_const = mu0 * I_encl / self.L
+            q_est = (finesse_input.SIGN_I * np.sqrt(F2) * self.q_weights /
+                     I_encl)
         B_p_est_const[0] = 0
-        # This assumes B_p is constant over a flux surface
-        B_p_est_const_c = np.tile(B_p_est_const, (len(B_p_est_const), 1))
-        # We know that isn't true, so let's rescale according output
-        B_p_est = B_p_scaling * B_p_est_const_c
-
-        B_phi_est = finesse_input.SIGN_I * np.tile(np.sqrt(F2),
-                                                   (len(F2), 1)) / R
-
-        q_est, _ = finesse_output.x_map.contour_integral((B_phi_est /
-                                                     (R * B_p_est))[0:-1, :])
-        q_est /= 2 * np.pi
-        q_est *= finesse_input.alpha / finesse_output.ALPHA
+        q_est *= finesse_input.alpha
+        return q_est, I_encl, F2, B_p_est_const
+
+    def estimate_q_jacobian(self, finesse_input):
+        """ Estimate the q-profile and its derivatives to the input
+        Differentiates the steps of estimate_profiles analytically, so all
+        derivatives are calculated at once, without finite differences.
+
+        Arguments:
+        finesse_input -- a FinesseInput instance
+
+        Returns:
+        q_est, I_encl, jacobian
+        q_est -- estimated q-profile
+        I_encl -- enclosed current in Ampere by flux-surface
+        jacobian -- dict with the derivatives of q_est by flux-surface:
+            'F2_tilde_poly' -- array with in row m the derivative to
+                               F2_tilde_poly[m], the coefficient of psi^m
+            'P_tilde_poly' -- the same for P_tilde_poly
+            'alpha' -- the derivative to alpha
+        """
+        self.precompute(finesse_input.a_0 / finesse_input.epsilon)
+        psi = self.psi
+
+        def basis(poly):
+            # Coefficients, lowest power first
+            coefficients = np.asarray(poly, dtype=float)[::-1]
+            return (coefficients,) + _powers(psi, len(coefficients))
+
+        def scale(values, powers, new_0, new_1):
+            # The scale of tools.rescale and its derivatives
+            scale = (new_0 - new_1) / (values[0] - values[-1])
+            return scale, -scale * (powers[:, 0] - powers[:, -1]) / \
+                (values[0] - values[-1])
+
+        F2_coefficients, F2_powers, F2_derivatives = \
+            basis(finesse_input.F2_tilde_poly)
+        F2_tilde = np.dot(F2_coefficients, F2_powers)
+        c_F, dc_F = scale(F2_tilde, F2_powers, self.F_0 ** 2, self.F_1 ** 2)
+        F2 = self.F_0 ** 2 + c_F * (F2_tilde - F2_tilde[0])
+        dF2 = (dc_F[:, np.newaxis] * (F2_tilde - F2_tilde[0]) +
+               c_F * (F2_powers - F2_powers[:, :1]))
+
+        P_coefficients, P_powers, P_derivatives = \
+            basis(finesse_input.P_tilde_poly)
+        P = np.dot(P_coefficients, P_powers)
+        c_p, dc_p = scale(P, P_powers, self.P_0, self.P_1)
+
+        # The enclosed current of every power of psi, with c_x = 1
+        I_F2_powers = self.enclosed_current(F2_derivatives / self.Psi_1,
+                                            np.zeros_like(F2_derivatives))
+        I_P_powers = self.enclosed_current(np.zeros_like(P_derivatives),
+                                           P_derivatives / self.Psi_1)
+        I_F2 = np.dot(F2_coefficients, I_F2_powers)
+        I_P = np.dot(P_coefficients, I_P_powers)
+        I_encl = c_F * I_F2 + c_p * I_P
+        dI_F2 = dc_F[:, np.newaxis] * I_F2 + c_F * I_F2_powers
+        dI_P = dc_p[:, np.newaxis] * I_P + c_p * I_P_powers
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            q_est = (finesse_input.SIGN_I * np.sqrt(F2) * self.q_weights *
+                     finesse_input.alpha / I_encl)
+            # q ~ sqrt(F2) / I_encl
+            jacobian = {"F2_tilde_poly": q_est * (0.5 * dF2 / F2 -
+                                                  dI_F2 / I_encl),
+                        "P_tilde_poly": -q_est * dI_P / I_encl,
+                        "alpha": q_est / finesse_input.alpha}
+        return q_est, I_encl, jacobian
+
+    def estimate_q_batch(self, finesse_input, F2_coefficients=None,
+                         P_coefficients=None, alphas=None):
+        """ Estimate the q-profile of many variations of finesse_input at once
+        Every row of F2_coefficients, P_coefficients and alphas is one
+        candidate. All candidates are calculated in one stacked computation.
+
+        Arguments:
+        finesse_input -- a FinesseInput instance with the other input
+
+        Keyword arguments:
+        F2_coefficients -- array with one row per candidate and in column m
+                           the coefficient of psi^m of F2_tilde_poly, like
+                           F2_tilde_poly[m]. Defaults to the one of
+                           finesse_input for every candidate
+        P_coefficients -- the same for P_tilde_poly
+        alphas -- the alpha of every candidate. Defaults to the one of
+                  finesse_input
+
+        Returns:
+        q_est, I_encl, (beta, betap)
+        q_est -- estimated q-profile, one row per candidate
+        I_encl -- enclosed current in Ampere by flux-surface, one row per
+                  candidate
+        (beta, betap) -- beta and beta poloidal of every candidate, see
+                         calculate_beta and calculate_betap
+        """
+        self.precompute(finesse_input.a_0 / finesse_input.epsilon)
+        psi = self.psi
+
+        def candidates(coefficients, poly):
+            if coefficients is None:
+                coefficients = np.asarray(poly, dtype=float)[::-1]
+            return np.atleast_2d(coefficients)
+        F2_coefficients = candidates(F2_coefficients,
+                                     finesse_input.F2_tilde_poly)
+        P_coefficients = candidates(P_coefficients,
+                                    finesse_input.P_tilde_poly)
+        n_candidates = max(len(F2_coefficients), len(P_coefficients),
+                           np.size(alphas))
+        if alphas is None:
+            alphas = finesse_input.alpha
+        alphas = np.broadcast_to(alphas, (n_candidates,))
+
+        # Rescale every row like tools.rescale
+        def rescale(coefficients, new_0, new_1):
+            powers, derivatives = _powers(psi, coefficients.shape[1])
+            values = np.dot(coefficients, powers)
+            scale = (new_0 - new_1) / (values[:, 0] - values[:, -1])
+            scaled = new_0 + scale[:, np.newaxis] * (values -
+                                                     values[:, :1])
+            prime = (np.dot(coefficients, derivatives) *
+                     (scale / self.Psi_1)[:, np.newaxis])
+            return scaled, prime
+        F2, F2_prime = rescale(F2_coefficients, self.F_0 ** 2,
+                               self.F_1 ** 2)
+        p, p_prime = rescale(P_coefficients, self.P_0, self.P_1)
+        F2, F2_prime, p, p_prime = [np.broadcast_to(x, (n_candidates,
+                                                        len(psi)))
+                                    for x in (F2, F2_prime, p, p_prime)]
+
+        I_encl = self.enclosed_current(F2_prime, p_prime)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            q_est = (finesse_input.SIGN_I * np.sqrt(F2) * self.q_weights *
+                     alphas[:, np.newaxis] / I_encl)
+            B_p_est_const = mu0 * I_encl / self.L
+        B_p_est_const[:, 0] = 0
+
+        return q_est, I_encl, self.estimate_beta(p, F2, B_p_est_const)
+
+    def estimate_beta(self, p, F2, B_p_est_const):
+        """ Estimate beta and beta poloidal
+        Same as calculate_beta and calculate_betap of the estimated fields
+        of estimate_q, but with the volume weights of precompute, which
+        should be called first.
+
+        Arguments:
+        p -- pressure in Pascal by flux-surface
+        F2 -- physical F^2 by flux-surface
+        B_p_est_const -- B_p by flux-surface, see estimate_profiles
+        All can also be stacks of profiles, with the flux-surfaces along the
+        last axis.
+
+        Returns:
+        beta, betap
+        """
+        p_weights, B_phi_weights, B_p_weights = self.beta_weights
+        p_int = np.dot(p, p_weights)
+        beta = 2 * mu0 * p_int / np.dot(F2, B_phi_weights)
+        betap = 2 * mu0 * p_int / np.dot(B_p_est_const ** 2, B_p_weights)
+        return beta, betap
+
+    def estimate_q(self, finesse_input):
+        """ Estimate q-profile from FINESSE input file
+
+        Arguments:
+        finesse_input -- a FINESSE input file (or more precicely a
+                         FinesseInput instance)
+
+        Returns:
+        abs(q_est), I_encl, (B_p_est, B_phi_est)
+        q_est -- estimated q-profile
+        I_encl -- enclosed current in Ampere by flux-surface
+        (B_p_est, B_phi_est) -- estimated magnetic fields
+        """
+        q_est, I_encl, F2, B_p_est_const = \
+            self.estimate_profiles(finesse_input)
+        # This assumes B_p is constant over a flux surface. We know that
+        # isn't true, so let's rescale according output
+        B_p_est = self.B_p_scaling * B_p_est_const
+        B_phi_est = finesse_input.SIGN_I * np.sqrt(F2) / self.R
 
         return q_est, I_encl, (B_p_est, B_phi_est)
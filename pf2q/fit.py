@@ -0,0 +1,416 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains an automatic fitter of the FINESSE input to a target
+q- and p-profile, for example the ones of an AsdexDataSet. It does what the
+user of FTool and PTool does with the sliders: it changes the coefficients
+of F2_tilde_poly and P_tilde_poly and alpha until the estimate of an
+EstimationCase matches the target. An estimate costs milliseconds and a
+FINESSE run minutes, so FINESSE only has to be run for the proposed input.
+auto_iterate alternates fitting and running FINESSE until FINESSE matches
+the target.
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import copy
+
+import numpy as np
+from scipy.interpolate import interp1d
+from scipy.optimize import minimize
+
+import pf2q.sweep as sweep
+import pf2q.tools as tools
+
+
+def default_parameters(finesse_input):
+    """ The parameters fit by default: all coefficients of F2_tilde_poly and
+    P_tilde_poly except the constant ones, which the rescale to the core and
+    edge values removes, and alpha
+    """
+    parameters = []
+    for name in ["F2_tilde_poly", "P_tilde_poly"]:
+        poly = getattr(finesse_input, name)
+        parameters.extend(name + "[" + str(i) + "]"
+                          for i in range(1, poly.order + 1))
+    parameters.append("alpha")
+    return parameters
+
+
+def estimate_p(estimation_case, P_tilde_poly):
+    """ Estimate the p-profile and its derivatives to the coefficients
+    The pressure is rescaled to the core and edge pressure of the
+    estimation case, like PTool does.
+
+    Arguments:
+    estimation_case -- an EstimationCase instance
+    P_tilde_poly -- the pressure polynomial
+
+    Returns:
+    p, dp
+    p -- pressure in Pascal by flux-surface
+    dp -- array with in row m the derivative of p to P_tilde_poly[m]
+    """
+    psi = estimation_case.finesse_output.psi_finesse[0, :]
+    coefficients = np.asarray(P_tilde_poly, dtype=float)[::-1]
+    powers = psi ** np.arange(len(coefficients))[:, np.newaxis]
+    P = np.dot(coefficients, powers)
+    p, (c_p, __) = tools.rescale(P, estimation_case.P_0, estimation_case.P_1)
+    dc_p = -c_p * (powers[:, 0] - powers[:, -1]) / (P[0] - P[-1])
+    dp = dc_p[:, np.newaxis] * (P - P[0]) + c_p * (powers - powers[:, :1])
+    return p, dp
+
+
+class Objective():
+    """ Mismatch of an estimated q- and p-profile with the target
+    The mismatch is the sum of
+    - the weighted mean square relative error of q,
+    - the square relative error of q at the points of tools.badness: rho =
+      .08, q = 1, q = 1.1 and the one-but-last point,
+    - the weighted mean square error of p, relative to the core pressure.
+    Each with its own weight. The targets are remapped to the rho of the
+    estimation case once, like tools.badness does.
+    """
+
+    def __init__(self, rho, rho_target, q_target, p_target=None,
+                 q_weight=1., badness_weight=0., p_weight=0., weights=None):
+        """
+        Arguments:
+        rho -- rho by flux-surface of the estimation case, see
+               FinesseDataSet.calculate_rho
+        rho_target -- rho of the target profiles
+        q_target -- target q-profile
+
+        Keyword arguments:
+        p_target -- target p-profile in Pascal, needed if p_weight is not 0
+        q_weight -- weight of the mean square relative error of q
+        badness_weight -- weight of the errors at the points of tools.badness
+        p_weight -- weight of the mean square error of p
+        weights -- weight of every flux-surface in the means, defaults to 1
+        """
+        self.q_target = tools.extrap1d(interp1d(rho_target,
+                                                np.abs(q_target)))(rho)
+        self.badness_indices = list(tools.badness_indices(rho,
+                                                          self.q_target))
+        if p_target is not None:
+            self.p_target = tools.extrap1d(interp1d(rho_target,
+                                                    p_target))(rho)
+            self.p_scale = np.max(np.abs(self.p_target))
+        elif p_weight != 0:
+            raise FitError("Give p_target to fit p")
+        self.q_weight = q_weight
+        self.badness_weight = badness_weight
+        self.p_weight = p_weight
+        self.weights = np.ones_like(rho) if weights is None else weights
+
+    def gradient(self, q_est, p):
+        """ The mismatch and its derivatives
+
+        Arguments:
+        q_est -- estimated q-profile
+        p -- estimated p-profile in Pascal
+
+        Returns:
+        value, (dq, dp)
+        value -- the mismatch
+        dq, dp -- the derivatives of value to q_est and p
+        """
+        # q_est is not defined on the magnetic axis
+        valid = np.isfinite(q_est)
+        weights = np.where(valid, self.weights, 0)
+        weights = weights / np.sum(weights)
+        error = np.where(valid, np.abs(q_est) / self.q_target - 1, 0)
+        derror = np.sign(q_est) / self.q_target
+
+        value = self.q_weight * np.sum(weights * error ** 2)
+        dq = 2 * self.q_weight * weights * error * derror
+        for index in self.badness_indices:
+            value += self.badness_weight * error[index] ** 2
+            dq[index] += 2 * self.badness_weight * error[index] * \
+                derror[index]
+
+        dp = np.zeros_like(p)
+        if self.p_weight != 0:
+            weights = self.weights / np.sum(self.weights)
+            error = (p - self.p_target) / self.p_scale
+            value += self.p_weight * np.sum(weights * error ** 2)
+            dp = 2 * self.p_weight * weights * error / self.p_scale
+        return value, (dq, dp)
+
+    def __call__(self, q_est, p):
+        return self.gradient(q_est, p)[0]
+
+
+class FitResult():
+    """ Result of fit
+    Attributes:
+    input -- the proposed FinesseInput
+    parameters -- dict with the fitted value of every parameter
+    value -- the mismatch of the proposed input
+    q_est, p -- the estimated q- and p-profile of the proposed input
+    success -- True if the optimizer converged
+    message -- the message of the optimizer
+    n_evaluations -- the number of estimates done
+    """
+
+    def __init__(self, input, parameters, value, q_est, p, success, message,
+                 n_evaluations):
+        self.input = input
+        self.parameters = parameters
+        self.value = value
+        self.q_est = q_est
+        self.p = p
+        self.success = success
+        self.message = message
+        self.n_evaluations = n_evaluations
+
+
+def fit(estimation_case, finesse_input, objective, parameters=None,
+        bounds=None, fixed=None, options=None):
+    """ Fit the FINESSE input to the target of objective using the estimate
+    Minimizes the objective with L-BFGS-B. If objective is an Objective,
+    the derivatives come from EstimationCase.estimate_q_jacobian, otherwise
+    they are approximated with finite differences.
+
+    Arguments:
+    estimation_case -- an EstimationCase instance, usually of the FINESSE run
+                       of finesse_input
+    finesse_input -- the FinesseInput to start from
+    objective -- an Objective, or a function objective(q_est, p) that
+                 returns the mismatch
+
+    Keyword arguments:
+    parameters -- names of the parameters to fit, like "F2_tilde_poly[2]",
+                  "P_tilde_poly[1]" or "alpha", see sweep.Parameter.
+                  Defaults to default_parameters
+    bounds -- dict with per parameter name a (low, high) tuple, low or high
+              can be None. Parameters without bounds are unbounded
+    fixed -- dict with per parameter name a value that is set on the
+             proposed input, but not fit. For example A_N[1], which the
+             estimate does not depend on
+    options -- dict with options for scipy.optimize.minimize
+
+    Returns:
+    result -- a FitResult instance
+    """
+    if parameters is None:
+        parameters = default_parameters(finesse_input)
+    bounds = [(bounds or {}).get(name, (None, None)) for name in parameters]
+    # (name, index) of every parameter, index None for alpha
+    locations = []
+    for name in parameters:
+        match = sweep.coefficient_pattern.match(name)
+        if name == "alpha":
+            locations.append((name, None))
+        elif match is not None and match.group(1) in ["F2_tilde_poly",
+                                                       "P_tilde_poly"]:
+            locations.append((match.group(1), int(match.group(2))))
+        else:
+            raise FitError("The estimate does not depend on " + name +
+                           ", give it in fixed instead")
+
+    work = sweep.apply_point(finesse_input, fixed or {})
+    start = []
+    for (name, index), (low, high) in zip(locations, bounds):
+        if name == "alpha":
+            value = work.alpha
+        else:
+            poly = getattr(work, name)
+            value = poly[index] if index <= poly.order else 0.
+        if low is not None:
+            value = max(value, low)
+        if high is not None:
+            value = min(value, high)
+        start.append(value)
+    # Also makes the polynomials long enough for all their parameters
+    work = sweep.apply_point(work, dict(zip(parameters, start)))
+
+    # The coefficients differ orders of magnitude, so the optimizer works
+    # with the parameters relative to their start value
+    scale = np.maximum(np.abs(start), 1)
+    scaled_bounds = [tuple(None if bound is None else bound / factor
+                           for bound in pair)
+                     for pair, factor in zip(bounds, scale)]
+
+    def update(x):
+        for (name, index), value in zip(locations, x * scale):
+            if name == "alpha":
+                work.alpha = value
+            else:
+                getattr(work, name)[index] = value
+
+    n_evaluations = [0]
+
+    def evaluate(x):
+        update(x)
+        n_evaluations[0] += 1
+        q_est, __, jacobian = estimation_case.estimate_q_jacobian(work)
+        p, dp = estimate_p(estimation_case, work.P_tilde_poly)
+        value, (dvalue_dq, dvalue_dp) = objective.gradient(q_est, p)
+        dq = np.where(np.isfinite(q_est), dvalue_dq, 0)
+        gradient = np.empty_like(x)
+        for i, (name, index) in enumerate(locations):
+            if name == "alpha":
+                derivative = np.dot(dq, np.nan_to_num(jacobian["alpha"]))
+            else:
+                derivative = np.dot(dq, np.nan_to_num(jacobian[name][index]))
+                if name == "P_tilde_poly":
+                    derivative += np.dot(dvalue_dp, dp[index])
+            gradient[i] = derivative
+        return value, gradient * scale
+
+    def evaluate_value(x):
+        update(x)
+        n_evaluations[0] += 1
+        q_est, __, __, __ = estimation_case.estimate_profiles(work)
+        p, __ = estimate_p(estimation_case, work.P_tilde_poly)
+        return objective(q_est, p)
+
+    has_gradient = hasattr(objective, "gradient")
+    result = minimize(evaluate if has_gradient else evaluate_value,
+                      np.asarray(start) / scale, jac=has_gradient,
+                      method="L-BFGS-B", bounds=scaled_bounds,
+                      options=options)
+
+    update(result.x)
+    proposal = copy.deepcopy(work)
+    q_est, __, __, __ = estimation_case.estimate_profiles(proposal)
+    p, __ = estimate_p(estimation_case, proposal.P_tilde_poly)
+    return FitResult(proposal,
+                     dict(zip(parameters, (result.x * scale).tolist())),
+                     objective(q_est, p), q_est, p, result.success,
+                     str(result.message), n_evaluations[0])
+
+
+def _relative_error(rho_real, real, rho_est, est):
+    """ Mean and maximum relative error of est, remapped to rho_real """
+    valid = np.isfinite(est)
+    est = np.interp(rho_real, rho_est[valid], np.abs(est[valid]))
+    error = tools.relative_error(real[1:], est[1:])
+    return float(np.nanmean(error)), float(np.nanmax(error))
+
+
+def auto_iterate(runner, finesse_input, rho_target, q_target, p_target=None,
+                 tolerance=0.05, max_runs=5, correct_bias=True,
+                 objective_kwargs=None, fit_kwargs=None, callback=None):
+    """ Fit on the estimate and rerun FINESSE until the q-profile matches
+    Does what the user of FTool and PTool does with the rerun FINESSE
+    button: FINESSE is run, the estimate is anchored on the run with
+    FinesseDataSet.assume_dp_dF_correct, the input is fit on the estimate
+    starting from the previous input, and FINESSE is run again with the
+    proposed input. This stops when the q-profile of FINESSE matches the
+    target or when max_runs runs are done.
+
+    Arguments:
+    runner -- anything with a submit(finesse_input) method that returns a
+              concurrent.futures.Future of the FinesseDataSet, like a
+              FinesseSession, a pool.FinessePool or a dispatch.Dispatcher
+    finesse_input -- the FinesseInput of the first run
+    rho_target -- rho of the target profiles
+    q_target -- target q-profile
+
+    Keyword arguments:
+    p_target -- target p-profile in Pascal, see Objective
+    tolerance -- the q-profile matches when the total badness and the
+                 badness at the points of tools.badness are all below it
+    max_runs -- maximum number of FINESSE runs
+    correct_bias -- if true, the estimate is fit to the target corrected
+                    for the error of the estimate of the last run: q is
+                    multiplied by q_est/q_finesse and p_est - p_finesse is
+                    added to p. So only the change of the estimate is used,
+                    which is more accurate than the estimate itself
+    objective_kwargs -- passed on to Objective, for example p_weight
+    fit_kwargs -- passed on to fit, for example bounds
+    callback -- function called as callback(record) after every run, with
+                record the dict added to the history, for example print
+
+    Returns:
+    finesse_input, finesse_data, history
+    finesse_input -- the input of the last successful run
+    finesse_data -- the FinesseDataSet of the last successful run, None if
+                    the first run failed
+    history -- list with a dict per run with the 'run' number, 'badness'
+               (the total badness), 'badness_points', the error of the
+               estimate of the run itself, 'anchor_error', and of the q the
+               fit before the run predicted, 'prediction_error', both as
+               (mean, max) relative error of q,
+               'fit_value', 'n_evaluations', 'converged' and 'error' if the
+               run failed
+    """
+    objective_kwargs = objective_kwargs or {}
+    fit_kwargs = fit_kwargs or {}
+    q_target = np.abs(q_target)
+    history = []
+    finesse_data = None
+    proposal = finesse_input
+    fit_result = None
+    for run in range(1, max_runs + 1):
+        record = {"run": run}
+        if fit_result is not None:
+            record["fit_value"] = fit_result.value
+            record["n_evaluations"] = fit_result.n_evaluations
+        try:
+            new_data = runner.submit(proposal).result()
+        except Exception as error:
+            record["error"] = str(error)
+            record["converged"] = False
+            history.append(record)
+            if callback is not None:
+                callback(record)
+            break
+        if fit_result is not None:
+            # The prediction is on the rho of the previous run
+            record["prediction_error"] = _relative_error(
+                new_data.calculate_rho(), np.abs(new_data.q_finesse[0, :]),
+                finesse_data.rho, prediction)
+        finesse_input, finesse_data = proposal, new_data
+
+        rho = finesse_data.calculate_rho()
+        q_finesse = np.abs(finesse_data.q_finesse[0, :])
+        total, points = tools.badness(rho_target, q_target, rho, q_finesse)
+        record["badness"] = total
+        record["badness_points"] = [badness for __, badness in points[:-1]]
+        record["converged"] = bool(
+            np.all(np.abs([total] + record["badness_points"]) < tolerance))
+
+        estimation_case = finesse_data.assume_dp_dF_correct()
+        q_est, __, __, __ = estimation_case.estimate_profiles(finesse_input)
+        record["anchor_error"] = _relative_error(rho, q_finesse, rho, q_est)
+        history.append(record)
+        if callback is not None:
+            callback(record)
+        if record["converged"] or run == max_runs:
+            break
+
+        if correct_bias:
+            # Fit the estimate to the target as much off as the estimate
+            # of this run is off from FINESSE
+            q_goal = tools.extrap1d(interp1d(rho_target, q_target))(rho)
+            ratio = np.abs(q_est) / q_finesse
+            ratio[0] = ratio[1]
+            q_goal *= ratio
+            p_goal = None
+            if p_target is not None:
+                p_goal = tools.extrap1d(interp1d(rho_target, p_target))(rho)
+                p_goal += estimate_p(estimation_case,
+                                     finesse_input.P_tilde_poly)[0] - \
+                    finesse_data.p
+            objective = Objective(rho, rho, q_goal, p_target=p_goal,
+                                  **objective_kwargs)
+        else:
+            objective = Objective(rho, rho_target, q_target,
+                                  p_target=p_target, **objective_kwargs)
+        # Warm start from the input of this run
+        fit_result = fit(estimation_case, finesse_input, objective,
+                         **fit_kwargs)
+        proposal = fit_result.input
+        # The q-profile FINESSE is expected to give for the proposal
+        prediction = np.abs(fit_result.q_est)
+        if correct_bias:
+            prediction /= ratio
+    return finesse_input, finesse_data, history
+
+
+class FitError(Exception):
+    def __init__(self, message):
+        super(FitError, self).__init__(message)
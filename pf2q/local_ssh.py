@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the ssh command that runs the remote command on the local
+machine. It accepts the ssh options PF2q uses and ignores the host, so
+remote helpers like unix_functions.MultiplexedConnection can be used and
+tested without network. Use it as:
+
+    python -m pf2q.local_ssh [options] [user@]host command ...
+
+@licence: GPLv3
+"""
+import subprocess
+import sys
+
+# ssh options that take an argument
+options_with_argument = ["-b", "-c", "-D", "-E", "-e", "-F", "-I", "-i",
+                         "-J", "-L", "-l", "-m", "-O", "-o", "-p", "-Q",
+                         "-R", "-S", "-W", "-w"]
+
+
+def main(argv):
+    """ Run the command in argv as ssh would, but locally
+
+    Arguments:
+    argv -- the ssh arguments, without the program name
+
+    Returns:
+    returncode -- exit status of the command
+    """
+    control_command = None
+    i = 0
+    while i < len(argv) and argv[i].startswith("-"):
+        if argv[i] in options_with_argument:
+            if argv[i] == "-O":
+                control_command = argv[i + 1]
+            i += 2
+        else:
+            i += 1
+    # Skip the host
+    i += 1
+    if control_command is not None:
+        # There is no control master to control
+        return 0
+    command = " ".join(argv[i:])
+    if command == "":
+        return 0
+    return subprocess.call(["/bin/sh", "-c", command])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,274 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains functions to run FINESSE while its output is parsed
+live. Divergence detectors look at every line FINESSE writes and at the
+elapsed time, and the run is killed as soon as one of them triggers. That
+way a diverging run does not occupy the machine until it gives up by
+itself.
+
+A detector is an object with the methods
+    reset() -- called at the start of every run
+    feed(line, elapsed) -- called for every output line
+    check(elapsed) -- called regularly, also when there is no output
+Both feed and check return None, or a string with the reason to abort.
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+from __future__ import print_function
+
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pf2q.finesse as finesse
+
+# Pattern of a floating point number, also in Fortran notation like 1.0D-3
+number_pattern = r"([-+]?(?:\d+\.?\d*|\.\d+)(?:[eEdD][-+]?\d+)?)"
+
+
+def _to_float(string):
+    return float(string.replace("D", "E").replace("d", "e"))
+
+
+class Detector(object):
+    """ Detector that never triggers, base class of the other detectors """
+
+    def reset(self):
+        pass
+
+    def feed(self, line, elapsed):
+        return None
+
+    def check(self, elapsed):
+        return None
+
+
+class ResidualGrowthDetector(Detector):
+    """ Triggers when the residual grows instead of converging
+    Every line matching pattern gives a residual. The detector triggers when
+    a residual is larger than growth times the smallest residual so far, or
+    when the residual grew patience times in a row.
+    """
+
+    def __init__(self, pattern=r"residu\w*\s*[=:]?\s*" + number_pattern,
+                 growth=1e3, patience=None):
+        """
+        Keyword arguments:
+        pattern -- regular expression with the residual as first group
+        growth -- maximum ratio between residual and smallest residual
+        patience -- maximum number of consecutive growing residuals, None
+                    to not check this
+        """
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+        self.growth = growth
+        self.patience = patience
+        self.reset()
+
+    def reset(self):
+        self.smallest = None
+        self.last = None
+        self.n_growing = 0
+
+    def feed(self, line, elapsed):
+        match = self.pattern.search(line)
+        if match is None:
+            return None
+        residual = abs(_to_float(match.group(1)))
+        if residual != residual:
+            return "Residual is NaN"
+        if self.last is not None and residual > self.last:
+            self.n_growing += 1
+        else:
+            self.n_growing = 0
+        self.last = residual
+        if self.smallest is None or residual < self.smallest:
+            self.smallest = residual
+        if residual > self.growth * self.smallest:
+            return ("Residual grew from %.3E to %.3E" %
+                    (self.smallest, residual))
+        if self.patience is not None and self.n_growing >= self.patience:
+            return ("Residual grew %d times in a row, to %.3E" %
+                    (self.n_growing, residual))
+        return None
+
+
+class IterationLimitDetector(Detector):
+    """ Triggers when FINESSE needs more than max_iterations iterations
+    If pattern has a group, it is read as iteration number, otherwise every
+    line matching pattern counts as one iteration.
+    """
+
+    def __init__(self, max_iterations, pattern=r"iter\w*\s*[=:]?\s*(\d+)"):
+        """
+        Arguments:
+        max_iterations -- maximum number of iterations
+
+        Keyword arguments:
+        pattern -- regular expression of an iteration line
+        """
+        self.max_iterations = max_iterations
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+        self.reset()
+
+    def reset(self):
+        self.iterations = 0
+
+    def feed(self, line, elapsed):
+        match = self.pattern.search(line)
+        if match is None:
+            return None
+        if self.pattern.groups > 0:
+            self.iterations = int(match.group(1))
+        else:
+            self.iterations += 1
+        if self.iterations > self.max_iterations:
+            return ("More than %d iterations" % self.max_iterations)
+        return None
+
+
+class WallClockDetector(Detector):
+    """ Triggers when the run takes longer than budget seconds """
+
+    def __init__(self, budget):
+        """
+        Arguments:
+        budget -- maximum wall time of a run in seconds
+        """
+        self.budget = budget
+
+    def check(self, elapsed):
+        if elapsed > self.budget:
+            return ("Wall time budget of %g s exceeded" % self.budget)
+        return None
+
+
+def kill_process_group(process, timeout=5):
+    """ Kill process and everything it started, see run_monitored """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        process.terminate()
+    deadline = time.time() + timeout
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.01)
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            process.kill()
+        process.wait()
+
+
+class Watchdog(object):
+    """ Applies detectors to a running process and kills it if one triggers
+    Lines are passed with feed, from any thread. A background thread calls
+    check of every detector each poll_interval seconds. The process should
+    lead its own process group, see run_monitored.
+    """
+
+    def __init__(self, process, detectors, poll_interval=0.1):
+        """
+        Arguments:
+        process -- the subprocess.Popen instance to watch
+        detectors -- list of detectors, see the module documentation
+
+        Keyword arguments:
+        poll_interval -- seconds between checks of the detectors
+        """
+        self.process = process
+        self.detectors = list(detectors)
+        self.poll_interval = poll_interval
+        self.reason = None
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        for detector in self.detectors:
+            detector.reset()
+        self.thread = threading.Thread(target=self._watch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _abort(self, reason):
+        # Called with lock held
+        if self.reason is None and reason is not None:
+            self.reason = reason
+            kill_process_group(self.process)
+
+    def _watch(self):
+        while not self.done.wait(self.poll_interval):
+            with self.lock:
+                if self.reason is not None:
+                    return
+                elapsed = time.time() - self.start
+                for detector in self.detectors:
+                    self._abort(detector.check(elapsed))
+
+    def feed(self, line):
+        """ Pass one output line to the detectors """
+        with self.lock:
+            if self.reason is not None:
+                return
+            elapsed = time.time() - self.start
+            for detector in self.detectors:
+                self._abort(detector.feed(line, elapsed))
+
+    def stop(self):
+        """ Stop watching and raise FinesseOutputError if a detector
+        triggered
+        """
+        self.done.set()
+        self.thread.join()
+        if self.reason is not None:
+            raise finesse.FinesseSession.FinesseOutputError(
+                "FINESSE aborted: " + self.reason)
+
+
+def run_monitored(command, detectors=(), echo=True, poll_interval=0.1,
+                  **kwargs):
+    """ Run command while its output is checked by detectors
+    The command is started in its own process group with stdout and stderr
+    combined. If a detector triggers, the whole process group is killed and
+    FinesseSession.FinesseOutputError is raised with the reason. Like
+    subprocess.check_call, subprocess.CalledProcessError is raised if the
+    command fails by itself.
+
+    Arguments:
+    command -- command to run, passed on to subprocess.Popen
+
+    Keyword arguments:
+    detectors -- list of detectors, see the module documentation
+    echo -- if true, the output is written to sys.stdout as it comes in
+    poll_interval -- seconds between checks of the detectors
+    kwargs -- passed on to subprocess.Popen, for example shell=True
+
+    Returns:
+    lines -- list of all output lines
+    """
+    if hasattr(os, "setsid"):
+        kwargs["preexec_fn"] = os.setsid
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, **kwargs)
+    watchdog = Watchdog(process, detectors, poll_interval=poll_interval)
+    output = []
+    try:
+        for line in iter(process.stdout.readline, b''):
+            line = line.decode(errors="replace")
+            output.append(line)
+            if echo:
+                sys.stdout.write(line)
+            watchdog.feed(line)
+        process.wait()
+    except BaseException:
+        # For example SystemExit on SIGTERM, do not leave FINESSE running
+        kill_process_group(process)
+        raise
+    finally:
+        watchdog.stop()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return output
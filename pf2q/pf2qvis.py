@@ -138,22 +138,14 @@ class FpTool(object):
         self.betap
 
         Needs (static per FINESSE run):
-        self.map
         self.p
-        self.R0
         self.estimation_case
         """
-        self.q_est, self.I_encl_est, (B_theta, B_phi) = \
-                                 self.estimation_case.estimate_q(self.input)
-
-        self.beta = finesse.calculate_beta(self.map,
-                                           self.p,
-                                           B_phi,
-                                           self.R0)
-        self.betap = finesse.calculate_betap(self.map,
-                                             self.p,
-                                             B_theta,
-                                             self.R0)
+        self.q_est, self.I_encl_est, F2, B_p_est_const = \
+            self.estimation_case.estimate_profiles(self.input)
+
+        self.beta, self.betap = self.estimation_case.estimate_beta(
+            self.p, F2, B_p_est_const)
 
     def _define_below_plt_2(self):
         """ Defines the beta text boxes
@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains a pool that runs several FINESSE jobs at once. FINESSE
+reads and writes fixed paths in its case directory, so every worker gets
+its own copy of the case directory.
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # for Python2
+    import Queue as queue
+except ImportError:
+    # for Python3
+    import queue
+
+import pf2q.finesse as finesse
+import pf2q.unix_functions as unix_functions
+
+
+def clone_case(finesse_case_path, clone_path):
+    """ Copy a FINESSE case without its output and logs
+
+    Arguments:
+    finesse_case_path -- path of the FINESSE case to copy
+    clone_path -- path of the copy, should not exist yet
+
+    Returns:
+    finesse_paths -- FinessePaths instance of the copy
+    """
+    shutil.copytree(finesse_case_path, clone_path,
+                    ignore=shutil.ignore_patterns("*.dat", "*.log"))
+    finesse_paths = finesse.FinessePaths(os.path.join(clone_path, ""),
+                                         path_module=os.path)
+    for path in [finesse_paths.INPUT_path, finesse_paths.DATA_path,
+                 finesse_paths.OUTPUT_path]:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    return finesse_paths
+
+
+class FinessePool():
+    """ Runs FINESSE jobs in parallel
+    Each of the n_workers workers has its own clone of the FINESSE case and
+    its own run_finesse_function, made by make_run_finesse from the
+    FinessePaths of the clone. Every job writes its result to its own run
+    directory in result_path, see runs.RunStore.
+    """
+
+    def __init__(self, finesse_case_path, result_path, n_workers=None,
+                 make_run_finesse=unix_functions.make_run_finesse_local,
+                 scratch_path=None, backup_result=False, **session_kwargs):
+        """
+        Arguments:
+        finesse_case_path -- path of the (local) FINESSE case to clone
+        result_path -- path where the run directories of jobs are made
+
+        Keyword arguments:
+        n_workers -- number of FINESSE runs at once. Defaults to the number
+                     of CPUs
+        make_run_finesse -- function that makes a run_finesse_function for
+                            the FinessePaths of a clone
+        scratch_path -- directory to create the clones in
+        backup_result -- if true, keep the run directory of every job
+        session_kwargs -- passed on to FinesseSession, e.g. dtype or
+                          max_backup_size
+        """
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        self.result_path = result_path
+        self.backup_result = backup_result
+        self.scratch_dir = tempfile.mkdtemp(prefix="pf2q_pool",
+                                            dir=scratch_path)
+        self.workers = queue.Queue()
+        for i in range(n_workers):
+            finesse_paths = clone_case(finesse_case_path,
+                                       os.path.join(self.scratch_dir,
+                                                    "case" + str(i)))
+            self.workers.put(finesse.FinesseSession(
+                finesse_paths, make_run_finesse(finesse_paths), result_path,
+                **session_kwargs))
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+
+    def _run(self, input_data):
+        session = self.workers.get()
+        try:
+            return session.run_finesse(input_data,
+                                       backup_result=self.backup_result)
+        finally:
+            self.workers.put(session)
+
+    def submit(self, input_data):
+        """ Submit a FINESSE job
+
+        Arguments:
+        input_data -- an instance of FinesseInput. It should not be changed
+                      until the job is done
+
+        Returns:
+        future -- concurrent.futures.Future of the FinesseDataSet. The times
+                  the job was submitted, started and finished are in the
+                  dict future.timing
+        """
+        timing = {"submitted": time.time()}
+        future = self.executor.submit(finesse._run_timed, timing, self._run,
+                                      input_data)
+        future.timing = timing
+        return future
+
+    def map(self, inputs):
+        """ Run FINESSE for all inputs
+
+        Arguments:
+        inputs -- iterable of FinesseInput instances
+
+        Returns:
+        results -- iterator over the FinesseDataSets, in the order of inputs.
+                   A failed job raises its FinesseOutputError when reached
+        """
+        futures = [self.submit(input_data) for input_data in inputs]
+        return (future.result() for future in futures)
+
+    def close(self):
+        """ Wait for all jobs and remove the case clones """
+        self.executor.shutdown(wait=True)
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
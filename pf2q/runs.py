@@ -0,0 +1,219 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains the store of FINESSE run directories. Every FINESSE run
+gets its own directory, so runs never see each others output and a crashed
+run can not block the next one. A run directory is created atomically under
+a temporary name and only renamed to its run id when the run finished, so
+every directory named after a run id holds a complete result.
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import errno
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import uuid
+
+# Prefix of the directories of runs that are not finished (yet)
+incomplete_prefix = ".incomplete-"
+# Name of the file with the metadata of a finished run
+metadata_file = "run.json"
+# Name of the file with the host and process id that owns an unfinished run
+owner_file = ".owner.json"
+
+
+def new_run_id():
+    """ Make a unique run id that sorts by creation time """
+    return time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+
+
+def _owner_alive(run_path):
+    """ Whether the process that created an unfinished run still runs
+
+    Returns:
+    alive -- True or False, or None if that can not be known: the owner is
+             on another host, the owner file is missing or the platform can
+             not check processes
+    """
+    try:
+        with open(os.path.join(run_path, owner_file), 'r') as f:
+            owner = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    # On Windows os.kill terminates the process instead of checking it
+    if owner.get("host") != socket.gethostname() or os.name == "nt":
+        return None
+    try:
+        os.kill(owner["pid"], 0)
+    except OSError as error:
+        return error.errno != errno.ESRCH
+    return True
+
+
+class RunStore():
+    """ Directory with one subdirectory per FINESSE run
+    Finished runs are kept in a directory named after their run id, which
+    contains the FINESSE output and a run.json file with metadata. Old runs
+    are removed by prune, based on the total size and the age of the runs.
+    """
+
+    def __init__(self, runs_path, max_size=None, max_age=None,
+                 max_incomplete_age=7 * 24 * 3600):
+        """
+        Arguments:
+        runs_path -- directory to store the runs in. Created if needed
+
+        Keyword arguments:
+        max_size -- maximum total size of the finished runs in bytes, None
+                    for no limit
+        max_age -- maximum age of the finished runs in seconds, None for no
+                   limit
+        max_incomplete_age -- maximum age in seconds of unfinished runs of
+                              which it is unknown if their process still
+                              runs, see prune. None for no limit
+        """
+        self.runs_path = runs_path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_incomplete_age = max_incomplete_age
+        if not os.path.isdir(runs_path):
+            os.makedirs(runs_path)
+
+    def create(self):
+        """ Create the directory of a new run
+
+        Returns:
+        (run_id, run_path) -- id of the run and its (temporary) directory
+        """
+        run_id = new_run_id()
+        run_path = tempfile.mkdtemp(prefix=incomplete_prefix + run_id + "-",
+                                    dir=self.runs_path)
+        with open(os.path.join(run_path, owner_file), 'w') as f:
+            json.dump({"host": socket.gethostname(), "pid": os.getpid()}, f)
+        return run_id, run_path
+
+    def finish(self, run_id, run_path, metadata=None):
+        """ Move a finished run to its final place and prune old runs
+
+        Arguments:
+        run_id -- id of the run, as returned by create
+        run_path -- directory of the run, as returned by create
+
+        Keyword arguments:
+        metadata -- JSON serializable dict stored in run.json
+
+        Returns:
+        run_path -- the final directory of the run
+        """
+        metadata = dict(metadata or {})
+        metadata["run_id"] = run_id
+        metadata["finished"] = time.time()
+        with open(os.path.join(run_path, metadata_file), 'w') as f:
+            json.dump(metadata, f)
+        try:
+            os.remove(os.path.join(run_path, owner_file))
+        except OSError:
+            pass
+        final_path = self.path(run_id)
+        os.rename(run_path, final_path)
+        self.prune(keep=run_id)
+        return final_path
+
+    def discard(self, run_path):
+        """ Remove the directory of a run """
+        shutil.rmtree(run_path, ignore_errors=True)
+
+    def path(self, run_id):
+        """ Directory of the finished run with id run_id """
+        return os.path.join(self.runs_path, run_id)
+
+    def __contains__(self, run_id):
+        return os.path.isfile(os.path.join(self.path(run_id), metadata_file))
+
+    def metadata(self, run_id):
+        """ The metadata stored in run.json of the finished run run_id """
+        with open(os.path.join(self.path(run_id), metadata_file), 'r') as f:
+            return json.load(f)
+
+    def output_file(self, run_id):
+        """ Path of the FINESSE .dat output of the finished run run_id """
+        return os.path.join(self.path(run_id),
+                            self.metadata(run_id)["output_file"])
+
+    def run_ids(self):
+        """ Ids of all finished runs, oldest first """
+        return sorted(name for name in os.listdir(self.runs_path)
+                      if not name.startswith(".") and name in self)
+
+    def _size(self, path):
+        size = 0
+        for root, __, files in os.walk(path):
+            for file in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    pass
+        return size
+
+    def prune(self, keep=None):
+        """ Remove old runs
+        Finished runs older than max_age are removed, then the oldest
+        finished runs are removed until the total size is below max_size.
+        Unfinished runs are left behind by crashed runs, but can also be
+        runs in progress of other sessions with the same runs_path. They are
+        removed when the process that created them is known to be dead and
+        they are older than max_age, or when they are older than
+        max_incomplete_age.
+
+        Keyword arguments:
+        keep -- id of a run that is never removed, like the newest run
+        """
+        now = time.time()
+        for name in os.listdir(self.runs_path):
+            if not name.startswith(incomplete_prefix):
+                continue
+            path = os.path.join(self.runs_path, name)
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+            alive = _owner_alive(path)
+            if alive is False and self.max_age is not None and \
+                    age > self.max_age:
+                self.discard(path)
+            elif alive is None and self.max_incomplete_age is not None and \
+                    age > self.max_incomplete_age:
+                self.discard(path)
+        if self.max_size is None and self.max_age is None:
+            return
+
+        runs = []
+        for run_id in self.run_ids():
+            if run_id == keep:
+                continue
+            try:
+                finished = self.metadata(run_id)["finished"]
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            runs.append((run_id, finished))
+        size = None
+        if self.max_size is not None:
+            sizes = dict((run_id, self._size(self.path(run_id)))
+                         for run_id, __ in runs)
+            size = sum(sizes.values())
+            if keep is not None and keep in self:
+                size += self._size(self.path(keep))
+        for run_id, finished in sorted(runs, key=lambda run: run[1]):
+            too_old = (self.max_age is not None and
+                       now - finished > self.max_age)
+            too_large = size is not None and size > self.max_size
+            if not too_old and not too_large:
+                break
+            self.discard(self.path(run_id))
+            if size is not None:
+                size -= sizes[run_id]
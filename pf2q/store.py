@@ -0,0 +1,301 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains an append-only store of FINESSE results. Everything
+small is kept in one SQLite file: the input hash, the input parameters,
+timing, the status of the run and the 1d profiles (rho, q, p, I_encl, ...).
+The optional 2d fields are kept as .npy files next to it. So a query like
+"q at rho=0.5 for all runs with alpha in [2, 4]" only reads a few rows of
+the SQLite file, and never the 2d fields.
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+import pf2q.finesse as finesse
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    input_hash TEXT,
+    created REAL,
+    run_time REAL,
+    status TEXT,
+    error TEXT,
+    tag TEXT);
+CREATE INDEX IF NOT EXISTS runs_input_hash ON runs (input_hash);
+CREATE TABLE IF NOT EXISTS parameters (
+    run_id INTEGER,
+    name TEXT,
+    value REAL,
+    PRIMARY KEY (run_id, name));
+CREATE INDEX IF NOT EXISTS parameters_name_value ON parameters (name, value);
+CREATE TABLE IF NOT EXISTS profiles (
+    run_id INTEGER,
+    name TEXT,
+    data BLOB,
+    PRIMARY KEY (run_id, name));
+CREATE TABLE IF NOT EXISTS fields (
+    run_id INTEGER,
+    name TEXT,
+    file TEXT,
+    PRIMARY KEY (run_id, name));
+"""
+
+
+def input_parameters(finesse_input):
+    """ The numeric parameters of a FinesseInput as flat dict
+    Polynomial coefficients are named like F2_tilde_poly[2], the coefficient
+    of psi^2, and A_N[0], see also sweep.apply_point.
+    """
+    parameters = {"a_0": finesse_input.a_0, "B_phi0": finesse_input.B_phi0}
+    for name in finesse.FinesseInput.constants:
+        value = getattr(finesse_input, name)
+        if np.ndim(value) == 0:
+            parameters[name] = float(value)
+        else:
+            for i, coefficient in enumerate(value):
+                parameters[name + "[" + str(i) + "]"] = float(coefficient)
+    for name in finesse.FinesseInput.profiles:
+        poly = getattr(finesse_input, name)
+        for i in range(poly.order + 1):
+            parameters[name + "[" + str(i) + "]"] = float(poly[i])
+    return parameters
+
+
+def derived_profiles(finesse_data, finesse_input):
+    """ The 1d profiles of a FINESSE run
+    The estimated q and I_encl assume dp and dF are correct in the output,
+    see FinesseDataSet.assume_dp_dF_correct.
+
+    Arguments:
+    finesse_data -- a FinesseDataSet
+    finesse_input -- the FinesseInput of the run
+
+    Returns:
+    profiles -- dict with the profiles rho, psi, q (from the output), p (in
+                Pa), q_est and I_encl (in A)
+    """
+    profiles = {"psi": finesse_data.psi_finesse[0, :],
+                "q": np.abs(finesse_data.q_finesse[0, :]),
+                "rho": finesse_data.calculate_rho()}
+    estimation_case = finesse_data.assume_dp_dF_correct()
+    profiles["p"] = finesse_data.p
+    q_est, I_encl, __ = estimation_case.estimate_q(finesse_input)
+    profiles["q_est"] = np.abs(q_est)
+    profiles["I_encl"] = I_encl
+    return profiles
+
+
+class ResultsStore():
+    """ Append-only store of FINESSE results, see the module documentation
+    Runs are never changed after they are added. The store can be used
+    from several threads.
+    """
+
+    def __init__(self, store_path):
+        """
+        Arguments:
+        store_path -- directory of the store. Created if needed
+        """
+        self.store_path = store_path
+        self.fields_path = os.path.join(store_path, "fields")
+        if not os.path.isdir(self.fields_path):
+            os.makedirs(self.fields_path)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(store_path, "results.sqlite"),
+            check_same_thread=False)
+        with self.lock:
+            self.connection.executescript(schema)
+
+    def add(self, finesse_input, finesse_data=None, run_time=None,
+            error=None, profiles=None, fields=False, tag=None):
+        """ Add one run to the store
+
+        Arguments:
+        finesse_input -- the FinesseInput of the run
+
+        Keyword arguments:
+        finesse_data -- the FinesseDataSet of the run, None if it failed
+        run_time -- wall time of the run in seconds
+        error -- the exception or message of a failed run
+        profiles -- dict of 1d profiles. Defaults to derived_profiles
+        fields -- if true, the 2d data sets of finesse_data are stored too
+        tag -- string to group runs by, for example the name of a sweep
+
+        Returns:
+        run_id -- id of the run in the store
+        """
+        status = "ok" if finesse_data is not None else "failed"
+        if finesse_data is not None and profiles is None:
+            profiles = derived_profiles(finesse_data, finesse_input)
+        # Write the 2d fields first, a row never points to a missing file
+        field_files = {}
+        if finesse_data is not None and fields:
+            prefix = finesse_input.input_hash() + "_" + str(time.time())
+            for name in finesse.FinesseDataSet.data:
+                file = prefix + "_" + name + ".npy"
+                np.save(os.path.join(self.fields_path, file),
+                        getattr(finesse_data, name))
+                field_files[name] = file
+
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (input_hash, created, run_time, status, "
+                "error, tag) VALUES (?, ?, ?, ?, ?, ?)",
+                (finesse_input.input_hash(), time.time(), run_time, status,
+                 None if error is None else str(error), tag))
+            run_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO parameters VALUES (?, ?, ?)",
+                [(run_id, name, value) for name, value in
+                 input_parameters(finesse_input).items()])
+            self.connection.executemany(
+                "INSERT INTO profiles VALUES (?, ?, ?)",
+                [(run_id, name, np.asarray(profile, dtype=float).tobytes())
+                 for name, profile in (profiles or {}).items()])
+            self.connection.executemany(
+                "INSERT INTO fields VALUES (?, ?, ?)",
+                [(run_id, name, file) for name, file in field_files.items()])
+        return run_id
+
+    def select(self, status="ok", tag=None, input_hash=None, **ranges):
+        """ Ids of the runs that match all conditions
+
+        Keyword arguments:
+        status -- status of the runs, None for any status
+        tag -- tag of the runs, None for any tag
+        input_hash -- input hash of the runs, None for any hash
+        ranges -- per parameter name a (low, high) tuple or a single value,
+                  for example alpha=(2, 4). Names with brackets can be
+                  given with a dict: select(**{"P_tilde_poly[1]": (-6, -4)})
+
+        Returns:
+        run_ids -- sorted list of run ids
+        """
+        query = "SELECT run_id FROM runs WHERE 1"
+        arguments = []
+        for column, value in [("status", status), ("tag", tag),
+                              ("input_hash", input_hash)]:
+            if value is not None:
+                query += " AND " + column + " = ?"
+                arguments.append(value)
+        for name, value in ranges.items():
+            if np.ndim(value) == 0:
+                value = (value, value)
+            query += (" AND run_id IN (SELECT run_id FROM parameters "
+                      "WHERE name = ? AND value BETWEEN ? AND ?)")
+            arguments.extend([name, value[0], value[1]])
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY run_id",
+                                           arguments).fetchall()
+        return [row[0] for row in rows]
+
+    def run(self, run_id):
+        """ Dict with the columns of the runs table for run_id """
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT * FROM runs WHERE run_id = ?", (run_id,))
+            row = cursor.fetchone()
+            names = [description[0] for description in cursor.description]
+        if row is None:
+            raise KeyError(run_id)
+        return dict(zip(names, row))
+
+    def parameters(self, run_id):
+        """ Dict with the input parameters of run_id """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT name, value FROM parameters WHERE run_id = ?",
+                (run_id,)).fetchall()
+        return dict(rows)
+
+    def parameter(self, name, run_ids):
+        """ Array with parameter name of every run in run_ids, NaN if a run
+        does not have it
+        """
+        values = dict(self._rows("SELECT run_id, value FROM parameters "
+                                 "WHERE name = ?", name, run_ids))
+        return np.array([values.get(run_id, np.nan) for run_id in run_ids])
+
+    def _rows(self, query, name, run_ids):
+        rows = []
+        run_ids = list(run_ids)
+        # SQLite limits the number of variables per query
+        for start in range(0, len(run_ids), 500):
+            chunk = run_ids[start:start + 500]
+            with self.lock:
+                rows.extend(self.connection.execute(
+                    query + " AND run_id IN (" +
+                    ",".join("?" * len(chunk)) + ")",
+                    [name] + chunk).fetchall())
+        return rows
+
+    def profiles(self, name, run_ids):
+        """ Profile name of every run in run_ids
+
+        Returns:
+        profiles -- list of 1d arrays, None for runs without the profile
+        """
+        data = dict(self._rows("SELECT run_id, data FROM profiles "
+                               "WHERE name = ?", name, run_ids))
+        return [np.frombuffer(data[run_id]) if run_id in data else None
+                for run_id in run_ids]
+
+    def profile(self, run_id, name):
+        """ Profile name of run_id as 1d array """
+        profile = self.profiles(name, [run_id])[0]
+        if profile is None:
+            raise KeyError((run_id, name))
+        return profile
+
+    def value_at(self, name, x_name, x, run_ids):
+        """ Profile name interpolated at x of profile x_name
+        For example value_at("q", "rho", 0.5, store.select(alpha=(2, 4)))
+        gives q at rho=0.5 for all runs with alpha in [2, 4].
+
+        Returns:
+        values -- array with the value for every run in run_ids, NaN if a
+                  run does not have the profiles or they have no finite
+                  points
+        """
+        values = np.full(len(run_ids), np.nan)
+        for i, (y, x_profile) in enumerate(zip(
+                self.profiles(name, run_ids),
+                self.profiles(x_name, run_ids))):
+            if y is None or x_profile is None:
+                continue
+            valid = np.isfinite(y) & np.isfinite(x_profile)
+            if not np.any(valid):
+                continue
+            order = np.argsort(x_profile[valid])
+            values[i] = np.interp(x, x_profile[valid][order],
+                                  y[valid][order], left=np.nan,
+                                  right=np.nan)
+        return values
+
+    def field(self, run_id, name):
+        """ 2d field name of run_id, memory-mapped from its .npy file """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT file FROM fields WHERE run_id = ? AND name = ?",
+                (run_id, name)).fetchone()
+        if row is None:
+            raise KeyError((run_id, name))
+        return np.load(os.path.join(self.fields_path, row[0]), mmap_mode='r')
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
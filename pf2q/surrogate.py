@@ -0,0 +1,310 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains a surrogate model of FINESSE, trained on the runs in a
+store.ResultsStore. The model is a polynomial chaos expansion: the profiles
+q, p and I_encl on a fixed rho grid are regressed on products of Legendre
+polynomials of the input parameters, up to a total degree. The normal
+equations are kept per fold, so new runs are added without refitting the
+old ones, and the k-fold cross-validation error comes almost for free. The
+parameters and profiles of every run are kept too, for the
+cross-validation and to rebuild the regression when a parameter starts to
+vary or a run falls outside the range of the earlier ones. A prediction
+costs microseconds, so it can screen many candidate inputs before anything
+is run with FINESSE.
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import itertools
+
+import numpy as np
+from numpy.polynomial import legendre
+
+import pf2q.store as store
+
+
+def _multi_indices(n_variables, degree):
+    """ All multi-indices with a total degree up to degree
+
+    Returns:
+    indices -- array with one row per multi-index and in column i the degree
+               of variable i
+    """
+    indices = []
+    for total in range(degree + 1):
+        for variables in itertools.combinations_with_replacement(
+                range(n_variables), total):
+            index = np.zeros(n_variables, dtype=int)
+            for variable in variables:
+                index[variable] += 1
+            indices.append(index)
+    return np.array(indices).reshape(-1, n_variables)
+
+
+class Surrogate():
+    """ Polynomial chaos surrogate of FINESSE trained on a ResultsStore
+    Call update to train on the runs that were added to the store since the
+    last update. The inputs are the parameters of store.input_parameters
+    that vary between the runs, unless given. The surrogate is trained once
+    at least one of them varies.
+    """
+    profiles = ["q", "p", "I_encl"]
+
+    def __init__(self, results_store, parameters=None, degree=2, ridge=1e-8,
+                 n_rho=65, n_folds=5, tag=None):
+        """
+        Arguments:
+        results_store -- the store.ResultsStore to train on
+
+        Keyword arguments:
+        parameters -- names of the input parameters, like "alpha" or
+                      "F2_tilde_poly[2]". Defaults to all parameters that
+                      vary between the runs trained on
+        degree -- maximum total degree of the polynomials
+        ridge -- regularization of the regression, relative to the mean
+                 diagonal of the normal equations
+        n_rho -- number of points of the rho grid the profiles are on
+        n_folds -- number of folds of the cross-validation
+        tag -- only train on the runs with this tag, None for all runs
+        """
+        self.results_store = results_store
+        self.given_parameters = None if parameters is None else \
+            list(parameters)
+        self.degree = degree
+        self.ridge = ridge
+        self.rho = np.linspace(0, 1, n_rho)
+        self.n_folds = n_folds
+        self.tag = tag
+        self.last_run_id = 0
+        # The parameters and profiles of every run
+        self.points = []
+        self.outputs = []
+        # Set once a parameter varies, and again when the parameters that
+        # vary or their range change
+        self.parameters = None
+        self.low = None
+        self.high = None
+        self.indices = None
+        # Normal equations per fold and the features of every run for the
+        # cross-validation
+        self.gram = None
+        self.moments = None
+        self.features = []
+        self.coefficients = None
+
+    def __len__(self):
+        return len(self.outputs)
+
+    def _resample(self, rho, profile):
+        """ profile on the rho grid, None if it has less than two finite
+        points
+        """
+        if rho is None or profile is None:
+            return None
+        valid = np.isfinite(rho) & np.isfinite(profile)
+        if np.sum(valid) < 2:
+            return None
+        order = np.argsort(rho[valid])
+        return np.interp(self.rho, rho[valid][order], profile[valid][order])
+
+    def _load(self, run_ids):
+        """ The input parameters and the profiles on the rho grid
+        Runs that miss a profile, or have less than two finite points in
+        one, can not be used and are left out.
+
+        Returns:
+        names, inputs, outputs -- the names of the parameters, and per run
+                                  that can be used a row of parameters and
+                                  a row of the profiles after each other
+        """
+        rhos = self.results_store.profiles("rho", run_ids)
+        profiles = [self.results_store.profiles(name, run_ids)
+                    for name in self.profiles]
+        used = []
+        outputs = []
+        for i, run_id in enumerate(run_ids):
+            resampled = [self._resample(rhos[i], name_profiles[i])
+                         for name_profiles in profiles]
+            if any(profile is None for profile in resampled):
+                continue
+            used.append(run_id)
+            outputs.append(np.concatenate(resampled))
+        if len(used) == 0:
+            return [], np.empty((0, 0)), []
+        names = self.given_parameters
+        if names is None:
+            names = sorted(self.results_store.parameters(used[0]))
+        inputs = np.column_stack([self.results_store.parameter(name, used)
+                                  for name in names])
+        return names, np.nan_to_num(inputs), outputs
+
+    def _features(self, inputs):
+        """ Legendre polynomials of the inputs scaled to [-1, 1] """
+        scaled = 2 * (inputs - self.low) / (self.high - self.low) - 1
+        features = np.ones((len(inputs), len(self.indices)))
+        for variable in range(inputs.shape[1]):
+            values = legendre.legvander(scaled[:, variable], self.degree)
+            features *= values[:, self.indices[:, variable]]
+        return features
+
+    def _inputs(self, points, names):
+        """ The matrix of the values of names in points """
+        return np.array([[point.get(name, 0.) for name in names]
+                         for point in points]).reshape(-1, len(names))
+
+    def update(self):
+        """ Train on the runs added to the store since the last update
+        The regression is rebuilt from all runs when the parameters that
+        vary or their range change.
+
+        Returns:
+        n_new -- the number of new runs that could be used
+        """
+        run_ids = [run_id for run_id in
+                   self.results_store.select(status="ok", tag=self.tag)
+                   if run_id > self.last_run_id]
+        if len(run_ids) == 0:
+            return 0
+        names, inputs, outputs = self._load(run_ids)
+        # Only skip the runs once they are loaded, so an error while loading
+        # does not lose them
+        self.last_run_id = max(run_ids)
+        if len(outputs) == 0:
+            return 0
+        self.points.extend(dict(zip(names, row)) for row in inputs)
+        self.outputs.extend(outputs)
+
+        names = self.given_parameters
+        if names is None:
+            names = sorted(set().union(*self.points))
+        inputs = self._inputs(self.points, names)
+        low = np.min(inputs, axis=0)
+        high = np.max(inputs, axis=0)
+        varies = high > low
+        if not np.any(varies):
+            return len(outputs)
+        if self.given_parameters is None:
+            names = [name for name, keep in zip(names, varies) if keep]
+            low, high = low[varies], high[varies]
+        else:
+            # A parameter that does not vary yet gets a unit range
+            high = np.where(varies, high, low + 1)
+        if names != self.parameters or np.any(low < self.low) or \
+                np.any(high > self.high):
+            self.parameters = names
+            self.low, self.high = low, high
+            self.indices = _multi_indices(len(names), self.degree)
+            n_features = len(self.indices)
+            self.gram = np.zeros((self.n_folds, n_features, n_features))
+            self.moments = np.zeros((self.n_folds, n_features,
+                                     len(self.outputs[0])))
+            self.features = []
+
+        start = len(self.features)
+        features = self._features(self._inputs(self.points[start:], names))
+        for feature, output in zip(features, self.outputs[start:]):
+            fold = len(self.features) % self.n_folds
+            self.gram[fold] += np.outer(feature, feature)
+            self.moments[fold] += np.outer(feature, output)
+            self.features.append(feature)
+        self.coefficients = self._solve(np.sum(self.gram, axis=0),
+                                        np.sum(self.moments, axis=0))
+        return len(outputs)
+
+    def _solve(self, gram, moments):
+        regularization = self.ridge * np.trace(gram) / len(gram)
+        return np.linalg.solve(gram + regularization * np.eye(len(gram)),
+                               moments)
+
+    def _check_trained(self):
+        if self.coefficients is None:
+            raise SurrogateError("Train the surrogate with update first, "
+                                 "on runs in which a parameter varies")
+
+    def predict(self, inputs):
+        """ Predict the profiles for a matrix of inputs
+
+        Arguments:
+        inputs -- array with one row per candidate and one column per name
+                  in self.parameters
+
+        Returns:
+        profiles -- dict with per name in Surrogate.profiles an array with
+                    one row per candidate, on the rho grid self.rho
+        """
+        self._check_trained()
+        outputs = np.dot(self._features(np.atleast_2d(inputs)),
+                         self.coefficients)
+        n_rho = len(self.rho)
+        return dict((name, outputs[:, i * n_rho:(i + 1) * n_rho])
+                    for i, name in enumerate(self.profiles))
+
+    def inputs(self, finesse_input):
+        """ The row of inputs of predict for finesse_input """
+        self._check_trained()
+        parameters = store.input_parameters(finesse_input)
+        return np.array([parameters.get(name, 0.)
+                         for name in self.parameters])
+
+    def estimate_profiles(self, finesse_input):
+        """ Predict q, p and I_encl on self.rho for finesse_input
+
+        Returns:
+        profiles -- dict with per name in Surrogate.profiles a profile
+        """
+        return dict((name, profile[0]) for name, profile in
+                    self.predict(self.inputs(finesse_input)).items())
+
+    def estimate_q(self, finesse_input):
+        """ Predict the q-profile, like EstimationCase.estimate_q
+        The profiles are on the rho grid self.rho. The surrogate does not
+        model the 2d fields, so these are None.
+
+        Returns:
+        q_est, I_encl, (None, None)
+        """
+        profiles = self.estimate_profiles(finesse_input)
+        return profiles["q"], profiles["I_encl"], (None, None)
+
+    def cross_validate(self):
+        """ k-fold cross-validation error of the surrogate
+        Every fold is predicted by the surrogate trained on the other folds.
+
+        Returns:
+        errors -- dict with per name in Surrogate.profiles a dict with the
+                  'rms' error relative to the rms of the profiles and the
+                  'max' absolute error relative to the largest value of the
+                  profile, over all runs
+        """
+        self._check_trained()
+        if len(self) < 2 * self.n_folds:
+            raise SurrogateError("Too few runs for " + str(self.n_folds) +
+                                 "-fold cross-validation")
+        features = np.array(self.features)
+        outputs = np.array(self.outputs)
+        folds = np.arange(len(features)) % self.n_folds
+        predictions = np.empty_like(outputs)
+        gram = np.sum(self.gram, axis=0)
+        moments = np.sum(self.moments, axis=0)
+        for fold in range(self.n_folds):
+            coefficients = self._solve(gram - self.gram[fold],
+                                       moments - self.moments[fold])
+            predictions[folds == fold] = np.dot(features[folds == fold],
+                                                coefficients)
+        errors = {}
+        n_rho = len(self.rho)
+        for i, name in enumerate(self.profiles):
+            columns = slice(i * n_rho, (i + 1) * n_rho)
+            error = predictions[:, columns] - outputs[:, columns]
+            scale = np.max(np.abs(outputs[:, columns]), axis=1)
+            errors[name] = {
+                "rms": float(np.sqrt(np.mean(error ** 2) /
+                                     np.mean(outputs[:, columns] ** 2))),
+                "max": float(np.max(np.abs(error) / scale[:, np.newaxis]))}
+        return errors
+
+
+class SurrogateError(Exception):
+    def __init__(self, message):
+        super(SurrogateError, self).__init__(message)
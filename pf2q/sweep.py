@@ -0,0 +1,404 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains a sweep engine that runs FINESSE for many variations
+of one FinesseInput. The sweep is described by the parameters to vary and
+how to sample them. All points are spooled to disk before anything is run,
+and every result is committed to disk as soon as it is done, so a sweep
+that is interrupted can be resumed without redoing finished points.
+
+Spool directory layout:
+    spec.json -- the parameters, the sampling and the seed
+    base_input.pkl -- the pickled base FinesseInput
+    pending/<index>.json -- points that still have to be run
+    done/<index>.json -- finished points, with status and run time
+    results/<index>.npz -- the FINESSE output of successful points
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import copy
+import itertools
+import json
+import os
+import pickle
+import re
+import shutil
+import time
+from concurrent.futures import as_completed
+
+import numpy as np
+
+import pf2q.finesse as finesse
+
+# Parameter names that set all grid sizes of the input at once
+grid_parameter = "npoint"
+grid_constants = ["NR", "NP", "NR_INVERSE", "NP_INVERSE"]
+# Parameter names like F2_tilde_poly[2], the coefficient of psi^2
+coefficient_pattern = re.compile(r"^(\w+)\[(\d+)\]$")
+
+
+class Parameter():
+    """ A FinesseInput field or polynomial coefficient to vary
+    name is either a constant of FinesseInput, like "alpha", a polynomial
+    coefficient, like "P_tilde_poly[1]" for the coefficient of psi^1, one
+    value of a constant with more values, like "A_N[1]", or "npoint" to set
+    NR, NP, NR_INVERSE and NP_INVERSE at once.
+    """
+
+    def __init__(self, name, low=None, high=None, n=None, values=None):
+        """
+        Either give low and high, or the values to use.
+
+        Arguments:
+        name -- name of the parameter
+
+        Keyword arguments:
+        low -- lowest value
+        high -- highest value
+        n -- number of values between low and high on a grid
+        values -- list of values to use on a grid
+        """
+        if values is None and (low is None or high is None):
+            raise SweepError("Give low and high or values for " + name)
+        self.name = name
+        self.low = low
+        self.high = high
+        self.n = n
+        self.values = values
+
+    def grid(self):
+        """ The values of the parameter on a grid """
+        if self.values is not None:
+            return list(self.values)
+        if self.n is None:
+            raise SweepError("Give n or values of " + self.name +
+                             " for a grid")
+        return np.linspace(self.low, self.high, self.n).tolist()
+
+    def scale(self, unit):
+        """ Map values in [0, 1) to the range of the parameter """
+        if self.values is not None:
+            index = np.minimum((np.asarray(unit) *
+                                len(self.values)).astype(int),
+                               len(self.values) - 1)
+            return [self.values[i] for i in index]
+        return (self.low + np.asarray(unit) * (self.high - self.low)).tolist()
+
+    def to_dict(self):
+        return {"name": self.name, "low": self.low, "high": self.high,
+                "n": self.n, "values": self.values}
+
+
+def sample(parameters, sampling="grid", n_samples=None, seed=0):
+    """ Sample points from the parameters
+
+    Arguments:
+    parameters -- list of Parameter instances
+
+    Keyword arguments:
+    sampling -- "grid" for all combinations of the grid values, "random" for
+                uniform random points or "lhs" for a Latin hypercube
+    n_samples -- number of points for random and lhs sampling
+    seed -- seed of the random generator
+
+    Returns:
+    points -- list of dicts with a value per parameter name
+    """
+    names = [parameter.name for parameter in parameters]
+    if sampling == "grid":
+        return [dict(zip(names, values)) for values in
+                itertools.product(*[parameter.grid()
+                                    for parameter in parameters])]
+    if n_samples is None:
+        raise SweepError("Give n_samples for " + sampling + " sampling")
+    random = np.random.RandomState(seed)
+    if sampling == "random":
+        unit = random.uniform(size=(len(parameters), n_samples))
+    elif sampling == "lhs":
+        # One point in every one of the n_samples strata of each parameter
+        unit = np.array([(random.permutation(n_samples) +
+                          random.uniform(size=n_samples)) / n_samples
+                         for __ in parameters])
+    else:
+        raise SweepError("Unknown sampling " + sampling)
+    columns = [parameter.scale(values)
+               for parameter, values in zip(parameters, unit)]
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+def apply_point(base_input, point):
+    """ Copy base_input and set the values of point
+
+    Arguments:
+    base_input -- an instance of FinesseInput
+    point -- dict with a value per parameter name
+
+    Returns:
+    finesse_input -- the modified copy of base_input
+    """
+    finesse_input = copy.deepcopy(base_input)
+    for name, value in point.items():
+        match = coefficient_pattern.match(name)
+        if name == grid_parameter:
+            for constant in grid_constants:
+                setattr(finesse_input, constant, int(value))
+        elif match is not None and \
+                match.group(1) in finesse.FinesseInput.profiles:
+            poly = np.poly1d(getattr(finesse_input, match.group(1)))
+            poly[int(match.group(2))] = value
+            setattr(finesse_input, match.group(1), poly)
+        elif match is not None and \
+                match.group(1) in finesse.FinesseInput.constants:
+            # Constants with more values, like A_N
+            values = list(getattr(finesse_input, match.group(1)))
+            values[int(match.group(2))] = value
+            setattr(finesse_input, match.group(1), values)
+        elif name in finesse.FinesseInput.constants:
+            if name in grid_constants:
+                value = int(value)
+            setattr(finesse_input, name, value)
+        else:
+            raise SweepError("Unknown parameter " + name)
+    return finesse_input
+
+
+def run_times(future, submitted):
+    """ The wait and run time of the finished future of a runner
+
+    Arguments:
+    future -- the finished future
+    submitted -- time.time() when the job was submitted
+
+    Returns:
+    wait_time, run_time -- seconds waited for the runner and seconds run.
+                           Without future.timing, see
+                           FinesseSession.submit, the wait is 0 and the run
+                           time counts from submitted until now
+    """
+    timing = getattr(future, "timing", {})
+    started = timing.get("started", submitted)
+    finished = timing.get("finished", time.time())
+    return started - submitted, finished - started
+
+
+def write_json(path, content):
+    """ Write content as json to path, through a temporary file, so a crash
+    halfway does not leave a half written file behind
+    """
+    with open(path + ".tmp", 'w') as f:
+        json.dump(content, f)
+    os.replace(path + ".tmp", path)
+
+
+class Sweep():
+    """ A sweep spooled in a directory, see the module documentation
+    Create a new sweep with Sweep.create and open an existing one, for
+    example after a crash, with Sweep(spool_path).
+    """
+
+    def __init__(self, spool_path):
+        """
+        Arguments:
+        spool_path -- the spool directory made by Sweep.create
+        """
+        self.spool_path = spool_path
+        with open(os.path.join(spool_path, "spec.json"), 'r') as f:
+            self.spec = json.load(f)
+        with open(os.path.join(spool_path, "base_input.pkl"), 'rb') as f:
+            self.base_input = pickle.load(f)
+
+    @classmethod
+    def create(cls, spool_path, base_input, parameters, sampling="grid",
+               n_samples=None, seed=0):
+        """ Sample the points and spool them to a new spool directory
+
+        Arguments:
+        spool_path -- the spool directory, should not exist yet
+        base_input -- the FinesseInput the parameters are varied of
+        parameters -- list of Parameter instances
+
+        Keyword arguments:
+        sampling, n_samples, seed -- see sample
+
+        Returns:
+        sweep -- Sweep instance of the new spool directory
+        """
+        points = sample(parameters, sampling=sampling, n_samples=n_samples,
+                        seed=seed)
+        # Check all points before anything is written
+        for point in points:
+            apply_point(base_input, point)
+
+        # Write to a temporary directory first, so a crash during spooling
+        # does not leave a half spooled sweep behind
+        tmp_path = spool_path.rstrip(os.sep) + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        for name in ["pending", "done", "results"]:
+            os.makedirs(os.path.join(tmp_path, name))
+        with open(os.path.join(tmp_path, "base_input.pkl"), 'wb') as f:
+            pickle.dump(base_input, f)
+        for index, point in enumerate(points):
+            write_json(os.path.join(tmp_path, "pending",
+                                    str(index) + ".json"),
+                       {"index": index, "point": point})
+        write_json(os.path.join(tmp_path, "spec.json"),
+                   {"parameters": [parameter.to_dict()
+                                   for parameter in parameters],
+                    "sampling": sampling, "n_samples": n_samples,
+                    "seed": seed, "n_points": len(points)})
+        os.rename(tmp_path, spool_path)
+        return cls(spool_path)
+
+    def _indices(self, name):
+        return sorted(int(file[:-len(".json")])
+                      for file in os.listdir(os.path.join(self.spool_path,
+                                                          name))
+                      if file.endswith(".json"))
+
+    def _read(self, name, index):
+        with open(os.path.join(self.spool_path, name,
+                               str(index) + ".json"), 'r') as f:
+            return json.load(f)
+
+    def pending(self):
+        """ Indices of the points that still have to be run """
+        return self._indices("pending")
+
+    def done(self):
+        """ Indices of the finished points, successful or not """
+        return self._indices("done")
+
+    def status(self):
+        """ Dict with the number of 'pending', 'ok' and 'failed' points """
+        status = {"pending": len(self.pending()), "ok": 0, "failed": 0}
+        for index in self.done():
+            status[self._read("done", index)["status"]] += 1
+        return status
+
+    def input(self, index):
+        """ The FinesseInput of point index """
+        try:
+            point = self._read("pending", index)["point"]
+        except (IOError, OSError):
+            point = self._read("done", index)["point"]
+        return apply_point(self.base_input, point)
+
+    def commit(self, index, finesse_data=None, error=None, run_time=None,
+               wait_time=None):
+        """ Save the result of point index and mark it as done
+        The result is written before the point is moved from pending to
+        done, so a crash in between only means the point is run again.
+
+        Arguments:
+        index -- index of the point
+
+        Keyword arguments:
+        finesse_data -- FinesseDataSet of a successful point
+        error -- exception of a failed point
+        run_time -- wall time of the run in seconds
+        wait_time -- time in seconds the point waited for the runner
+        """
+        record = self._read("pending", index)
+        record["run_time"] = run_time
+        record["wait_time"] = wait_time
+        record["finished"] = time.time()
+        if finesse_data is not None:
+            arrays = dict((name, getattr(finesse_data, name))
+                          for name in (list(finesse.FinesseDataSet.constants) +
+                                       list(finesse.FinesseDataSet.data)))
+            result_path = os.path.join(self.spool_path, "results",
+                                       str(index) + ".npz")
+            with open(result_path + ".tmp", 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(result_path + ".tmp", result_path)
+            record["status"] = "ok"
+        else:
+            record["status"] = "failed"
+            record["error"] = str(error)
+        write_json(os.path.join(self.spool_path, "done",
+                                str(index) + ".json"), record)
+        os.remove(os.path.join(self.spool_path, "pending",
+                               str(index) + ".json"))
+
+    def retry_failed(self):
+        """ Move the failed points back to pending """
+        for index in self.done():
+            record = self._read("done", index)
+            if record["status"] != "failed":
+                continue
+            write_json(os.path.join(self.spool_path, "pending",
+                                    str(index) + ".json"),
+                       {"index": index, "point": record["point"]})
+            os.remove(os.path.join(self.spool_path, "done",
+                                   str(index) + ".json"))
+
+    def run(self, runner, callback=None, store=None, fields=False):
+        """ Run all pending points
+        Can be called again after an interruption, only the points that are
+        still pending are run.
+
+        Arguments:
+        runner -- anything with a submit(finesse_input) method that returns
+                  a concurrent.futures.Future of the FinesseDataSet, like a
+                  pool.FinessePool, a dispatch.Dispatcher or a
+                  FinesseSession
+
+        Keyword arguments:
+        callback -- function called as callback(index, finesse_data, error)
+                    after every committed point
+        store -- a store.ResultsStore every point is added to as well,
+                 tagged with the name of the spool directory
+        fields -- if true, the 2d fields are added to store too
+
+        Returns:
+        status -- see status
+        """
+        futures = {}
+        for index in self.pending():
+            submitted = time.time()
+            futures[runner.submit(self.input(index))] = (index, submitted)
+        for future in as_completed(futures):
+            index, submitted = futures[future]
+            wait_time, run_time = run_times(future, submitted)
+            error = None
+            try:
+                finesse_data = future.result()
+            except Exception as exception:
+                error = exception
+                finesse_data = None
+            # Add to the store first, a crash in between only means the
+            # point is run and added again
+            if store is not None:
+                store.add(self.input(index), finesse_data=finesse_data,
+                          run_time=run_time, error=error, fields=fields,
+                          tag=os.path.basename(
+                              os.path.abspath(self.spool_path)))
+            self.commit(index, finesse_data=finesse_data, error=error,
+                        run_time=run_time, wait_time=wait_time)
+            if callback is not None:
+                callback(index, finesse_data, error)
+        return self.status()
+
+    def results(self):
+        """ Iterate over the successful points
+
+        Returns:
+        results -- iterator over (point, finesse_data) with finesse_data a
+                   dict with the constants and 2d data sets
+        """
+        for index in self.done():
+            record = self._read("done", index)
+            if record["status"] != "ok":
+                continue
+            with np.load(os.path.join(self.spool_path, "results",
+                                      str(index) + ".npz")) as arrays:
+                finesse_data = dict((name, arrays[name]) for name in arrays)
+            for name in finesse.FinesseDataSet.constants:
+                finesse_data[name] = finesse_data[name].item()
+            yield record["point"], finesse_data
+
+
+class SweepError(Exception):
+    def __init__(self, message):
+        super(SweepError, self).__init__(message)
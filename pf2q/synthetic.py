@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains a stand-in for FINESSE that generates output from an
+analytic, Solov'ev-like equilibrium instead of solving the Grad-Shafranov
+equation. The flux surfaces are shifted, elongated and triangular ellipses
+with psi ~ s^2 near the axis, the field is derived from psi and the F2 and
+P profiles of the input. The output is written in the same 40-column layout
+as FINESSE, so the rest of PF2q can be run and benchmarked without FINESSE
+or network. The output is realistic in shape and magnitude, not in physics.
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+
+import os
+import time
+
+import numpy as np
+
+import pf2q.finesse as finesse
+
+
+def _normalized(values):
+    """ Scale values to a maximum absolute value of 1 """
+    scale = np.max(np.abs(values))
+    if scale == 0:
+        return values
+    return values / scale
+
+
+def synthetic_output(input_data, shift=0.1, elongation=1.7,
+                     triangularity=0.4, beta=0.02, shear=0.5):
+    """ Generate FINESSE-like output for input_data
+    The grid is NR_INVERSE x NP_INVERSE, with the poloidal angle along the
+    first axis (from 0 to 2 pi, both included) and the radial coordinate
+    along the second axis (from the magnetic axis to the boundary), as
+    FinesseDataSet expects. Lengths are normalized to a_0 and fields to
+    B_phi0, like FINESSE does.
+
+    Arguments:
+    input_data -- an instance of FinesseInput
+
+    Keyword arguments:
+    shift -- Shafranov shift of the magnetic axis
+    elongation -- elongation of the flux surfaces
+    triangularity -- triangularity of the flux surfaces
+    beta -- about twice the central normalized pressure
+    shear -- q rises from the axis to the boundary by a factor
+             (1 + shear)^2
+
+    Returns:
+    finesse_data -- dict with the constants and the 2d data sets, as
+                    FinesseSession.read_output_data returns it
+    """
+    n_chi = input_data.NR_INVERSE
+    n_s = input_data.NP_INVERSE
+    chi, s = np.meshgrid(np.linspace(0, 2 * np.pi, n_chi),
+                         np.linspace(0, 1, n_s), indexing='ij')
+    phase = chi + triangularity * s * np.sin(chi)
+    x = shift * (1 - s ** 2) + s * np.cos(phase)
+    y = elongation * s * np.sin(chi)
+    R0 = 1. / input_data.epsilon
+    R = R0 + x
+
+    # The gradient of psi(s) follows from the Jacobian of (s, chi) -> (x, y)
+    # with the factor s of the determinant divided out
+    x_s = -2 * shift * s + np.cos(phase) - \
+        triangularity * s * np.sin(phase) * np.sin(chi)
+    x_chi_over_s = -np.sin(phase) * (1 + triangularity * s * np.cos(chi))
+    y_s = elongation * np.sin(chi)
+    y_chi_over_s = elongation * np.cos(chi)
+    det_over_s = x_s * y_chi_over_s - x_chi_over_s * y_s
+    psi = (1 + shear) * s ** 2 / (1 + shear * s ** 2)
+    dpsi_ds = 2 * (1 + shear) * s / (1 + shear * s ** 2) ** 2
+    dpsi_dx = dpsi_ds * y_chi_over_s / det_over_s
+    dpsi_dy = -dpsi_ds * x_chi_over_s / det_over_s
+
+    F2_tilde = _normalized(np.polyval(input_data.F2_tilde_poly, psi))
+    F = R0 * np.sqrt(np.clip(1 + 0.1 * F2_tilde, 1e-3, None))
+    P = 0.5 * beta * _normalized(np.polyval(input_data.P_tilde_poly, psi))
+
+    B_phi = input_data.SIGN_I * F / R
+    B_R = -dpsi_dy / (input_data.alpha * R)
+    B_Z = dpsi_dx / (input_data.alpha * R)
+    B_p = np.sqrt(B_R ** 2 + B_Z ** 2)
+
+    # q = 1/(2 pi) * contour integral of B_phi / (R B_p) dl
+    # which is 0/0 on the axis, so extrapolate there
+    dl = np.hypot(np.diff(x, axis=0), np.diff(y, axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        integrand = B_phi / (R * B_p)
+        integrand = (integrand[:-1] + integrand[1:]) / 2
+        q = np.sum(integrand * dl, axis=0) / (2 * np.pi)
+    if n_s > 2:
+        q[0] = 2 * q[1] - q[2]
+    q = np.tile(q, (n_chi, 1))
+
+    # Volume averages with the area of each cell, R dA ~ R |det| ds dchi
+    dA = np.abs(s * det_over_s) * R
+    P_int = np.sum(P * dA)
+    Beta = 2 * P_int / np.sum(B_phi ** 2 * dA)
+    Betap = 2 * P_int / np.sum(B_p ** 2 * dA)
+
+    finesse_data = {"EPSILON": input_data.epsilon,
+                    "ALPHA": input_data.alpha,
+                    "GAMMA": input_data.gamma,
+                    "xMA": shift,
+                    "yMA": 0.,
+                    "rhoMAoverrho0": 1.,
+                    "BMAoverB0": abs(B_phi[0, 0]),
+                    "Beta": Beta,
+                    "Betap": Betap,
+                    "NR_INVERSE": n_chi,
+                    "NP_INVERSE": n_s,
+                    "x_finesse": x,
+                    "y_finesse": y,
+                    "P_finesse": P,
+                    "BR_finesse": B_R,
+                    "BZ_finesse": B_Z,
+                    "Bphi_finesse": B_phi,
+                    "Grav": np.zeros_like(x),
+                    "psi_finesse": psi,
+                    "q_finesse": q}
+    return finesse_data
+
+
+def make_run_finesse_synthetic(delay=0, output_name="finesse_synthetic.dat",
+                               **output_kwargs):
+    """
+    Makes a run_finesse_function that writes synthetic FINESSE output, see
+    synthetic_output, to the result path. delay is the time in seconds the
+    function sleeps to mimic the run time of FINESSE. Other keyword
+    arguments are passed on to synthetic_output.
+    """
+    def run_finesse_synthetic(input_data, result_path):
+        start = time.time()
+        finesse_data = synthetic_output(input_data, **output_kwargs)
+        finesse.FinesseSession.write_output_data(
+            os.path.join(result_path, output_name), finesse_data)
+        remaining = delay - (time.time() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+    return run_finesse_synthetic
+
+
+def example_input(npoint=33, a_0=0.5, B_phi0=2.5):
+    """ FinesseInput with the profiles of example_script.py
+    Handy to feed the synthetic backend, for example in benchmarks.
+
+    Keyword arguments:
+    npoint -- NR, NP, NR_INVERSE and NP_INVERSE of the input
+    a_0 -- the a_0 tokamak constant
+    B_phi0 -- the B_phi0 tokamak constant
+
+    Returns:
+    finesse_input -- an instance of FinesseInput
+    """
+    input = {"F2_tilde_poly": np.flipud([20, -68, -1.21, 55.25, -22, 0.001]),
+             "P_tilde_poly": np.flipud([1.00, -5.33, 17.52, -32.5, 30.04,
+                                        -10.72]),
+             "A_N": [0.8, 26, 0.4],
+             "gamma": 1.66666666666667,
+             "alpha": 3,
+             "epsilon": 0.3145,
+             "NR": npoint,
+             "NP": npoint,
+             "NR_INVERSE": npoint,
+             "NP_INVERSE": npoint,
+             "SIGN_I": -1}
+    boundary = np.array([[2.4402, 0], [-0.028406, 0.04322],
+                         [-0.27095, -0.051646], [0.047307, -0.034382]])
+    return finesse.FinesseInput(input, boundary, a_0, B_phi0)
@@ -7,6 +7,7 @@ It also contains some deprecated functions that you can use at your own risk.
 @licence: GPLv3
 """
 
+import hashlib
 import os
 import warnings
 from math import ceil
@@ -62,10 +63,63 @@ def rescale(values, new_0=1, new_1=0):
 plotcounter = 0
 
 
+def file_hash(path, block_size=2 ** 20):
+    """ Calculate the SHA-1 hex digest of the content of a file """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def memory_usage(arrays):
+    """ Calculate the memory kept alive by a list of arrays
+    A view keeps its whole base array alive, so the size of the base array
+    is counted instead of the size of the view. Each base is counted once.
+
+    Arguments:
+    arrays -- list of numpy arrays
+
+    Returns:
+    nbytes -- the total size of the underlying buffers in bytes
+    """
+    buffers = {}
+    for array in arrays:
+        while isinstance(array.base, np.ndarray):
+            array = array.base
+        buffers[id(array)] = array.nbytes
+    return sum(buffers.values())
+
+
 def relative_error(real, estimate):
     return abs(1 - estimate / real)
 
 
+def badness_indices(rho_est, real_resc):
+    """ Determine the points where badness looks at the relative error
+    These only depend on rho and the real values, so they can be reused for
+    many estimates on the same rho.
+
+    Arguments:
+    rho_est -- estimated values of rho
+    real_resc -- real values of the function at the estimated values of rho
+
+    Returns:
+    (pre_q_1_index, q_1_index, post_q_1_index, end_index)
+    with the index in rho_est of rho = .08, q = 1, q = 1.1 and the one-but-last
+    element
+    """
+    # Find the index for which the real rho is 0.08
+    pre_q_1_index = int((np.abs(rho_est-0.08)).argmin())
+    # Find the index for which the real value is one
+    q_1_index = int((np.abs(real_resc-1)).argmin())
+    # Find the index for which the real value is 1.1
+    post_q_1_index = int((np.abs(real_resc-1.1)).argmin())
+    # Find the one but last index
+    end_index = -2
+    return pre_q_1_index, q_1_index, post_q_1_index, end_index
+
+
 def badness(rho_real, real, rho_est, est):
     """ Determine the badness of an estimate
     Calculate the relative errors at q = 1, q = 1.1, rho = .08, one-but-last
@@ -100,37 +154,16 @@ def badness(rho_real, real, rho_est, est):
                                est)
     total_badness = np.nanmean(rel_error)
 
-    # Find the index for which the real value is one
-    index = np.int((np.abs(real_resc-1)).argmin())
-    badness = rel_error[index]
-    if real_resc[index] > est[index]:
-        badness *= -1
-    badness_q_1_index = index
-    badness_q_1 = badness
-
-    # Find the index for which the real rho is 0.08
-    index = np.int((np.abs(rho_est-0.08)).argmin())
-    badness = rel_error[index]
-    if real_resc[index] > est[index]:
-        badness *= -1
-    badness_pre_q_1_index = index
-    badness_pre_q_1 = badness
-
-    # Find the index for which the real value is 1.1
-    index = np.int((np.abs(real_resc-1.1)).argmin())
-    badness = rel_error[index]
-    if real_resc[index] > est[index]:
-        badness *= -1
-    badness_post_q_1_index = index
-    badness_post_q_1 = badness
-
-    # Find the one but last index
-    index = -2
-    badness = rel_error[index]
-    if real_resc[index] > est[index]:
-        badness *= -1
-    badness_end_index = index
-    badness_end = badness
+    badness_points = []
+    for index in badness_indices(rho_est, real_resc):
+        badness = rel_error[index]
+        if real_resc[index] > est[index]:
+            badness *= -1
+        badness_points.append((index, badness))
+    ((badness_pre_q_1_index,  badness_pre_q_1),
+     (badness_q_1_index,      badness_q_1),
+     (badness_post_q_1_index, badness_post_q_1),
+     (badness_end_index,      badness_end)) = badness_points
 
     if len(np.where(np.nanmax(rel_error) == rel_error)[0]) != 0:
         badness_max_index = np.where(np.nanmax(rel_error) == rel_error)[0][0]
@@ -6,46 +6,57 @@ PF2q access to the system running FINESSE.
 @licence: GPLv3
 """
 
-import subprocess
+import io
 import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+import pf2q.finesse as finesse
+import pf2q.monitor as monitor
+
+
+def check_call_input(command, input, **kwargs):
+    """
+    Run command with input on its stdin and wait for it to finish. Raises
+    subprocess.CalledProcessError if the command fails, like
+    subprocess.check_call.
+    """
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, **kwargs)
+    process.communicate(input)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
 
 
 def make_send_input_boundary(finessePaths, remote_user, remote_server):
     """
-    Makes the function that temporarely saves the input and boundary data in
-    the run directory and sends them to a remote server. It uses the Unix
-    shell command scp and assumes login is passwordless (for example,
-    using ssh keys)
+    Makes the function that sends the input and boundary data to a remote
+    server. Both files are rendered in memory and streamed as one tar archive
+    over the stdin of a single ssh command, no temporary files are written.
+    It uses the Unix shell commands ssh and tar and assumes login is
+    passwordless (for example, using ssh keys)
     """
     def send_input_boundary(input_data):
-        run_dirname, __ = os.path.split(os.path.abspath(__file__))
-        temp_input = os.path.join(run_dirname, "finesse.inp")
-        temp_boundary = os.path.join(run_dirname, "boundary.dat")
-        input_data.input_to_file(temp_input)
-        input_data.boundary_to_file(temp_boundary)
-        remote_input = finessePaths.path_module.join(finessePaths.INPUT_path,
-                                                     "finesse.inp")
-        remote_boundary = finessePaths.path_module.join(finessePaths.DATA_path,
-                                                        "boundary.dat")
         remote_string = remote_user + "@" + remote_server
-        subprocess.check_call(["scp",
-                               temp_input,
-                               remote_string + ":" + remote_input])
-        subprocess.check_call(["scp",
-                               temp_boundary,
-                               remote_string + ":" + remote_boundary])
-        os.remove(temp_input)
-        os.remove(temp_boundary)
+        check_call_input(["ssh", remote_string,
+                          "tar -xf - -C " + finessePaths.finesse_case_path],
+                         input_data.render_tar(finessePaths))
     return send_input_boundary
 
 
 def make_run_finesse_gate(finessePaths, remote_user,
-                          remote_gate, remote_server):
+                          remote_gate, remote_server, detectors=()):
     """
     Makes the function that runs FINESSE on a remote server that needs to be
     reached through a gate server. It uses the Unix shell command ssh and
     assumes login is passwordless (for example, using ssh keys)
     FINESSE needs to be installed on the remote_server.
+    The output of FINESSE is checked by detectors, see pf2q.monitor. When one
+    triggers the local ssh is killed, which closes the remote session.
     """
     def run_finesse_gate():
         remote_string = remote_user + "@" + remote_gate
@@ -54,14 +65,18 @@ def make_run_finesse_gate(finessePaths, remote_user,
                     export PATH=$PATH:~/usr/local/bin && \
                     cd " + finessePaths.finesse_case_path + "  \
                     && finesse\""]
-        subprocess.check_call(commands)
+        monitor.run_monitored(commands, detectors=detectors)
     return run_finesse_gate
 
 
-def make_run_finesse_local(finessePaths):
+def make_run_finesse_local(finessePaths, finesse_command="finesse",
+                           detectors=()):
     """
     Makes the function that runs FINESSE locally. On Linux, this uses
-    the /bin/sh shell.
+    the /bin/sh shell. finesse_command is the command that runs FINESSE.
+    If the result path is not the FINESSE OUTPUT path, the .dat output is
+    moved to the result path. The output of FINESSE is checked by
+    detectors, see pf2q.monitor, and FINESSE is killed when one triggers.
     """
     def run_finesse_local(input_data, result):
         local_input = finessePaths.path_module.join(finessePaths.INPUT_path, "finesse.inp")
@@ -69,10 +84,16 @@ def make_run_finesse_local(finessePaths):
         input_data.input_to_file(local_input)
         input_data.boundary_to_file(local_boundary)
 
-
         command = ["export PATH=$PATH:$HOME/usr/local/bin && cd " + \
-                   finessePaths.finesse_case_path + " && finesse"]
-        subprocess.check_call(command, shell=True)
+                   finessePaths.finesse_case_path + " && " + finesse_command]
+        monitor.run_monitored(command, detectors=detectors, shell=True)
+
+        output_path = os.path.abspath(finessePaths.OUTPUT_path)
+        if output_path != os.path.abspath(result):
+            for file in os.listdir(output_path):
+                if file.startswith("finesse") and file.endswith(".dat"):
+                    shutil.move(os.path.join(output_path, file),
+                                os.path.join(result, file))
     return run_finesse_local
 
 
@@ -109,3 +130,169 @@ def make_remove_remote(finessePaths, remote_user, remote_gate):
                                 finessePaths.OUTPUT_path + "*.log " +
                                 finessePaths.OUTPUT_path + "*.inp")])
     return remove_remote
+
+
+class MultiplexedConnection(object):
+    """
+    Runs FINESSE on a remote server over one persistent, multiplexed ssh
+    connection. The first run opens an OpenSSH control master, later runs
+    reuse it, so the handshake through the gate is only done once. Every
+    run is one scripted exchange: the input and boundary are streamed as tar
+    archive over stdin, FINESSE is run, the .dat output comes back as tar
+    archive over stdout and the remote files are removed. The script reports
+    the end of each stage on stderr, which is used to record the wall time
+    of each stage in timings.
+
+    The FINESSE output is checked live by detectors, see pf2q.monitor. When
+    one triggers the local ssh is killed, which ends the remote session.
+
+    Use the run_finesse method as run_finesse_function of a FinesseSession.
+    For testing without network, pass a stand-in for ssh as ssh_command, for
+    example [sys.executable, "-m", "pf2q.local_ssh"].
+    """
+    stages = ["send", "finesse", "fetch", "cleanup"]
+    stage_marker = "PF2Q_STAGE "
+
+    def __init__(self, finessePaths, remote_user, remote_gate,
+                 remote_server=None, ssh_command=["ssh"],
+                 finesse_command="finesse", persist=600, detectors=()):
+        """
+        Arguments:
+        finessePaths -- FinessePaths instance of the remote FINESSE case
+        remote_user -- user name on remote_gate
+        remote_gate -- server the ssh connection is made to
+
+        Keyword arguments:
+        remote_server -- server that runs FINESSE, reached with ssh from
+                         remote_gate. If None, FINESSE runs on remote_gate
+        ssh_command -- command (as list) used instead of ssh
+        finesse_command -- command that runs FINESSE on the remote server
+        persist -- seconds the idle control master stays open
+        detectors -- list of divergence detectors, see pf2q.monitor
+        """
+        self.finessePaths = finessePaths
+        self.remote_string = remote_user + "@" + remote_gate
+        self.remote_server = remote_server
+        self.ssh_command = list(ssh_command)
+        self.finesse_command = finesse_command
+        self.control_dir = tempfile.mkdtemp(prefix="pf2q")
+        self.ssh_options = ["-o", "ControlMaster=auto",
+                            "-o", "ControlPath=" +
+                            os.path.join(self.control_dir, "cm"),
+                            "-o", "ControlPersist=" + str(persist)]
+        self.detectors = list(detectors)
+        self.timings = []
+        # The ssh of the running exchange, see cancel
+        self.process = None
+
+    def _script(self):
+        """ The shell script that does one FINESSE run remotely """
+        paths = self.finessePaths
+        run_finesse = ("ulimit -s unlimited && "
+                       "export PATH=$PATH:~/usr/local/bin && "
+                       "cd " + paths.finesse_case_path + " && " +
+                       self.finesse_command)
+        if self.remote_server is not None:
+            run_finesse = ("ssh -n " + self.remote_server +
+                           " \"" + run_finesse.replace("$", "\\$") + "\"")
+        lines = ["cd " + paths.finesse_case_path + " || exit 10",
+                 "tar -xf - || exit 10",
+                 "echo " + self.stage_marker + "send >&2",
+                 "(" + run_finesse + ") </dev/null 1>&2 || status=11",
+                 "echo " + self.stage_marker + "finesse >&2",
+                 "if [ -z \"$status\" ]; then",
+                 "  (cd " + paths.OUTPUT_path + " && tar -cf - *.dat) || "
+                 "status=12",
+                 "fi",
+                 "echo " + self.stage_marker + "fetch >&2",
+                 "rm -f " + paths.OUTPUT_path + "*.dat " +
+                 paths.OUTPUT_path + "*.log " + paths.OUTPUT_path + "*.inp",
+                 "echo " + self.stage_marker + "cleanup >&2",
+                 "exit ${status:-0}"]
+        return "\n".join(lines)
+
+    def run_finesse(self, input_data, result_path):
+        """
+        Run FINESSE remotely for input_data and save the resulting .dat
+        files in result_path. Raises FinesseSession.FinesseOutputError if any
+        stage fails. The wall time of each stage is appended to timings.
+        """
+        command = (self.ssh_command + self.ssh_options +
+                   [self.remote_string, self._script()])
+        start = time.time()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   preexec_fn=os.setsid)
+        self.process = process
+        watchdog = monitor.Watchdog(process, self.detectors)
+        stage_ends = []
+
+        def read_stderr():
+            for line in iter(process.stderr.readline, b''):
+                line = line.decode(errors="replace")
+                if line.startswith(self.stage_marker):
+                    stage_ends.append(time.time())
+                else:
+                    sys.stderr.write(line)
+                    watchdog.feed(line)
+        stderr_thread = threading.Thread(target=read_stderr)
+        stderr_thread.start()
+        try:
+            process.stdin.write(input_data.render_tar(self.finessePaths))
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        output = process.stdout.read()
+        process.wait()
+        stderr_thread.join()
+        self.process = None
+
+        timing = {}
+        previous = start
+        for stage, end in zip(self.stages, stage_ends):
+            timing[stage] = end - previous
+            previous = end
+        timing["total"] = time.time() - start
+        self.timings.append(timing)
+        watchdog.stop()
+
+        if process.returncode != 0:
+            if process.returncode == 11:
+                error_msg = "Could not run FINESSE"
+            elif process.returncode == 12:
+                error_msg = ("Could not copy remote to local, "
+                             "did FINESSE converge?")
+            elif len(stage_ends) == 0:
+                error_msg = "Could not copy local to remote"
+                raise finesse.FinesseTransportError(error_msg)
+            else:
+                error_msg = "Remote run failed in stage after " + \
+                            self.stages[len(stage_ends) - 1]
+                raise finesse.FinesseTransportError(error_msg)
+            raise finesse.FinesseSession.FinesseOutputError(error_msg)
+
+        with tarfile.open(fileobj=io.BytesIO(output), mode='r') as tar:
+            for member in tar.getmembers():
+                if member.isfile():
+                    with open(os.path.join(result_path,
+                                           os.path.basename(member.name)),
+                              'wb') as f:
+                        f.write(tar.extractfile(member).read())
+
+    def cancel(self):
+        """ Kill the ssh of the running exchange, which ends the remote
+        session. Called by FinesseSession.cancel; run_finesse then raises
+        FinesseOutputError
+        """
+        process = self.process
+        if process is not None and process.poll() is None:
+            monitor.kill_process_group(process)
+
+    def close(self):
+        """ Close the control master and remove its socket directory """
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(self.ssh_command + self.ssh_options +
+                            ["-O", "exit", self.remote_string],
+                            stdout=devnull, stderr=devnull)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
@@ -7,6 +7,8 @@ PF2q access to the system running FINESSE.
 """
 
 import subprocess
+import shutil
+import tempfile
 import os
 
 
@@ -14,13 +16,14 @@ def make_send_input_boundary_pscp(finessePaths, pscp_path, putty_session,
                                   remote_user, remote_server):
     """
     Makes the function that temporarely saves the input and boundary data in
-    the run directory and sends them to a remote server. It uses the PuTTY tool
-    PSCP and assumes a PuTTY session exists and login is passwordless (for
-    example, using ssh keys)
+    a temporary directory and sends them to a remote server. It uses the PuTTY
+    tool PSCP and assumes a PuTTY session exists and login is passwordless
+    (for example, using ssh keys). Use make_send_input_boundary_plink to
+    send the data without temporary files.
     """
     def send_input_boundary_pscp(input_data):
 
-        run_dirname, __ = os.path.split(os.path.abspath(__file__))
+        run_dirname = tempfile.mkdtemp()
         temp_input = os.path.join(run_dirname, "finesse.inp")
         temp_boundary = os.path.join(run_dirname, "boundary.dat")
         input_data.input_to_file(temp_input)
@@ -36,11 +39,31 @@ def make_send_input_boundary_pscp(finessePaths, pscp_path, putty_session,
         subprocess.check_call(pscp_path + " -load " + putty_session + " " +
                               temp_boundary + " " + remote_string + ":" +
                               remote_boundary)
-        os.remove(temp_input)
-        os.remove(temp_boundary)
+        shutil.rmtree(run_dirname)
     return send_input_boundary_pscp
 
 
+def make_send_input_boundary_plink(finessePaths, plink_path, putty_session,
+                                   remote_user, remote_server):
+    """
+    Makes the function that sends the input and boundary data to a remote
+    server. Both files are rendered in memory and streamed as one tar archive
+    over the stdin of a single PuTTY Plink command, no temporary files are
+    written. It assumes a PuTTY session exists, login is passwordless (for
+    example, using ssh keys) and tar is installed on the remote server.
+    """
+    def send_input_boundary_plink(input_data):
+        remote_string = remote_user + "@" + remote_server
+        command = plink_path + " -batch -load " + putty_session + " "
+        command += remote_string + " \"tar -xf - -C "
+        command += finessePaths.finesse_case_path + "\""
+        process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        process.communicate(input_data.render_tar(finessePaths))
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+    return send_input_boundary_plink
+
+
 def make_run_finesse_gate(finessePaths, putty_path, putty_session,
                           remote_user, remote_gate, remote_server):
     """
@@ -117,7 +140,6 @@ def make_save_input_boundary(local_INPUT_path, local_DATA_path):
     disk with the local client. This is the case at DIFFER.
     """
     def save_input_boundary(input_data):
-        run_dirname, __ = os.path.split(os.path.abspath(__file__))
         input = os.path.join(local_INPUT_path, "finesse.inp")
         boundary = os.path.join(local_DATA_path, "boundary.dat")
         input_data.input_to_file(input)
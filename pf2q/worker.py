@@ -0,0 +1,301 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module contains a long-lived FINESSE worker and the client to talk to
+it. The worker runs on the machine with FINESSE, for example started over
+ssh, and receives jobs over its stdin. Each job is run in a scratch copy of
+the FINESSE case and only the requested output columns are sent back, in
+binary, over its stdout. This avoids the ssh/scp setup of every run.
+
+Start a worker by hand with
+    python -m pf2q.worker finesse_case_path [finesse_command]
+
+Protocol: every message is a frame consisting of a 4 byte big-endian
+length, a JSON header of that length and the binary payloads whose sizes
+are listed in the header under "payload_sizes".
+@author: Karel van de Plassche
+@licence: GPLv3
+"""
+from __future__ import print_function
+
+import collections
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+import pf2q.finesse as finesse
+
+
+def write_frame(stream, header, payloads=()):
+    """ Write one frame to a binary stream
+
+    Arguments:
+    stream -- binary stream to write to
+    header -- JSON serializable dict
+
+    Keyword arguments:
+    payloads -- list of bytes sent after the header
+    """
+    header = dict(header)
+    header["payload_sizes"] = [len(payload) for payload in payloads]
+    header_bytes = json.dumps(header).encode("utf-8")
+    stream.write(struct.pack(">I", len(header_bytes)))
+    stream.write(header_bytes)
+    for payload in payloads:
+        stream.write(payload)
+    stream.flush()
+
+
+def _read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError("Stream closed in the middle of a frame")
+        data += chunk
+    return data
+
+
+def read_frame(stream):
+    """ Read one frame from a binary stream
+
+    Arguments:
+    stream -- binary stream to read from
+
+    Returns:
+    (header, payloads) -- the header dict and list of payload bytes, or
+                          (None, []) if the stream is closed
+    """
+    size = stream.read(4)
+    if not size:
+        return None, []
+    size = struct.unpack(">I", size + _read_exactly(stream, 4 - len(size)))[0]
+    header = json.loads(_read_exactly(stream, size).decode("utf-8"))
+    payloads = [_read_exactly(stream, payload_size)
+                for payload_size in header["payload_sizes"]]
+    return header, payloads
+
+
+class FinesseWorker():
+    """ Runs FINESSE jobs received over a stream in a scratch case directory
+    """
+
+    def __init__(self, finesse_case_path, finesse_command="finesse",
+                 scratch_path=None):
+        """
+        The FINESSE case is copied once to a scratch directory, all jobs are
+        run in that copy.
+
+        Arguments:
+        finesse_case_path -- path of the FINESSE case to copy
+
+        Keyword arguments:
+        finesse_command -- shell command that runs FINESSE in the case
+        scratch_path -- directory to create the scratch case in
+        """
+        self.finesse_command = finesse_command
+        self.scratch_dir = tempfile.mkdtemp(prefix="pf2q_worker",
+                                            dir=scratch_path)
+        case_path = os.path.join(self.scratch_dir, "case")
+        shutil.copytree(finesse_case_path, case_path,
+                        ignore=shutil.ignore_patterns("*.dat", "*.log"))
+        self.finesse_paths = finesse.FinessePaths(case_path + os.sep,
+                                                  path_module=os.path)
+        for path in [self.finesse_paths.INPUT_path,
+                     self.finesse_paths.DATA_path,
+                     self.finesse_paths.OUTPUT_path]:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def run_job(self, header, payloads):
+        """ Run one job and return the reply frame
+
+        Arguments:
+        header -- the job header, with the names of the requested columns
+                  under "columns" and the dtype under "dtype"
+        payloads -- [input file, boundary file] as bytes
+
+        Returns:
+        (header, payloads) -- the reply frame
+        """
+        paths = self.finesse_paths
+        for file in os.listdir(paths.OUTPUT_path):
+            os.remove(os.path.join(paths.OUTPUT_path, file))
+        with open(os.path.join(paths.INPUT_path, "finesse.inp"), 'wb') as f:
+            f.write(payloads[0])
+        with open(os.path.join(paths.DATA_path, "boundary.dat"), 'wb') as f:
+            f.write(payloads[1])
+
+        # FINESSE talks on stdout, which is reserved for the protocol
+        returncode = subprocess.call(self.finesse_command, shell=True,
+                                     cwd=paths.finesse_case_path,
+                                     stdout=sys.stderr.fileno())
+        if returncode != 0:
+            return {"status": "error",
+                    "message": "Could not run FINESSE"}, []
+        output_files = [file for file in os.listdir(paths.OUTPUT_path)
+                        if file.startswith("finesse") and
+                        file.endswith(".dat")]
+        if len(output_files) == 0:
+            return {"status": "error",
+                    "message": "Could not find output file. "
+                               "Did FINESSE converge?"}, []
+
+        columns = collections.OrderedDict(
+                            (name, finesse.FinesseDataSet.data[name])
+                            for name in header["columns"])
+        try:
+            finesse_data = finesse.FinesseSession.read_output_data(
+                                os.path.join(paths.OUTPUT_path,
+                                             output_files[0]),
+                                columns=columns, dtype=header["dtype"])
+        except finesse.FinesseSession.FinesseOutputError as error:
+            return {"status": "error", "message": str(error)}, []
+        constants = dict((name, finesse_data[name])
+                         for name in finesse.FinesseDataSet.constants
+                         if name in finesse_data)
+        return ({"status": "ok", "constants": constants,
+                 "columns": header["columns"], "dtype": header["dtype"]},
+                [finesse_data[name].tobytes() for name in header["columns"]])
+
+    def serve(self, input_stream, output_stream):
+        """ Run jobs from input_stream until it closes or a quit message """
+        try:
+            while True:
+                header, payloads = read_frame(input_stream)
+                if header is None or header["type"] == "quit":
+                    break
+                if header["type"] == "run":
+                    reply, reply_payloads = self.run_job(header, payloads)
+                else:
+                    reply = {"status": "error",
+                             "message": "Unknown job type " + header["type"]}
+                    reply_payloads = []
+                reply["id"] = header.get("id")
+                write_frame(output_stream, reply, reply_payloads)
+        finally:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+
+class WorkerConnection():
+    """ Client of a FinesseWorker
+    Starts the worker with worker_command, for example
+    ["ssh", "user@server", "python -m pf2q.worker /path/to/case"], and keeps
+    it running between jobs. Use the run_finesse method as
+    run_finesse_function of a FinesseSession. For a local stand-in use
+    [sys.executable, "-m", "pf2q.worker", finesse_case_path, command].
+    """
+
+    def __init__(self, worker_command, dtype=float):
+        """
+        Arguments:
+        worker_command -- command (as list) that starts the worker
+
+        Keyword arguments:
+        dtype -- dtype the worker sends the 2d data sets in
+        """
+        self.worker_command = worker_command
+        self.dtype = np.dtype(dtype).name
+        self.process = None
+        self.job_id = 0
+
+    def _start(self):
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(self.worker_command,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+
+    def run_finesse(self, input_data, result_path):
+        """ Run FINESSE on the worker
+        Nothing is written to result_path, the parsed output is returned.
+
+        Returns:
+        finesse_data -- dict with the constants and 2d data sets
+        """
+        self._start()
+        # cancel can reset self.process from another thread
+        process = self.process
+        self.job_id += 1
+        columns = list(finesse.FinesseDataSet.data.keys())
+        try:
+            write_frame(process.stdin,
+                        {"type": "run", "id": self.job_id,
+                         "columns": columns, "dtype": self.dtype},
+                        [input_data.render_input(),
+                         input_data.render_boundary()])
+            header, payloads = read_frame(process.stdout)
+            # Skip the replies of earlier jobs whose exchange was
+            # interrupted, for example by a timeout
+            while header is not None and \
+                    isinstance(header.get("id"), int) and \
+                    header["id"] < self.job_id:
+                header, payloads = read_frame(process.stdout)
+        except (IOError, OSError, EOFError):
+            header = None
+        except BaseException:
+            # Interrupted in the middle of a frame, the stream can not be
+            # trusted anymore
+            self.kill()
+            raise
+        if header is None:
+            self.close()
+            error_msg = "Lost connection to the FINESSE worker"
+            raise finesse.FinesseTransportError(error_msg)
+        if header.get("id") != self.job_id:
+            # The stream is out of step, start over with a new worker
+            self.kill()
+            error_msg = ("FINESSE worker replied to job " +
+                         str(header.get("id")) + " instead of job " +
+                         str(self.job_id))
+            raise finesse.FinesseTransportError(error_msg)
+        if header["status"] != "ok":
+            raise finesse.FinesseSession.FinesseOutputError(header["message"])
+
+        finesse_data = dict(header["constants"])
+        shape = [finesse_data["NR_INVERSE"], finesse_data["NP_INVERSE"]]
+        for name, payload in zip(header["columns"], payloads):
+            finesse_data[name] = np.frombuffer(
+                        payload, dtype=header["dtype"]).reshape(shape).copy()
+        return finesse_data
+
+    def kill(self):
+        """ Kill the worker without waiting for the job it runs """
+        process, self.process = self.process, None
+        if process is not None:
+            process.kill()
+            process.wait()
+
+    def cancel(self):
+        """ Kill the worker of the running job. Called by
+        FinesseSession.cancel; run_finesse then raises FinesseOutputError
+        and the next job starts a new worker
+        """
+        self.kill()
+
+    def close(self):
+        """ Ask the worker to quit and wait for it """
+        if self.process is not None:
+            try:
+                write_frame(self.process.stdin, {"type": "quit"})
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            self.process.wait()
+            self.process = None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python -m pf2q.worker finesse_case_path "
+              "[finesse_command]", file=sys.stderr)
+        sys.exit(1)
+    worker = FinesseWorker(*sys.argv[1:3])
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    worker.serve(stdin, stdout)